@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест бота с локальными заглушками Telegram Bot API, Sheets и Drive
+
+N мастеров одновременно проходят весь сценарий /start → фото. Заглушки
+работают в том же процессе, с настраиваемой задержкой и долей ошибок,
+поэтому сеть не нужна и результаты можно сравнивать между версиями.
+
+Запуск: python bench_bot.py --masters 20 --entries 3 --google-latency 150
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+
+from aiohttp import web
+
+from bench_images import bench_env, make_photo
+
+
+def percentile(values, p):
+    """Перцентиль p (0–100) без интерполяции"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def fault_middleware(service):
+    """Задержка и случайные ошибки для всех запросов к заглушке"""
+
+    @web.middleware
+    async def middleware(request, handler):
+        service.calls[request.match_info.route.name or request.path] += 1
+        if service.latency:
+            await asyncio.sleep(service.latency * random.uniform(0.5, 1.5))
+        if service.error_rate and random.random() < service.error_rate and not request.path.endswith('/token'):
+            service.errors += 1
+            # Тело дочитывается, иначе keep-alive соединение клиента зависает
+            await request.read()
+            return web.json_response(
+                service.error_body(),
+                status=service.error_status
+            )
+        return await handler(request)
+
+    return middleware
+
+
+class FakeService:
+    """Общая часть заглушек: aiohttp-приложение на свободном порту"""
+
+    def __init__(self, latency, error_rate):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = 503
+        self.calls = Counter()
+        self.errors = 0
+        self.app = web.Application(middlewares=[fault_middleware(self)], client_max_size=64 * 1024 * 1024)
+        self.runner = None
+        self.url = None
+
+    def error_body(self):
+        return {}
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeTelegram(FakeService):
+    """Заглушка Bot API: отвечает на методы бота и отдает фото"""
+
+    def __init__(self, latency, error_rate, photo):
+        super().__init__(latency, error_rate)
+        self.photo = photo
+        self.outgoing = defaultdict(asyncio.Queue)
+        self.message_id = 0
+        self.updates = []
+        self._updates_added = asyncio.Event()
+        self.app.router.add_route('*', '/bot{token}/{method}', self.method, name='bot')
+        self.app.router.add_get('/file/bot{token}/{path:.*}', self.file, name='file')
+
+    def error_body(self):
+        return {'ok': False, 'error_code': 503, 'description': 'Injected error'}
+
+    def next_message(self, chat_id, text):
+        self.message_id += 1
+        return {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'},
+            'text': text
+        }
+
+    async def method(self, request):
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        method = request.match_info['method']
+        self.calls[method] += 1
+
+        if method == 'getMe':
+            result = {
+                'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                'can_join_groups': False, 'can_read_all_group_messages': False,
+                'supports_inline_queries': False
+            }
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id') or 0)
+            self.outgoing[chat_id].put_nowait(params.get('text', ''))
+            result = self.next_message(chat_id, params.get('text', ''))
+        elif method == 'getUpdates':
+            result = await self.pending_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        elif method == 'getFile':
+            file_id = params['file_id']
+            result = {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self.photo_bytes(file_id)),
+                'file_path': f"photos/{file_id}.jpg"
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def push_update(self, update):
+        """Обновление для бота в режиме polling"""
+        self.updates.append(update)
+        self._updates_added.set()
+
+    async def pending_updates(self, offset, timeout):
+        """Long polling: обновления с update_id не меньше offset"""
+        deadline = time.perf_counter() + timeout
+        while True:
+            pending = [update for update in self.updates if update['update_id'] >= offset]
+            remaining = deadline - time.perf_counter()
+            if pending or remaining <= 0:
+                return pending
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def photo_bytes(self, file_id):
+        # Уникальный хвост после EOI: разные записи не попадают в кэш фото
+        return self.photo + file_id.encode()
+
+    async def file(self, request):
+        file_id = request.match_info['path'].rsplit('/', 1)[-1][:-len('.jpg')]
+        return web.Response(body=self.photo_bytes(file_id), content_type='image/jpeg')
+
+    async def expect(self, chat_id, fragment, timeout):
+        """Дождаться сообщения бота с нужным текстом"""
+        deadline = time.perf_counter() + timeout
+        while True:
+            text = await asyncio.wait_for(
+                self.outgoing[chat_id].get(),
+                max(0.0, deadline - time.perf_counter())
+            )
+            if fragment in text:
+                return text
+
+
+class FakeGoogle(FakeService):
+    """Заглушка OAuth, Drive v3 и Sheets v4"""
+
+    def __init__(self, latency, error_rate, public_folder, columns):
+        super().__init__(latency, error_rate)
+        self.public_folder = public_folder
+        self.columns = columns
+        self.rows = []
+        self.appended = []
+        self.files = {}
+        router = self.app.router
+        router.add_post('/token', self.token, name='token')
+        router.add_post('/upload/drive/v3/files', self.upload, name='drive.files.create')
+        router.add_get('/drive/v3/files', self.list_files, name='drive.files.list')
+        router.add_get('/drive/v3/files/{file_id}/permissions', self.list_permissions, name='drive.permissions.list')
+        router.add_post('/drive/v3/files/{file_id}/permissions', self.create_permission, name='drive.permissions.create')
+        router.add_post('/batch/drive/v3', self.batch, name='drive.batch')
+        router.add_get('/v4/spreadsheets/{sheet}/values/{range:.*}', self.values_get, name='sheets.values.get')
+        router.add_put('/v4/spreadsheets/{sheet}/values/{range:.*}', self.values_update, name='sheets.values.update')
+        router.add_post('/v4/spreadsheets/{sheet}/values/{range:.*}', self.values_append, name='sheets.values.append')
+
+    def error_body(self):
+        return {'error': {'code': self.error_status, 'message': 'Injected error', 'status': 'UNAVAILABLE'}}
+
+    async def token(self, request):
+        return web.json_response({'access_token': 'bench', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+    async def upload(self, request):
+        body = await request.read()
+        file_id = uuid.uuid4().hex
+        self.files[file_id] = len(body)
+        return web.json_response({'id': file_id})
+
+    async def list_files(self, request):
+        return web.json_response({'files': []})
+
+    async def list_permissions(self, request):
+        permissions = [{'type': 'anyone', 'role': 'reader'}] if self.public_folder else []
+        return web.json_response({'permissions': permissions})
+
+    async def create_permission(self, request):
+        return web.json_response({'id': 'anyoneWithLink'})
+
+    async def batch(self, request):
+        # Каждая часть multipart/mixed — вложенный HTTP-запрос permissions().create
+        body = await request.read()
+        message = BytesParser().parsebytes(
+            f"Content-Type: {request.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            content_id = part['Content-ID'].strip('<>')
+            self.calls['drive.batch.item'] += 1
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                "HTTP/1.1 200 OK\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                '{"id": "anyoneWithLink"}\r\n'
+            )
+        payload = ''.join(parts) + f"--{boundary}--\r\n"
+        return web.Response(
+            body=payload.encode(),
+            headers={'Content-Type': f'multipart/mixed; boundary={boundary}'}
+        )
+
+    async def values_get(self, request):
+        cells = request.match_info['range'].split('!')[-1]
+        start = cells.split(':')[0]
+        if cells == '1:1':
+            values = self.rows[:1]
+        elif start[1:].isdigit():
+            # Прямоугольный диапазон вида A2:G — строки целиком
+            values = self.rows[int(start[1:]) - 1:]
+        else:
+            column = ord(cells.split(':')[0][0]) - ord('A')
+            values = [[row[column]] for row in self.rows if len(row) > column]
+        return web.json_response({'values': values} if values else {})
+
+    async def values_update(self, request):
+        body = await request.json()
+        cells = request.match_info['range'].split('!')[-1]
+        column = ord(cells[0]) - ord('A')
+        if not self.rows:
+            self.rows.append([])
+        header = self.rows[0]
+        header.extend([''] * (column - len(header)))
+        header[column:column + len(body['values'][0])] = body['values'][0]
+        return web.json_response({'updatedCells': len(body['values'][0])})
+
+    async def values_append(self, request):
+        body = await request.json()
+        now = time.perf_counter()
+        self.rows.extend(body['values'])
+        self.appended.extend((now, row) for row in body['values'])
+        return web.json_response({'updates': {'updatedRows': len(body['values'])}})
+
+
+class Stats:
+    """Результаты нагрузочного теста"""
+
+    def __init__(self):
+        self.reply = []
+        self.flow = []
+        self.photo_sent = {}
+        self.failed = 0
+
+
+def message_update(update_id, chat_id, text=None, photo=None, media_group_id=None):
+    """JSON входящего сообщения от мастера"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f"Мастер {chat_id}"}
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    if photo is not None:
+        message['photo'] = photo
+    if media_group_id is not None:
+        message['media_group_id'] = media_group_id
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id, chat_id, data):
+    """JSON нажатия кнопки"""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f"Мастер {chat_id}"},
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': '...'
+            }
+        }
+    }
+
+
+async def run_master(jb, application, telegram, index, args, stats, update_ids):
+    """Один мастер проходит сценарий args.entries раз подряд (или вводит их одной сменой)"""
+    from telegram import Update
+
+    chat_id = 100000 + index
+    saved = "Добавлено в смену" if args.shift else "Данные сохранены"
+
+    async def send(data, fragment):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return await telegram.expect(chat_id, fragment, args.step_timeout)
+
+    async def header(command):
+        await send(message_update(next(update_ids), chat_id, text=command), "ФИО")
+        await send(message_update(next(update_ids), chat_id, text=f"Мастер {index}"), "дату")
+        await send(callback_update(next(update_ids), chat_id, 'date_today'), "смену")
+        await send(callback_update(next(update_ids), chat_id, 'день'), "наименование")
+
+    comments = []
+    try:
+        started = time.perf_counter()
+        if args.shift:
+            await header('/shift')
+        for entry in range(args.entries):
+            photos = []
+            for number in range(args.album):
+                file_id = f"photo-{index}-{entry}-{number}"
+                photos.append([
+                    {'file_id': f"{file_id}-s", 'file_unique_id': f"{file_id}-s", 'width': 320, 'height': 240},
+                    {'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600},
+                    {'file_id': f"{file_id}-x", 'file_unique_id': f"{file_id}-x", 'width': 1280, 'height': 960}
+                ])
+            comment = f"запись {index}-{entry}"
+            if not args.shift:
+                await header('/start')
+            await send(callback_update(next(update_ids), chat_id, 'name_0'), "комментарий")
+            await send(message_update(next(update_ids), chat_id, text=comment), "фото")
+            photo_sent = time.perf_counter()
+            if args.album == 1:
+                await send(message_update(next(update_ids), chat_id, photo=photos[0]), saved)
+            else:
+                # Альбом: фото приходят отдельными обновлениями с общим media_group_id
+                media_group_id = f"album-{index}-{entry}"
+                for photo in photos:
+                    await application.update_queue.put(Update.de_json(
+                        message_update(next(update_ids), chat_id, photo=photo, media_group_id=media_group_id),
+                        application.bot
+                    ))
+                await telegram.expect(chat_id, saved, args.step_timeout)
+            finished = time.perf_counter()
+
+            stats.reply.append(finished - photo_sent)
+            stats.flow.append(finished - started)
+            started = finished
+            comments.append(comment)
+            if not args.shift:
+                stats.photo_sent[comment] = photo_sent
+
+        if args.shift:
+            # Записи смены уходят в таблицу после завершения: задержка считается от него
+            flushed = time.perf_counter()
+            await send(callback_update(next(update_ids), chat_id, 'пакет_завершить'), "Смена сохранена")
+            for comment in comments:
+                stats.photo_sent[comment] = flushed
+    except asyncio.TimeoutError:
+        stats.failed += 1
+
+
+async def wait_committed(google, stats, timeout):
+    """Дождаться, пока все подтвержденные записи попадут в таблицу"""
+    deadline = time.perf_counter() + timeout
+    comment_column = google.columns.index('Комментарий')
+    while time.perf_counter() < deadline:
+        committed = {row[comment_column] for _, row in google.appended}
+        if set(stats.photo_sent) <= committed:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def report(args, stats, telegram, google, elapsed, commit_elapsed):
+    """Печать результатов"""
+    comment_column = google.columns.index('Комментарий')
+    commit = [
+        at - stats.photo_sent[row[comment_column]]
+        for at, row in google.appended
+        if row[comment_column] in stats.photo_sent
+    ]
+    entries = len(stats.reply)
+
+    print(f"Мастеров: {args.masters}, записей на мастера: {args.entries}, "
+          f"задержка Telegram/Google: {args.telegram_latency:.0f}/{args.google_latency:.0f} мс, "
+          f"ошибки Google: {args.google_error_rate:.0%} ({args.google_error_status})")
+    if args.workers:
+        print(f"Воркеров выгрузки: {args.workers}")
+    if args.shift:
+        print("Ввод сменой: /shift один раз, записи выгружаются после завершения смены")
+    if args.album > 1:
+        print(f"Фото в альбоме: {args.album}, файлов на Drive: {len(google.files)}")
+    print(f"Записей подтверждено: {entries}, не завершено: {stats.failed}, "
+          f"строк в таблице: {len(commit)}")
+    print(f"Пропускная способность: {entries / elapsed:.1f} записей/с (подтверждение), "
+          f"{len(commit) / commit_elapsed:.1f} записей/с (запись в таблицу)")
+    print(f"{'задержка, мс':<28} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, values in (
+        ("фото → подтверждение", stats.reply),
+        ("продукт → подтверждение" if args.shift else "/start → подтверждение", stats.flow),
+        ("фото → строка в таблице", commit)
+    ):
+        print(f"{name:<28} " + " ".join(
+            f"{percentile(values, p) * 1000:>8.0f}" for p in (50, 95, 99)
+        ))
+    print("Запросы к Google: " + ", ".join(
+        f"{name}={count}" for name, count in sorted(google.calls.items()) if name != 'token'
+    ) + f", ошибок: {google.errors}")
+    print("Запросы к Telegram: " + ", ".join(
+        f"{name}={count}" for name, count in sorted(telegram.calls.items()) if name not in ('bot', 'file')
+    ))
+
+
+async def run(args):
+    photo = make_photo(800, 600)
+    telegram = FakeTelegram(args.telegram_latency / 1000, args.telegram_error_rate, photo)
+    await telegram.start()
+
+    # COLUMN_HEADERS известны только после импорта, поэтому заголовки передаются позже
+    google = FakeGoogle(args.google_latency / 1000, args.google_error_rate, not args.private_folder, [])
+    google.error_status = args.google_error_status
+    await google.start()
+
+    bench_env(token_uri=f"{google.url}/token")
+    os.environ['TELEGRAM_API_URL'] = f"{telegram.url}/bot"
+    os.environ['TELEGRAM_FILE_URL'] = f"{telegram.url}/file/bot"
+    os.environ['GOOGLE_ROOT_URL'] = google.url
+    os.environ.setdefault('UPDATE_STATS_INTERVAL', '0')
+    os.environ.setdefault('OUTBOX_RETRY_BASE', '0.5')
+    os.environ.setdefault('OUTBOX_RETRY_MAX', '5')
+    os.environ.setdefault('GOOGLE_RETRY_BASE_DELAY', '0.2')
+    os.environ.setdefault('GOOGLE_RETRY_MAX_DELAY', '2')
+    if args.workers:
+        os.environ['UPLOAD_WORKERS'] = str(args.workers)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import journal_bot as jb
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    google.columns = list(jb.COLUMN_HEADERS)
+
+    jb.warm_image_pool()
+    jb.google_health()
+    await jb.ensure_sheet_layout(jb.google_services['sheets'])
+    await jb.detect_drive_public_mode(jb.google_services['drive'])
+
+    jb.open_storage()
+    application = jb.build_application()
+    await application.initialize()
+    await application.start()
+    if args.workers:
+        # Фото и выгрузку обрабатывают процессы-воркеры с общей очередью в SQLite
+        upload_tasks = [asyncio.create_task(jb.run_upload_worker(index)) for index in range(args.workers)]
+    else:
+        upload_tasks = [asyncio.create_task(jb.outbox.drain(application.bot))]
+
+    stats = Stats()
+    update_ids = iter(range(1, 10 ** 9))
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        run_master(jb, application, telegram, index, args, stats, update_ids)
+        for index in range(args.masters)
+    ])
+    elapsed = time.perf_counter() - started
+    await wait_committed(google, stats, args.commit_timeout)
+    commit_elapsed = time.perf_counter() - started
+
+    for task in upload_tasks:
+        task.cancel()
+    await asyncio.gather(*upload_tasks, return_exceptions=True)
+    await jb.sheets_queue.close()
+    await jb.drive_permission_queue.close()
+    if jb._http_session is not None:
+        await jb._http_session.close()
+    await application.stop()
+    await application.shutdown()
+    jb.image_executor.shutdown(wait=True)
+    jb.close_storage()
+    await telegram.stop()
+    await google.stop()
+
+    report(args, stats, telegram, google, elapsed, commit_elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--masters", type=int, default=20, help="одновременных мастеров")
+    parser.add_argument("--entries", type=int, default=3, help="записей на мастера")
+    parser.add_argument("--album", type=int, default=1, help="фото в записи (больше 1 — альбом)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="процессов-воркеров выгрузки (0 — выгрузка в процессе бота)")
+    parser.add_argument("--shift", action="store_true",
+                        help="записи мастера вводятся одной сменой (/shift) и выгружаются вместе")
+    parser.add_argument("--telegram-latency", type=float, default=20, help="задержка Bot API, мс")
+    parser.add_argument("--google-latency", type=float, default=150, help="задержка Google API, мс")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="доля ошибок Bot API")
+    parser.add_argument("--google-error-rate", type=float, default=0.0, help="доля ошибок Google API")
+    parser.add_argument("--google-error-status", type=int, default=503,
+                        help="код ответа при ошибке Google (429 — превышение квоты)")
+    parser.add_argument("--private-folder", action="store_true",
+                        help="папка Drive не открыта для всех: доступ выдается каждому файлу")
+    parser.add_argument("--step-timeout", type=float, default=30, help="ожидание ответа бота, с")
+    parser.add_argument("--commit-timeout", type=float, default=120, help="ожидание записи в таблицу, с")
+    parser.add_argument("--verbose", action="store_true", help="логи бота")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Сравнение старой и новой обработки фото при 10 и 50 одновременных снимках
+
+Запуск: python bench_images.py [--width 4000 --height 3000] [--budgets 0 60 150]
+Вторая таблица — размер фото и время кодирования при разных настройках кодирования.
+Реальные Telegram и Google не нужны: фото генерируются локально.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from io import BytesIO
+
+import rsa
+from PIL import Image as PILImage
+
+
+def bench_env(token_uri="http://127.0.0.1:9/token"):
+    """Фиктивные переменные окружения, чтобы импортировать journal_bot офлайн"""
+    _, private_key = rsa.newkeys(1024)
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+    os.environ.setdefault("GOOGLE_SHEET_ID", "bench-sheet")
+    os.environ.setdefault("GOOGLE_DRIVE_FOLDER_ID", "bench-folder")
+    os.environ.setdefault("GOOGLE_CREDS_JSON", json.dumps({
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri
+    }))
+    os.environ.setdefault("OUTBOX_DB", os.path.join(tempfile.mkdtemp(), "bench.db"))
+    os.environ.setdefault("PHOTOS_DIR", tempfile.mkdtemp())
+
+
+def make_photo(width, height):
+    """Синтетический снимок с градиентом и шумом, как у фото с телефона"""
+    gradient = PILImage.linear_gradient("L").resize((width, height))
+    noise = PILImage.effect_noise((width, height), 40)
+    img = PILImage.merge("RGB", (gradient, noise, gradient.transpose(PILImage.FLIP_LEFT_RIGHT)))
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=92)
+    return buffer.getvalue()
+
+
+async def legacy_pipeline(jb, raw_bytes, photos_dir, index):
+    """Прежний путь: полное декодирование в цикле событий, файл на диске и чтение обратно"""
+    with PILImage.open(BytesIO(raw_bytes)) as img:
+        img.thumbnail((jb.MAX_IMAGE_WIDTH, jb.MAX_IMAGE_HEIGHT))
+        photo_path = os.path.join(photos_dir, f"legacy_{index}.jpg")
+        img.save(photo_path, "JPEG", quality=85)
+    with open(photo_path, "rb") as f:
+        return f.read()
+
+
+async def new_pipeline(jb, raw_bytes, photos_dir, index):
+    """Новый путь: пул процессов, draft-декодирование, буфер в памяти"""
+    return await jb.prepare_photo(raw_bytes)
+
+
+async def measure(pipeline, jb, raw_bytes, concurrency, photos_dir):
+    """Время обработки пачки фото и максимальная задержка цикла событий"""
+    max_lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal max_lag
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - start - 0.01)
+
+    tick_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        pipeline(jb, raw_bytes, photos_dir, i) for i in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    running = False
+    await tick_task
+
+    return elapsed, max_lag, sum(len(r) for r in results) / len(results)
+
+
+def encoding_table(jb, raw_bytes, budgets):
+    """Размер и время кодирования для бюджетов IMAGE_TARGET_BYTES, форматов и прогрессивного JPEG"""
+    print(f"{'формат':<12} {'бюджет, КБ':>10} {'качество':>9} {'цвет':>6} {'попыток':>8} "
+          f"{'кодирование, мс':>16} {'фото, КБ':>9}")
+    for image_format, progressive in (("jpeg", False), ("jpeg", True), ("webp", False)):
+        for budget in budgets:
+            _, info = jb.process_image(raw_bytes, image_format=image_format, target_bytes=budget * 1024,
+                                       progressive=progressive)
+            name = "jpeg-progr" if progressive else image_format
+            print(f"{name:<12} {budget or '—':>10} {info['quality']:>9} {info['subsampling']:>6} "
+                  f"{info['encodes']:>8} {info['seconds'] * 1000:>16.1f} {info['bytes'] / 1024:>9.0f}")
+
+
+async def run(args):
+    bench_env()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import journal_bot as jb
+
+    jb.warm_image_pool()
+    raw_bytes = make_photo(args.width, args.height)
+    photos_dir = tempfile.mkdtemp()
+    print(f"Исходное фото: {args.width}x{args.height}, {len(raw_bytes) / 1024:.0f} КБ, "
+          f"процессов: {jb.IMAGE_WORKERS}")
+    print(f"{'путь':<8} {'фото':>5} {'время, с':>9} {'фото/с':>8} {'лаг цикла, мс':>14} {'JPEG, КБ':>9}")
+
+    for concurrency in args.concurrency:
+        for name, pipeline in (("старый", legacy_pipeline), ("новый", new_pipeline)):
+            elapsed, max_lag, avg_size = await measure(pipeline, jb, raw_bytes, concurrency, photos_dir)
+            print(f"{name:<8} {concurrency:>5} {elapsed:>9.2f} {concurrency / elapsed:>8.1f} "
+                  f"{max_lag * 1000:>14.0f} {avg_size / 1024:>9.0f}")
+
+    print()
+    encoding_table(jb, raw_bytes, args.budgets)
+
+    jb.image_executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--budgets", type=int, nargs="+", default=[0, 60, 150],
+                        help="бюджеты размера фото в КБ (0 — фиксированное качество)")
+    asyncio.run(run(parser.parse_args()))
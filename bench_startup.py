@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Время холодного запуска бота: от старта процесса до ответа на первое обновление
+
+Бот запускается отдельным процессом (как на Railway) против локальных заглушек
+Bot API и Google из bench_bot.py. В очереди getUpdates заранее лежит /start,
+замеряется время до /health, до ответа бота и до выхода после SIGTERM.
+
+Запуск: python bench_startup.py --runs 5
+Сравнение с прошлой версией:
+    git show HEAD~1:journal_bot.py > /tmp/journal_bot_old.py
+    python bench_startup.py --script /tmp/journal_bot_old.py
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import statistics
+import tempfile
+
+import aiohttp
+
+from bench_bot import FakeTelegram, FakeGoogle, message_update
+from bench_images import bench_env, make_photo
+
+CHAT_ID = 4242
+
+
+def free_port():
+    """Свободный TCP-порт для веб-сервера бота"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_health(port, timeout):
+    """Дождаться ответа 200 на /health"""
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/health") as response:
+                    if response.status == 200:
+                        return time.perf_counter()
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.01)
+    raise asyncio.TimeoutError
+
+
+async def measure(args, telegram, env, run_index):
+    """Один холодный запуск; возвращает секунды до /health, до ответа на /start
+    и от SIGTERM до выхода процесса"""
+    telegram.updates.clear()
+    telegram.outgoing.clear()
+    telegram.push_update(message_update(run_index + 1, CHAT_ID, text='/start'))
+
+    port = free_port()
+    run_env = dict(
+        env,
+        PORT=str(port),
+        OUTBOX_DB=os.path.join(tempfile.mkdtemp(), "bench.db"),
+        PHOTOS_DIR=tempfile.mkdtemp()
+    )
+    log = open(os.path.join(tempfile.gettempdir(), f"bench_startup_{run_index}.log"), 'wb')
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, args.script, env=run_env, stdout=log, stderr=log
+    )
+    try:
+        health_task = asyncio.create_task(wait_health(port, args.timeout))
+        await telegram.expect(CHAT_ID, '', args.timeout)
+        first_reply = time.perf_counter() - started
+        health = await health_task
+    except BaseException:
+        process.kill()
+        await process.wait()
+        log.close()
+        raise
+
+    # Плавная остановка, как при перезапуске на Railway: процесс сам завершает пул фото
+    stopping = time.perf_counter()
+    process.terminate()
+    await process.wait()
+    log.close()
+    return health - started, first_reply, time.perf_counter() - stopping
+
+
+async def run(args):
+    # Бот останавливается посреди long polling, обрыв соединения ожидаем
+    logging.getLogger('aiohttp.server').setLevel(logging.CRITICAL)
+    telegram = FakeTelegram(args.telegram_latency / 1000, 0.0, make_photo(800, 600))
+    await telegram.start()
+    google = FakeGoogle(args.google_latency / 1000, 0.0, True, [])
+    await google.start()
+
+    bench_env(token_uri=f"{google.url}/token")
+    env = dict(
+        os.environ,
+        TELEGRAM_API_URL=f"{telegram.url}/bot",
+        TELEGRAM_FILE_URL=f"{telegram.url}/file/bot",
+        GOOGLE_ROOT_URL=google.url,
+        UPDATE_STATS_INTERVAL='0'
+    )
+
+    health, first_reply, stop = [], [], []
+    for run_index in range(args.runs):
+        health_time, reply_time, stop_time = await measure(args, telegram, env, run_index)
+        health.append(health_time)
+        first_reply.append(reply_time)
+        stop.append(stop_time)
+
+    await telegram.stop()
+    await google.stop()
+
+    print(f"Скрипт: {args.script}, запусков: {args.runs}, "
+          f"задержка Telegram/Google: {args.telegram_latency:.0f}/{args.google_latency:.0f} мс")
+    print(f"{'время от запуска, мс':<28} {'мин':>8} {'медиана':>8} {'макс':>8}")
+    for name, values in (("/health отвечает", health), ("ответ на первое обновление", first_reply),
+                         ("выход после SIGTERM", stop)):
+        print(f"{name:<28} {min(values) * 1000:>8.0f} "
+              f"{statistics.median(values) * 1000:>8.0f} {max(values) * 1000:>8.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="число запусков")
+    parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal_bot.py"),
+                        help="запускаемая версия бота")
+    parser.add_argument("--telegram-latency", type=float, default=20, help="задержка Bot API, мс")
+    parser.add_argument("--google-latency", type=float, default=150, help="задержка Google API, мс")
+    parser.add_argument("--timeout", type=float, default=60, help="ожидание ответа, с")
+    asyncio.run(run(parser.parse_args()))
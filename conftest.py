@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Настройка pytest: journal_bot импортируется офлайн, без Telegram и Google
+
+Переменные окружения задаются до импорта journal_bot; базы и фото — во временных
+каталогах. Фикстура storage подменяет очередь, кэш фото и индекс журнала
+новыми объектами на отдельной базе для каждого теста.
+"""
+
+import json
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_TOKEN", "0:test")
+os.environ.setdefault("GOOGLE_SHEET_ID", "test-sheet")
+os.environ.setdefault("GOOGLE_DRIVE_FOLDER_ID", "test-folder")
+os.environ.setdefault("GOOGLE_CREDS_JSON", json.dumps({
+    "type": "service_account",
+    "client_email": "test@test.iam.gserviceaccount.com",
+    "private_key": "test",
+    "token_uri": "http://127.0.0.1:9/token"
+}))
+os.environ.setdefault("OUTBOX_DB", os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ.setdefault("PHOTOS_DIR", tempfile.mkdtemp())
+
+# Ручной сценарий для живого бота (нужны токен и чат), не тест pytest
+collect_ignore = ["test_bot.py"]
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """Очередь outbox, кэш фото, индекс журнала и локальные фото теста"""
+    import journal_bot as jb
+
+    path = str(tmp_path / "journal.db")
+    photos_dir = tmp_path / "photos"
+    photos_dir.mkdir()
+    objects = {
+        "outbox": jb.Outbox(path),
+        "photo_cache": jb.PhotoCache(path, jb.PHOTO_CACHE_SIZE),
+        "journal_index": jb.JournalIndex(path),
+    }
+    for name, value in objects.items():
+        monkeypatch.setattr(jb, name, value)
+    monkeypatch.setattr(jb, "photo_store", jb.PhotoStore(str(photos_dir), jb.LOCAL_PHOTOS_MAX_BYTES,
+                                                         jb.LOCAL_PHOTOS_MAX_AGE))
+    yield jb
+    for value in objects.values():
+        value.close()
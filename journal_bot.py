@@ -3,25 +3,53 @@
 
 import os
 import sys
+import tempfile
 import logging
 import datetime
+import bisect
+import functools
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import itertools
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import threading
+import time
+import uuid
 from io import BytesIO
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, NamedTuple, Optional
+
+# Момент запуска процесса: от него считается время до первого обработанного обновления
+BOOT_STARTED = time.monotonic()
+
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    PersistenceInput,
     filters
 )
 from dotenv import load_dotenv
-from PIL import Image as PILImage
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+# Клиент Google API, PIL и openpyxl импортируются при первом использовании:
+# бот начинает принимать обновления, не дожидаясь их загрузки
+from google.auth.exceptions import TransportError
+from googleapiclient.errors import HttpError
 import json
+import pickle
 import asyncio
+import aiohttp
 from aiohttp import web
 
 # Настройка логирования
@@ -37,48 +65,133 @@ load_dotenv(override=True)
 # Настройка порта для Railway
 PORT = int(os.getenv('PORT', 8080))
 
-# Получение переменных окружения
+# Собственный сервер Bot API (необязательно)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+TELEGRAM_FILE_URL = os.getenv('TELEGRAM_FILE_URL')
+
+# Режим получения обновлений: webhook или polling
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Без заданного секрета он создается при каждом запуске: webhook все равно
+# регистрируется заново, а обновления без секрета отклоняются
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+# Получение переменных окружения (проверяются в validate_config при запуске)
 TOKEN = os.getenv("TELEGRAM_TOKEN")
-logger.info(f"TELEGRAM_TOKEN: {'présent' if TOKEN else 'absent'}")
-if not TOKEN:
-    logger.error("❌ ОШИБКА: Токен Telegram не найден")
-    logger.error("Проверьте переменные окружения в Railway")
-    sys.exit(1)
 
 # Настройки Google
 GOOGLE_SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 GOOGLE_DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
 SPREADSHEET_ID = os.getenv("GOOGLE_SHEET_ID")
+# Другой адрес Google API, например локальная заглушка для нагрузочного теста
+GOOGLE_ROOT_URL = os.getenv("GOOGLE_ROOT_URL")
+GOOGLE_SHEET_TAB = os.getenv("GOOGLE_SHEET_TAB", "")
 GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
-logger.info(f"GOOGLE_SHEET_ID: {'présent' if SPREADSHEET_ID else 'absent'}")
-logger.info(f"GOOGLE_DRIVE_FOLDER_ID: {'présent' if GOOGLE_DRIVE_FOLDER_ID else 'absent'}")
 
-# Получение учетных данных Google из переменной окружения
+# Учетные данные Google из переменной окружения
 GOOGLE_CREDS_JSON = os.getenv("GOOGLE_CREDS_JSON")
-logger.info(f"GOOGLE_CREDS_JSON: {'présent' if GOOGLE_CREDS_JSON else 'absent'}")
-if not GOOGLE_CREDS_JSON:
-    logger.error("❌ ОШИБКА: Учетные данные Google не найдены")
-    logger.error("Проверьте переменные окружения в Railway")
-    sys.exit(1)
-
-try:
-    creds_dict = json.loads(GOOGLE_CREDS_JSON)
-    creds = service_account.Credentials.from_service_account_info(
-        creds_dict,
-        scopes=GOOGLE_SHEETS_SCOPES + GOOGLE_DRIVE_SCOPES
-    )
-except Exception as e:
-    logger.error(f"❌ ОШИБКА при загрузке учетных данных Google: {e}")
-    sys.exit(1)
 
-if not SPREADSHEET_ID or not GOOGLE_DRIVE_FOLDER_ID:
-    logger.error("❌ ОШИБКА: ID таблицы или папки Drive не указаны")
-    sys.exit(1)
+# Параллельная обработка обновлений Telegram
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 16))
+UPDATE_QUEUE_LIMIT = int(os.getenv('UPDATE_QUEUE_LIMIT', 1024))
+UPDATE_STATS_INTERVAL = float(os.getenv('UPDATE_STATS_INTERVAL', 60))
+
+# Параллелизм запросов к Google API
+GOOGLE_IO_WORKERS = int(os.getenv('GOOGLE_IO_WORKERS', 8))
+GOOGLE_DRIVE_CONCURRENCY = int(os.getenv('GOOGLE_DRIVE_CONCURRENCY', 4))
+GOOGLE_SHEETS_CONCURRENCY = int(os.getenv('GOOGLE_SHEETS_CONCURRENCY', 2))
+GOOGLE_HTTP_TIMEOUT = int(os.getenv('GOOGLE_HTTP_TIMEOUT', 60))
+
+# Квоты Google API: запросов в секунду и запас для всплесков
+GOOGLE_DRIVE_RATE = float(os.getenv('GOOGLE_DRIVE_RATE', 10))
+GOOGLE_DRIVE_BURST = float(os.getenv('GOOGLE_DRIVE_BURST', 20))
+GOOGLE_SHEETS_RATE = float(os.getenv('GOOGLE_SHEETS_RATE', 1))
+GOOGLE_SHEETS_BURST = float(os.getenv('GOOGLE_SHEETS_BURST', 10))
+GOOGLE_RETRY_ATTEMPTS = int(os.getenv('GOOGLE_RETRY_ATTEMPTS', 4))
+GOOGLE_RETRY_BASE_DELAY = float(os.getenv('GOOGLE_RETRY_BASE_DELAY', 1))
+GOOGLE_RETRY_MAX_DELAY = float(os.getenv('GOOGLE_RETRY_MAX_DELAY', 32))
+
+# Публикация фото на Google Drive: auto, inherit или per_file
+DRIVE_PUBLIC_MODE = os.getenv('DRIVE_PUBLIC_MODE', 'auto').lower()
+DRIVE_PERMISSION_BATCH_SIZE = int(os.getenv('DRIVE_PERMISSION_BATCH_SIZE', 20))
+DRIVE_PERMISSION_BATCH_DELAY = float(os.getenv('DRIVE_PERMISSION_BATCH_DELAY', 0.5))
+DRIVE_RESUMABLE_THRESHOLD = int(os.getenv('DRIVE_RESUMABLE_THRESHOLD', 5 * 1024 * 1024))
+
+# Пакетная запись в Google Sheets
+SHEETS_BATCH_SIZE = int(os.getenv('SHEETS_BATCH_SIZE', 20))
+SHEETS_BATCH_MAX_DELAY = float(os.getenv('SHEETS_BATCH_MAX_DELAY', 2.0))
+
+# Локальная очередь записей (outbox)
+OUTBOX_DB = os.getenv('OUTBOX_DB', 'journal.db')
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 32))
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', 5))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', 600))
+PHOTO_CACHE_SIZE = int(os.getenv('PHOTO_CACHE_SIZE', 5000))
+# Записи незавершенной смены (пакетный ввод) выгружаются сами через столько секунд
+BATCH_MAX_AGE = float(os.getenv('BATCH_MAX_AGE', 12 * 3600))
+# Аренда записи процессом выгрузки: после сбоя процесса запись берет другой
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 300))
+# Как часто процесс-воркер проверяет общую очередь, в секундах
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 0.25))
+# После стольких неудачных попыток мастеру сообщается, что выгрузка задерживается
+OUTBOX_NOTIFY_ATTEMPTS = int(os.getenv('OUTBOX_NOTIFY_ATTEMPTS', 3))
+
+# Роль процесса: all — все в одном процессе; bot — только диалоги и очередь записей;
+# worker — обработка фото и выгрузка в Google из общей очереди (python journal_bot.py worker)
+BOT_ROLE = os.getenv('BOT_ROLE', 'all').lower()
+# Число процессов-воркеров, которые бот запускает сам (0 — выгрузка в процессе бота)
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 0))
+# Unix-сокет, на котором воркер, запущенный ботом, отдает боту свои метрики
+WORKER_METRICS_SOCKET = os.getenv('WORKER_METRICS_SOCKET')
+# Фото скачивают и обрабатывают воркеры, бот только ставит записи в очередь
+UPLOAD_IN_WORKERS = BOT_ROLE == 'bot' or UPLOAD_WORKERS > 0
+
+# Сверка локального индекса журнала с таблицей, в секундах (0 — отключить)
+JOURNAL_RECONCILE_INTERVAL = float(os.getenv('JOURNAL_RECONCILE_INTERVAL', 6 * 3600))
+
+# Выгрузка журнала в Excel (/export)
+EXCEL_FILE = os.getenv('EXCEL_FILE', 'журнал_выпечки.xlsx')
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', 1))
+
+# Кому доступны /report, /stats и /export: ID пользователей или чатов через запятую
+# (пусто — никому, журнал с именами мастеров и ссылками на фото не раздается).
+# Разбирается в validate_config(): ошибка в списке — выход с кодом 1, а не сбой импорта
+MANAGER_IDS = frozenset()
+
+# Сохранение состояния диалогов между перезапусками
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', 2))
+
+# Остановка по SIGTERM/SIGINT: сколько секунд дожидаться начатой работы — обработки
+# обновлений и выгрузки записей; незавершенные записи остаются в outbox до запуска
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 20))
 
 # Локальные настройки
-PHOTOS_DIR = "photos"
+PHOTOS_DIR = os.getenv('PHOTOS_DIR', 'photos')
 MAX_IMAGE_WIDTH = 800
 MAX_IMAGE_HEIGHT = 600
+# Кодирование фото: формат (jpeg или webp) и прогрессивный JPEG
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'jpeg').lower()
+IMAGE_PROGRESSIVE = bool(int(os.getenv('IMAGE_PROGRESSIVE', 0)))
+# Целевой размер фото в байтах (0 — всегда IMAGE_MAX_QUALITY) и границы качества:
+# качество снижается до IMAGE_MIN_QUALITY, даже если фото в бюджет не помещается
+IMAGE_TARGET_BYTES = int(os.getenv('IMAGE_TARGET_BYTES', 150 * 1024))
+IMAGE_MAX_QUALITY = int(os.getenv('IMAGE_MAX_QUALITY', 85))
+IMAGE_MIN_QUALITY = int(os.getenv('IMAGE_MIN_QUALITY', 60))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', os.cpu_count() or 1))
+
+# Локальные копии фото: лимит объема, срок хранения (дни) и период очистки
+LOCAL_PHOTOS_MAX_BYTES = int(os.getenv('LOCAL_PHOTOS_MAX_BYTES', 500 * 1024 * 1024))
+LOCAL_PHOTOS_MAX_AGE = float(os.getenv('LOCAL_PHOTOS_MAX_AGE_DAYS', 30)) * 86400
+LOCAL_PHOTOS_SWEEP_INTERVAL = float(os.getenv('LOCAL_PHOTOS_SWEEP_INTERVAL', 300))
+
+# Скачивание фото из Telegram
+TELEGRAM_DOWNLOAD_CONCURRENCY = int(os.getenv('TELEGRAM_DOWNLOAD_CONCURRENCY', 4))
+MAX_PHOTO_BYTES = int(os.getenv('MAX_PHOTO_BYTES', 10 * 1024 * 1024))
+
+# Альбомы: фото с одним media_group_id собираются в одну запись
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', 1.0))
+ALBUM_MAX_PHOTOS = 10
 
 # Список наименований продукции (полные названия)
 PRODUCT_NAMES = [
@@ -94,9 +207,6 @@ PRODUCT_NAMES = [
     "Сосиска в тесте"
 ]
 
-# Создание директории для фото
-os.makedirs(PHOTOS_DIR, exist_ok=True)
-
 # Заголовки столбцов
 COLUMN_HEADERS = [
     'Мастер',
@@ -104,482 +214,3379 @@ COLUMN_HEADERS = [
     'Смена',
     'Наименование',
     'Комментарий',
-    'Фото'
+    'Фото',
+    'ID записи',
+    'Ссылки на фото'
 ]
 
-def init_google_services():
-    """Инициализация сервисов Google"""
-    try:
-        sheets_service = build('sheets', 'v4', credentials=creds)
-        drive_service = build('drive', 'v3', credentials=creds)
-        return sheets_service, drive_service
-    except Exception as e:
-        logger.error(f"❌ ОШИБКА Google: {e}")
-        return None, None
+# Встроенные метрики в текстовом формате Prometheus (/metrics)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Границы корзин для размеров фото и записей, в байтах
+BYTES_BUCKETS = tuple(kb * 1024 for kb in (16, 32, 64, 128, 256, 512, 1024, 2048, 5120))
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv('EVENT_LOOP_LAG_INTERVAL', 0.5))
 
-async def upload_to_drive(file_path, drive_service):
-    """Загрузка файла на Google Drive"""
-    try:
-        file_metadata = {
-            'name': os.path.basename(file_path),
-            'parents': [GOOGLE_DRIVE_FOLDER_ID]
-        }
-        media = MediaFileUpload(file_path, mimetype='image/jpeg')
-        file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-        
-        # Открываем доступ
-        drive_service.permissions().create(
-            fileId=file['id'],
-            body={'type': 'anyone', 'role': 'reader'}
-        ).execute()
-        
-        return f"https://drive.google.com/uc?id={file['id']}"
-    except Exception as e:
-        logger.error(f"❌ ОШИБКА Drive: {e}")
-        return None
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
 
-async def save_to_sheets(sheets_service, data, image_url):
-    """Сохранение в Google Sheets"""
-    try:
-        # Проверка заголовков
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range="A1:F1"
-        ).execute()
-        
-        if 'values' not in result:
-            sheets_service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range="A1:F1",
-                valueInputOption='USER_ENTERED',
-                body={'values': [COLUMN_HEADERS]}
-            ).execute()
-
-        # Форматируем дату как строку в формате ДД.ММ.ГГГГ
-        date_str = data['date_obj'].strftime("%d.%m.%Y")
-        
-        values = [
-            [
-                data['Мастер'],
-                date_str,
-                data['смена'],
-                data['наименование'],
-                data.get('комментарий', ''),
-                f'=IMAGE("{image_url}")'
-            ]
-        ]
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
 
-        # Добавление данных
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range="A1:F1",
-            valueInputOption='USER_ENTERED',
-            insertDataOption='INSERT_ROWS',
-            body={'values': values}
-        ).execute()
-        
-        return True
-    except Exception as e:
-        logger.error(f"❌ ОШИБКА Sheets: {e}")
-        return False
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка команды /start"""
-    context.user_data.clear()
-    context.user_data['этап'] = 1
-    await update.message.reply_text(
-        "👨‍🍳 Введите ФИО Мастера:",
-        reply_markup=ReplyKeyboardRemove()
-    )
+class Metrics:
+    """Счетчики, гистограммы и вычисляемые показатели
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка текстовых сообщений"""
-    user_data = context.user_data
-    text = update.message.text.strip()
+    Запись — одно обращение к словарю и сложение, поэтому метрики можно
+    обновлять прямо в обработчиках. Ключ серии — имя и кортеж меток.
+    """
 
-    if user_data['этап'] == 1:
-        user_data['Мастер'] = text
-        user_data['этап'] = 2
-        
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data='date_today')],
-            [InlineKeyboardButton("Другая дата", callback_data='date_custom')],
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_master')]
-        ]
-        
-        await update.message.reply_text(
-            "📅 Выберите дату:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    
-    elif user_data['этап'] == 2:
-        if 'custom_date' in user_data and user_data['custom_date']:
+    def __init__(self):
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._gauges = {}
+
+    def describe(self, name, kind, text, buckets=None):
+        self._help[name] = (kind, text)
+        if buckets is not None:
+            self._buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self._buckets.get(name, METRICS_BUCKETS))
+        histogram.observe(value)
+
+    def gauge(self, name, collect):
+        """Показатель, который вычисляется при запросе: collect() → {метки: значение}"""
+        self._gauges[name] = collect
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Длительность блока в секундах"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def snapshot(self):
+        """Значения всех серий в виде JSON (метрики воркера для /metrics бота)"""
+        gauges = []
+        for name, collect in self._gauges.items():
             try:
-                date_obj = datetime.datetime.strptime(text, "%d.%m.%Y")
-                user_data['дата'] = text
-                user_data['date_obj'] = date_obj
-                del user_data['custom_date']
-                user_data['этап'] = 3
-                
-                keyboard = [
-                    [InlineKeyboardButton("День", callback_data='день'),
-                     InlineKeyboardButton("Ночь", callback_data='ночь')],
-                    [InlineKeyboardButton("◀️ Назад", callback_data='back_to_date')]
-                ]
-                
-                await update.message.reply_text(
-                    "🌞🌜 Выберите смену:",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            except ValueError:
-                await update.message.reply_text("❌ Неверный формат. Используйте ДД.ММ.ГГГГ")
+                values = collect()
+            except Exception as e:
+                logger.error(f"❌ ОШИБКА метрики {name}: {e}")
+                continue
+            gauges.extend([name, sorted(labels), value] for labels, value in values.items())
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+            'histograms': [
+                [name, list(labels), list(histogram.buckets), histogram.counts, histogram.sum]
+                for (name, labels), histogram in self._histograms.items()
+            ],
+            'gauges': gauges
+        }
+
+    def render(self, remote=()):
+        """Все метрики в текстовом формате Prometheus 0.0.4
+
+        remote: [(дополнительные метки, snapshot())] — метрики других процессов,
+        например воркеров выгрузки с меткой worker.
+        """
+        series = {}
+        for extra, snapshot in [((), self.snapshot()), *remote]:
+            for name, labels, value in snapshot['counters']:
+                series.setdefault(name, []).append(f"{name}{self._labels(labels, extra)} {value}")
+            for name, labels, buckets, counts, total in snapshot['histograms']:
+                lines = series.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(buckets, counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [*extra, ('le', bound)])} {cumulative}")
+                cumulative += counts[-1]
+                lines.append(f"{name}_bucket{self._labels(labels, [*extra, ('le', '+Inf')])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels, extra)} {total}")
+                lines.append(f"{name}_count{self._labels(labels, extra)} {cumulative}")
+            for name, labels, value in snapshot['gauges']:
+                series.setdefault(name, []).append(f"{name}{self._labels(labels, extra)} {value}")
+
+        output = []
+        for name, lines in series.items():
+            kind, text = self._help.get(name, ('untyped', name))
+            output.append(f"# HELP {name} {text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+metrics = Metrics()
+metrics.describe('journal_stage_seconds', 'histogram', 'Длительность этапов обработки записи')
+metrics.describe('journal_google_requests_total', 'counter', 'Запросы к Google API')
+metrics.describe('journal_google_errors_total', 'counter', 'Ошибки запросов к Google API')
+metrics.describe('journal_google_request_seconds', 'histogram', 'Длительность запросов к Google API')
+metrics.describe('journal_google_queue_seconds', 'histogram', 'Ожидание очереди квоты Google API')
+metrics.describe('journal_google_throttled_total', 'counter', 'Задержки запросов из-за квоты (rate) и пауз после 429 (backoff)')
+metrics.describe('journal_google_retries_total', 'counter', 'Повторы запросов к Google API')
+metrics.describe('journal_google_rate', 'gauge', 'Текущий лимит запросов в секунду к Google API')
+metrics.describe('journal_event_loop_lag_seconds', 'histogram', 'Задержка цикла событий')
+metrics.describe('journal_conversations', 'gauge', 'Активные диалоги по этапам')
+metrics.describe('journal_updates_waiting', 'gauge', 'Обновления Telegram в очереди обработки')
+
+async def monitor_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL):
+    """Фоновая оценка задержки цикла событий: насколько позже просыпается sleep"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = time.perf_counter() - started - interval
+        metrics.observe('journal_event_loop_lag_seconds', max(0.0, lag))
+        if lag > 1.0:
+            logger.warning(f"⚠️ Цикл событий заблокирован на {lag * 1000:.0f} мс")
+
+# Пул потоков для синхронного клиента googleapiclient
+google_executor = ThreadPoolExecutor(
+    max_workers=GOOGLE_IO_WORKERS,
+    thread_name_prefix='google-io'
+)
+# Приоритеты запросов к Google: записи, которых ждут мастера, идут раньше фоновой работы
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BACKGROUND: 'background'}
+google_priority = contextvars.ContextVar('google_priority', default=PRIORITY_INTERACTIVE)
+
+# Ответы, после которых запрос повторяется; 5xx — только для идемпотентных методов
+GOOGLE_RETRY_STATUSES = {429, 500, 502, 503, 504}
+GOOGLE_IDEMPOTENT_METHODS = {
+    'files.list', 'permissions.list', 'permissions.create', 'batch',
+    'values.get', 'values.update'
+}
+
+class GoogleApiScheduler:
+    """Очередь запросов к одному API Google с учетом квоты
+
+    Запрос запускается, когда есть свободный слот (concurrency), токен
+    в ведре (rate запросов/с, запас burst) и API не на паузе после 429.
+    Ожидающие упорядочены по приоритету, затем по времени прихода.
+    Скорость адаптивная: при 429 снижается вдвое, после успешных
+    запросов постепенно возвращается к rate.
+    """
+
+    def __init__(self, name, rate, burst, concurrency):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = burst
+        self.running = 0
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._timer = None
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _dispatch(self):
+        """Запустить ожидающих, насколько позволяют слоты, токены и пауза"""
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters and self.running < self.concurrency:
+            _, _, cost, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if now < self.paused_until:
+                self._schedule(self.paused_until - now, 'backoff')
                 return
-    
-    elif user_data['этап'] == 4:
-        if 'custom_name' in user_data and user_data['custom_name']:
-            user_data['наименование'] = text
-            del user_data['custom_name']
-            user_data['этап'] = 5
-            
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад", callback_data='back_to_product')]
-            ]
-            
-            await update.message.reply_text(
-                "💬 Введите комментарий:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-    
-    elif user_data['этап'] == 5:
-        user_data['комментарий'] = text
-        user_data['этап'] = 6
-        
-        keyboard = [
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_comment')]
-        ]
-        
-        await update.message.reply_text(
-            "📸 Отправьте фото готовой продукции:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            if self.tokens < min(cost, self.burst):
+                self._schedule((min(cost, self.burst) - self.tokens) / self.rate, 'rate')
+                return
+            heapq.heappop(self._waiters)
+            self.tokens -= cost
+            self.running += 1
+            future.set_result(None)
+
+    def _schedule(self, delay, reason):
+        if self._timer is None:
+            metrics.inc('journal_google_throttled_total', api=self.name, reason=reason)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    async def acquire(self, priority, cost=1):
+        """Дождаться своей очереди; cost — число запросов в пакете"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), cost, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def throttled(self, delay):
+        """Ответ 429: пауза для всех запросов API и снижение скорости"""
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        logger.warning(
+            f"⚠️ Квота Google ({self.name}): пауза {delay:.1f} с, "
+            f"скорость {self.rate:.2f} запросов/с"
         )
 
-async def handle_date_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка выбора даты"""
-    query = update.callback_query
-    await query.answer()
+    def succeeded(self):
+        # Аддитивное восстановление скорости после снижения
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
 
-    user_data = context.user_data
-    
-    if query.data == 'date_today':
-        today = datetime.datetime.now()
-        user_data['дата'] = today.strftime("%d.%m.%Y")
-        user_data['date_obj'] = today
-        user_data['этап'] = 3
-        
-        keyboard = [
-            [InlineKeyboardButton("День", callback_data='день'),
-             InlineKeyboardButton("Ночь", callback_data='ночь')],
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_date')]
-        ]
-        
-        await query.edit_message_text(text=f"Дата: {user_data['дата']}")
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="🌞🌜 Выберите смену:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+google_schedulers = {
+    'drive': GoogleApiScheduler('drive', GOOGLE_DRIVE_RATE, GOOGLE_DRIVE_BURST, GOOGLE_DRIVE_CONCURRENCY),
+    'sheets': GoogleApiScheduler('sheets', GOOGLE_SHEETS_RATE, GOOGLE_SHEETS_BURST, GOOGLE_SHEETS_CONCURRENCY)
+}
+metrics.gauge(
+    'journal_google_rate',
+    lambda: {(('api', name),): scheduler.rate for name, scheduler in google_schedulers.items()}
+)
+
+def google_retry_delay(error, attempt):
+    """Задержка перед повтором: Retry-After или экспонента со случайным разбросом (full jitter)"""
+    retry_after = error.resp.get('retry-after') if isinstance(error, HttpError) else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, min(GOOGLE_RETRY_MAX_DELAY, GOOGLE_RETRY_BASE_DELAY * 2 ** attempt))
+
+async def google_execute(api, method, make_request, cost=1):
+    """Выполнение запроса Google API в пуле потоков, не блокируя цикл событий
+
+    Запрос проходит через планировщик квоты API; при 429 (и 5xx для
+    идемпотентных методов) повторяется до GOOGLE_RETRY_ATTEMPTS раз.
+    Приоритет берется из google_priority.
+    """
+    scheduler = google_schedulers[api]
+    priority = google_priority.get()
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        queued = time.perf_counter()
+        await scheduler.acquire(priority, cost)
+        metrics.observe(
+            'journal_google_queue_seconds',
+            time.perf_counter() - queued,
+            api=api, priority=PRIORITY_NAMES[priority]
         )
-    elif query.data == 'date_custom':
-        user_data['custom_date'] = True
-        
-        keyboard = [
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_master')]
-        ]
-        
-        await query.edit_message_text(
-            text="✏️ Введите дату в формате ДД.ММ.ГГГГ:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        metrics.inc('journal_google_requests_total', api=api, method=method)
+        started = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(
+                google_executor,
+                _execute_google_request,
+                make_request
+            )
+            scheduler.succeeded()
+            return result
+        except Exception as e:
+            status = e.resp.status if isinstance(e, HttpError) else type(e).__name__
+            metrics.inc('journal_google_errors_total', api=api, method=method, status=status)
+            if is_transport_error(e):
+                mark_google_transport_failure(api, e)
+            retryable = status == 429 or (status in GOOGLE_RETRY_STATUSES and method in GOOGLE_IDEMPOTENT_METHODS)
+            if not retryable or attempt >= GOOGLE_RETRY_ATTEMPTS:
+                raise
+            delay = google_retry_delay(e, attempt)
+            if status == 429:
+                scheduler.throttled(delay)
+            metrics.inc('journal_google_retries_total', api=api, method=method, status=status)
+            error = e
+        finally:
+            scheduler.release()
+            metrics.observe(
+                'journal_google_request_seconds',
+                time.perf_counter() - started,
+                api=api, method=method
+            )
+        attempt += 1
+        logger.warning(
+            f"⚠️ Google ({api} {method}): ответ {error.resp.status}, "
+            f"повтор {attempt} через {delay:.1f} с"
         )
+        await asyncio.sleep(delay)
 
-async def handle_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка выбора смены"""
-    query = update.callback_query
-    await query.answer()
+async def drive_create_file(drive_service, body, media_body, fields='id'):
+    """Создание файла на Drive (files().create)"""
+    return await google_execute('drive', 'files.create', lambda: drive_service.files().create(
+        body=body,
+        media_body=media_body,
+        fields=fields
+    ))
 
-    user_data = context.user_data
-    user_data['смена'] = 'День' if query.data == 'день' else 'Ночь'
-    user_data['этап'] = 4
-
-    await query.edit_message_text(text=f"Смена: {user_data['смена']}")
-    
-    keyboard = []
-    for idx, name in enumerate(PRODUCT_NAMES):
-        keyboard.append([InlineKeyboardButton(name, callback_data=f"name_{idx}")])
-    
-    keyboard.append([InlineKeyboardButton("✏️ Ввести свое наименование", callback_data="custom_name")])
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data='back_to_shift')])
-    
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="🏷 Выберите наименование продукта:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+async def drive_find_file(drive_service, name):
+    """Поиск файла в папке по имени (files().list)"""
+    result = await google_execute('drive', 'files.list', lambda: drive_service.files().list(
+        q=f"name = '{name}' and '{GOOGLE_DRIVE_FOLDER_ID}' in parents and trashed = false",
+        fields='files(id)',
+        pageSize=1
+    ))
+    files = result.get('files', [])
+    return files[0]['id'] if files else None
 
-async def handle_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка выбора наименования"""
-    query = update.callback_query
-    await query.answer()
+async def drive_create_permission(drive_service, file_id, body):
+    """Выдача доступа к файлу Drive (permissions().create)"""
+    return await google_execute('drive', 'permissions.create', lambda: drive_service.permissions().create(
+        fileId=file_id,
+        body=body
+    ))
 
-    user_data = context.user_data
-    
-    if query.data == "custom_name":
-        user_data['custom_name'] = True
-        
-        keyboard = [
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_product')]
-        ]
-        
-        await query.edit_message_text(
-            text="✏️ Введите свое наименование:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-    
-    idx = int(query.data.split("_")[1])
-    user_data['наименование'] = PRODUCT_NAMES[idx]
-    user_data['этап'] = 5
-    
-    keyboard = [
-        [InlineKeyboardButton("◀️ Назад", callback_data='back_to_product')]
-    ]
-    
-    await query.edit_message_text(text=f"Наименование: {user_data['наименование']}")
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="💬 Введите комментарий:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+async def sheets_get_values(sheets_service, range_name, value_render_option='FORMATTED_VALUE'):
+    """Чтение диапазона таблицы (values().get)"""
+    return await google_execute('sheets', 'values.get', lambda: sheets_service.spreadsheets().values().get(
+        spreadsheetId=SPREADSHEET_ID,
+        range=range_name,
+        valueRenderOption=value_render_option,
+        dateTimeRenderOption='FORMATTED_STRING'
+    ))
 
-async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка кнопки назад"""
-    query = update.callback_query
-    await query.answer()
+async def sheets_update_values(sheets_service, range_name, values):
+    """Перезапись диапазона таблицы (values().update)"""
+    return await google_execute('sheets', 'values.update', lambda: sheets_service.spreadsheets().values().update(
+        spreadsheetId=SPREADSHEET_ID,
+        range=range_name,
+        valueInputOption='USER_ENTERED',
+        body={'values': values}
+    ))
 
-    user_data = context.user_data
-    back_to = query.data
-
-    if back_to == 'back_to_master':
-        user_data['этап'] = 1
-        await query.edit_message_text(text="👨‍🍳 Введите ФИО Мастера:")
-    
-    elif back_to == 'back_to_date':
-        user_data['этап'] = 2
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data='date_today')],
-            [InlineKeyboardButton("Другая дата", callback_data='date_custom')],
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_master')]
-        ]
-        await query.edit_message_text(
-            text="📅 Выберите дату:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    
-    elif back_to == 'back_to_shift':
-        user_data['этап'] = 3
-        keyboard = [
-            [InlineKeyboardButton("День", callback_data='день'),
-             InlineKeyboardButton("Ночь", callback_data='ночь')],
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_date')]
-        ]
-        await query.edit_message_text(
-            text="🌞🌜 Выберите смену:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    
-    elif back_to == 'back_to_product':
-        user_data['этап'] = 4
-        keyboard = []
-        for idx, name in enumerate(PRODUCT_NAMES):
-            keyboard.append([InlineKeyboardButton(name, callback_data=f"name_{idx}")])
-        keyboard.append([InlineKeyboardButton("✏️ Ввести свое наименование", callback_data="custom_name")])
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data='back_to_shift')])
-        await query.edit_message_text(
-            text="🏷 Выберите наименование продукта:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    
-    elif back_to == 'back_to_comment':
-        user_data['этап'] = 5
-        keyboard = [
-            [InlineKeyboardButton("◀️ Назад", callback_data='back_to_product')]
-        ]
-        await query.edit_message_text(
-            text="💬 Введите комментарий:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+async def sheets_append_values(sheets_service, range_name, values):
+    """Добавление строк в таблицу (values().append)"""
+    return await google_execute('sheets', 'values.append', lambda: sheets_service.spreadsheets().values().append(
+        spreadsheetId=SPREADSHEET_ID,
+        range=range_name,
+        valueInputOption='USER_ENTERED',
+        insertDataOption='INSERT_ROWS',
+        body={'values': values}
+    ))
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка фото"""
-    user_data = context.user_data
-    if user_data.get('этап') != 6:
-        await update.message.reply_text("❌ Начните с команды /start")
-        return
+GOOGLE_API_VERSIONS = {
+    'sheets': 'v4',
+    'drive': 'v3'
+}
 
-    try:
-        # Скачивание фото
-        photo_file = await update.message.photo[-1].get_file()
-        img_data = BytesIO()
-        await photo_file.download_to_memory(out=img_data)
-        img_data.seek(0)
-
-        # Обработка изображения
-        with PILImage.open(img_data) as img:
-            img.thumbnail((MAX_IMAGE_WIDTH, MAX_IMAGE_HEIGHT))
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            photo_path = os.path.join(PHOTOS_DIR, f"{timestamp}.jpg")
-            img.save(photo_path, "JPEG", quality=85)
-
-        # Сохранение
-        sheets_ok = False
-        image_url = None
-        
-        sheets_service, drive_service = init_google_services()
-        if sheets_service and drive_service:
-            image_url = await upload_to_drive(photo_path, drive_service)
-            if image_url:
-                sheets_ok = await save_to_sheets(sheets_service, user_data, image_url)
-
-        # Формирование ответа
-        if sheets_ok:
-            msg = (
-                "✅ Данные сохранены!\n"
-                f"📅 Дата: {user_data['дата']}\n"
-                f"👨‍🍳 Мастер: {user_data['Мастер']}\n"
-                f"🌃 Смена: {user_data['смена']}\n"
-                f"🏷 Наименование: {user_data['наименование']}\n"
-                f"💬 Комментарий: {user_data.get('комментарий', 'нет')}\n\n"
-                "Добавить новую запись?"
+def is_transport_error(error):
+    """Ошибка транспорта, после которой клиент пересоздается"""
+    import httplib2
+    return isinstance(error, (httplib2.HttpLib2Error, TransportError, OSError))
+
+# Общие долгоживущие клиенты Google
+google_services = {}
+_google_stale = set(GOOGLE_API_VERSIONS)
+_google_creds_lock = threading.Lock()
+_google_init_lock = threading.Lock()
+_google_http = threading.local()
+_google_http_generation = 0
+creds = None
+
+def google_credentials():
+    """Учетные данные сервисного аккаунта (создаются при первом обращении)"""
+    global creds
+    with _google_creds_lock:
+        if creds is None:
+            from google.oauth2 import service_account
+            creds = service_account.Credentials.from_service_account_info(
+                json.loads(GOOGLE_CREDS_JSON),
+                scopes=GOOGLE_SHEETS_SCOPES + GOOGLE_DRIVE_SCOPES
             )
-        else:
-            msg = "❌ Ошибка сохранения\nПопробовать снова?"
+    return creds
 
-        # Réinitialisation de l'état de l'utilisateur
-        user_data.clear()
-        user_data['этап'] = 1
+def refresh_google_credentials():
+    """Централизованное обновление токена доступа Google"""
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    credentials = google_credentials()
+    with _google_creds_lock:
+        if not credentials.valid:
+            credentials.refresh(GoogleAuthRequest())
 
-        await update.message.reply_text(
-            msg,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("➕ Новая запись", callback_data='новая')]
-            ])
+def _thread_http():
+    """HTTP-транспорт с keep-alive, отдельный для каждого потока пула"""
+    if getattr(_google_http, 'generation', None) != _google_http_generation:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        _google_http.http = AuthorizedHttp(
+            google_credentials(),
+            http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
         )
+        _google_http.generation = _google_http_generation
+    return _google_http.http
+
+def _execute_google_request(make_request):
+    """Выполнение запроса в потоке пула"""
+    refresh_google_credentials()
+    return make_request().execute(http=_thread_http())
 
+def mark_google_transport_failure(api, error):
+    """Пометить клиент для пересоздания после сбоя транспорта"""
+    global _google_http_generation
+    logger.warning(f"⚠️ Сбой транспорта Google ({api}): {error}")
+    _google_stale.add(api)
+    _google_http_generation += 1
+
+def init_google_services():
+    """Инициализация сервисов Google (из локального кэша discovery-документов)"""
+    try:
+        from googleapiclient.discovery import build, build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        credentials = google_credentials()
+        for api in list(_google_stale):
+            if GOOGLE_ROOT_URL:
+                # Все адреса (API, загрузка, batch) берутся из rootUrl документа
+                document = json.loads(get_static_doc(api, GOOGLE_API_VERSIONS[api]))
+                document['rootUrl'] = GOOGLE_ROOT_URL.rstrip('/') + '/'
+                google_services[api] = build_from_document(document, credentials=credentials)
+            else:
+                google_services[api] = build(
+                    api,
+                    GOOGLE_API_VERSIONS[api],
+                    credentials=credentials,
+                    static_discovery=True,
+                    cache_discovery=False
+                )
+            _google_stale.discard(api)
+        return google_services['sheets'], google_services['drive']
     except Exception as e:
-        logger.error(f"❌ ОШИБКА фото: {e}")
-        await update.message.reply_text(
-            "❌ Ошибка. Попробуйте снова.\n"
-            "Начните с /start"
-        )
+        logger.error(f"❌ ОШИБКА Google: {e}")
+        return None, None
 
-async def handle_new(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Новая запись"""
-    query = update.callback_query
-    await query.answer()
-    
-    # Réinitialisation des données utilisateur
-    context.user_data.clear()
-    context.user_data['этап'] = 1
-    
-    # Envoi du message de démarrage
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="👨‍🍳 Введите ФИО Мастера:",
-        reply_markup=ReplyKeyboardRemove()
+def google_health():
+    """Проверка состояния клиентов Google: пересоздает только сломанные"""
+    with _google_init_lock:
+        if _google_stale:
+            init_google_services()
+    return not _google_stale
+
+async def google_ready():
+    """google_health() для цикла событий: пересоздание клиентов (разбор discovery-документа)
+    выполняется в потоке, чтобы не останавливать обработку чатов"""
+    if not _google_stale:
+        return True
+    return await asyncio.to_thread(google_health)
+
+def process_image(raw_bytes, max_size=(MAX_IMAGE_WIDTH, MAX_IMAGE_HEIGHT), image_format=IMAGE_FORMAT,
+                  target_bytes=IMAGE_TARGET_BYTES, min_quality=IMAGE_MIN_QUALITY,
+                  max_quality=IMAGE_MAX_QUALITY, progressive=IMAGE_PROGRESSIVE):
+    """Уменьшение фото и кодирование под целевой размер (выполняется в пуле процессов)
+
+    Возвращает байты и сведения о кодировании: формат, качество, субдискретизацию
+    цвета, размер, число попыток кодирования и время кодирования в секундах.
+    """
+    from PIL import Image as PILImage, ImageOps
+    with PILImage.open(BytesIO(raw_bytes)) as img:
+        # JPEG декодируется сразу в уменьшенном масштабе (DCT scaling)
+        if img.format == 'JPEG':
+            img.draft('RGB', max_size)
+        # Поворот из тега Orientation применяется к пикселям, сам EXIF в результат не попадает
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(max_size)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+    started = time.perf_counter()
+    encodes = 0
+
+    def encode(quality, subsampling):
+        nonlocal encodes
+        encodes += 1
+        buffer = BytesIO()
+        if image_format == 'webp':
+            img.save(buffer, 'WEBP', quality=quality, method=4)
+        else:
+            img.save(buffer, 'JPEG', quality=quality, subsampling=subsampling, progressive=progressive)
+        return buffer.getvalue()
+
+    # Субдискретизация: 2 — 4:2:0, 0 — 4:4:4 (WebP всегда кодирует цвет как 4:2:0)
+    quality, subsampling = max_quality, 2
+    photo_bytes = encode(quality, subsampling)
+    if target_bytes and len(photo_bytes) <= target_bytes:
+        # Запас по размеру тратится на полное разрешение цвета
+        if image_format != 'webp':
+            full_color = encode(quality, 0)
+            if len(full_color) <= target_bytes:
+                photo_bytes, subsampling = full_color, 0
+    elif target_bytes:
+        # Наибольшее качество, при котором фото помещается в бюджет; ниже границы не опускаемся
+        floor_bytes = encode(min_quality, subsampling)
+        low, high = min_quality, max_quality
+        best = (min_quality, floor_bytes)
+        if len(floor_bytes) <= target_bytes:
+            while high - low > 2:
+                middle = (low + high) // 2
+                candidate = encode(middle, subsampling)
+                if len(candidate) <= target_bytes:
+                    low, best = middle, (middle, candidate)
+                else:
+                    high = middle
+        quality, photo_bytes = best
+
+    return photo_bytes, {
+        'format': image_format,
+        'quality': quality,
+        'subsampling': '4:4:4' if subsampling == 0 else '4:2:0',
+        'bytes': len(photo_bytes),
+        'over_budget': bool(target_bytes) and len(photo_bytes) > target_bytes,
+        'encodes': encodes,
+        'seconds': time.perf_counter() - started
+    }
+
+# Пул процессов для обработки изображений
+image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+
+def _warm_image_worker():
+    from PIL import Image as PILImage
+    return os.getpid()
+
+def warm_image_pool():
+    """Запуск процессов пула и импорт PIL в них заранее"""
+    for future in [image_executor.submit(_warm_image_worker) for _ in range(IMAGE_WORKERS)]:
+        future.result()
+
+metrics.describe('journal_photo_bytes', 'histogram', 'Размер фото, готового к выгрузке', BYTES_BUCKETS)
+metrics.describe('journal_photo_encodes_total', 'counter', 'Попытки кодирования фото при подборе качества')
+metrics.describe('journal_photo_over_budget_total', 'counter', 'Фото больше IMAGE_TARGET_BYTES на минимальном качестве')
+metrics.describe('journal_entry_upload_bytes', 'histogram', 'Байты фото, выгруженные в Drive за запись', BYTES_BUCKETS)
+
+async def prepare_photo(raw_bytes):
+    """Обработка фото вне цикла событий"""
+    loop = asyncio.get_running_loop()
+    photo_bytes, encoding = await loop.run_in_executor(image_executor, process_image, raw_bytes)
+    metrics.observe('journal_stage_seconds', encoding['seconds'], stage='encode')
+    metrics.inc('journal_photo_encodes_total', encoding['encodes'], format=encoding['format'])
+    if encoding['over_budget']:
+        metrics.inc('journal_photo_over_budget_total')
+    return photo_bytes
+
+def keep_original(raw_bytes, fits):
+    """Фото от Telegram выгружается как есть: размер, формат и объем уже подходят.
+    Telegram сам поворачивает сжатые фото и удаляет из них EXIF"""
+    return (
+        fits and IMAGE_FORMAT == 'jpeg' and not IMAGE_PROGRESSIVE
+        and (not IMAGE_TARGET_BYTES or len(raw_bytes) <= IMAGE_TARGET_BYTES)
     )
 
-async def health_check(request):
-    """Endpoint de vérification de santé pour Railway"""
-    return web.Response(text="OK")
+async def encode_photo(raw_bytes, fits):
+    """Фото, готовое к выгрузке: оригинал, если он подходит, иначе перекодированное"""
+    if keep_original(raw_bytes, fits):
+        photo_bytes = raw_bytes
+    else:
+        with metrics.timer('journal_stage_seconds', stage='resize'):
+            photo_bytes = await prepare_photo(raw_bytes)
+    metrics.observe('journal_photo_bytes', len(photo_bytes))
+    return photo_bytes
 
-async def main():
-    """Fonction principale de démarrage du bot"""
-    # Vérification des variables d'environnement
-    logger.info("Vérification des variables d'environnement...")
-    if not TOKEN:
-        logger.error("❌ TELEGRAM_TOKEN manquant")
-        return
-    if not GOOGLE_CREDS_JSON:
-        logger.error("❌ GOOGLE_CREDS_JSON manquant")
-        return
-    if not SPREADSHEET_ID:
-        logger.error("❌ GOOGLE_SHEET_ID manquant")
-        return
-    if not GOOGLE_DRIVE_FOLDER_ID:
-        logger.error("❌ GOOGLE_DRIVE_FOLDER_ID manquant")
-        return
+def photo_mimetype(photo_bytes):
+    """MIME-тип фото по сигнатуре файла"""
+    if photo_bytes[:4] == b'RIFF' and photo_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
 
-    logger.info("✅ Variables d'environnement OK")
-    logger.info("Initialisation de l'application...")
+PHOTO_EXTENSION = 'webp' if IMAGE_FORMAT == 'webp' else 'jpg'
 
-    # Initialisation de l'application
-    application = Application.builder().token(TOKEN).build()
-    
-    # Ajout des gestionnaires
-    logger.info("Configuration des gestionnaires...")
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("new", handle_new))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(CallbackQueryHandler(handle_date_choice, pattern="^date_"))
-    application.add_handler(CallbackQueryHandler(handle_shift, pattern="^день|ночь$"))
-    application.add_handler(CallbackQueryHandler(handle_product_name, pattern="^name_|custom_name$"))
-    application.add_handler(CallbackQueryHandler(handle_new, pattern="^новая$"))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(CallbackQueryHandler(handle_back, pattern="^back_"))
-    
-    logger.info("✅ Configuration terminée")
-    logger.info("Démarrage du bot...")
+def photo_file_name(entry_id, position=0):
+    """Имя файла фото записи (локально и на Drive); position — номер фото в альбоме"""
+    if position == 0:
+        return f"{entry_id}.{PHOTO_EXTENSION}"
+    return f"{entry_id}_{position}.{PHOTO_EXTENSION}"
 
-    try:
-        # Démarrage du polling avec gestion des erreurs
-        await application.initialize()
-        await application.start()
-        
-        # Configuration du polling
-        await application.updater.start_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
+def photo_entry_id(name):
+    """ID записи по имени файла фото"""
+    return name.split('.', 1)[0].split('_', 1)[0]
+
+class PhotoStore:
+    """Локальные копии фото в PHOTOS_DIR с ограничением по объему и возрасту
+
+    Файл называется по ID записи (и номеру фото в альбоме) и пишется атомарно (временный файл +
+    os.replace), поэтому одновременные фото не перезаписывают друг друга.
+    Удаляются только копии, уже выгруженные на Drive: сначала старше
+    max_age, затем самые давние, пока объем не уложится в max_bytes.
+    """
+
+    def __init__(self, path, max_bytes, max_age):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Имя файла → (размер, время записи), от старых к новым
+        self._files = OrderedDict()
+        self._pending = set()
+        self.total_bytes = 0
+        self._wakeup = None
+
+    def _scan(self):
+        files = []
+        stale_before = time.time() - 60
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                # Недописанный файл после сбоя (свежие могут дописываться прямо сейчас)
+                if entry.name.endswith('.tmp'):
+                    if stat.st_mtime < stale_before:
+                        os.unlink(entry.path)
+                    continue
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+        return files
+
+    async def load(self, pending_ids):
+        """Построить индекс по содержимому каталога
+
+        pending_ids: ID записей, еще не выгруженных в Google; их фото не удаляются.
+        """
+        started = time.perf_counter()
+        files = await asyncio.to_thread(self._scan)
+        # Фото, сохраненные во время сканирования, уже есть в индексе и остаются в нем
+        saved = self._files
+        self._files = OrderedDict(
+            (name, (size, mtime)) for mtime, name, size in files if name not in saved
         )
-        
-        # Boucle principale
+        self._files.update(saved)
+        self.total_bytes = sum(size for size, _ in self._files.values())
+        pending_ids = set(pending_ids)
+        self._pending |= {name for name in self._files if photo_entry_id(name) in pending_ids}
+        logger.info(
+            f"✅ Локальные фото: {len(self._files)} файлов, {self.total_bytes // (1024 * 1024)} МБ, "
+            f"индекс за {(time.perf_counter() - started) * 1000:.0f} мс"
+        )
+
+    async def refresh(self, pending_ids):
+        """Перестроить индекс и список невыгруженных заново
+
+        Для процесса бота, когда фото сохраняют и выгружают воркеры.
+        """
+        files = await asyncio.to_thread(self._scan)
+        pending_ids = set(pending_ids)
+        self._files = OrderedDict((name, (size, mtime)) for mtime, name, size in files)
+        self.total_bytes = sum(size for size, _ in self._files.values())
+        self._pending = {name for name in self._files if photo_entry_id(name) in pending_ids}
+
+    def _write(self, name, photo_bytes):
+        photo_path = os.path.join(self.path, name)
+        tmp_path = f"{photo_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(photo_bytes)
+        os.replace(tmp_path, photo_path)
+        return photo_path
+
+    async def save(self, entry_id, photo_bytes, position=0):
+        """Сохранить копию фото записи entry_id до ее выгрузки в Drive"""
+        name = photo_file_name(entry_id, position)
+        photo_path = await asyncio.to_thread(self._write, name, photo_bytes)
+        previous = self._files.pop(name, None)
+        if previous is not None:
+            self.total_bytes -= previous[0]
+        self._files[name] = (len(photo_bytes), time.time())
+        self._pending.add(name)
+        self.total_bytes += len(photo_bytes)
+        return photo_path
+
+    def confirm(self, entry_id):
+        """Фото записи выгружены в Drive: локальные копии можно удалять"""
+        self._pending = {name for name in self._pending if photo_entry_id(name) != entry_id}
+        if self.total_bytes > self.max_bytes and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _victims(self):
+        """Файлы на удаление: выгруженные, старше max_age или сверх объема"""
+        victims = []
+        excess = self.total_bytes - self.max_bytes
+        oldest_allowed = time.time() - self.max_age if self.max_age > 0 else 0
+        for name, (size, mtime) in self._files.items():
+            if name in self._pending:
+                continue
+            if excess <= 0 and mtime >= oldest_allowed:
+                break
+            victims.append(name)
+            excess -= size
+        return victims
+
+    def _unlink(self, names):
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    async def sweep(self):
+        """Удалить лишние выгруженные копии; возвращает число удаленных файлов"""
+        victims = self._victims()
+        if not victims:
+            return 0
+        freed = 0
+        for name in victims:
+            size, _ = self._files.pop(name)
+            freed += size
+        self.total_bytes -= freed
+        await asyncio.to_thread(self._unlink, victims)
+        logger.info(f"🧹 Локальные фото: удалено {len(victims)} файлов, {freed // 1024} КБ")
+        if self.total_bytes > self.max_bytes:
+            logger.warning(
+                f"⚠️ Локальные фото занимают {self.total_bytes // 1024} КБ при лимите "
+                f"{self.max_bytes // 1024} КБ: {len(self._pending)} еще не выгружены в Drive"
+            )
+        return len(victims)
+
+    async def sweeper(self, interval, pending_ids=None):
+        """Фоновая очистка: по таймеру и при превышении объема
+
+        pending_ids: корутина со списком невыгруженных записей; если задана,
+        индекс перед каждой очисткой строится заново (фото пишут воркеры).
+        """
+        self._wakeup = asyncio.Event()
         while True:
             try:
-                await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                break
-            
+                if pending_ids is not None:
+                    await self.refresh(await pending_ids())
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"❌ ОШИБКА очистки локальных фото: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+photo_store = PhotoStore(PHOTOS_DIR, LOCAL_PHOTOS_MAX_BYTES, LOCAL_PHOTOS_MAX_AGE)
+metrics.describe('journal_local_photos_bytes', 'gauge', 'Объем локальных копий фото')
+metrics.gauge('journal_local_photos_bytes', lambda: {(): photo_store.total_bytes})
+
+class PhotoTooLargeError(Exception):
+    """Фото больше MAX_PHOTO_BYTES"""
+
+class TelegramDownloadError(Exception):
+    """Ошибка скачивания файла Telegram; в сообщении нет URL файла (в нем токен бота)"""
+
+download_limit = asyncio.Semaphore(TELEGRAM_DOWNLOAD_CONCURRENCY)
+_http_session = None
+
+def http_session():
+    """Общая HTTP-сессия с keep-alive для скачивания файлов"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=60)
+        )
+    return _http_session
+
+def photo_fits(photo_size):
+    """Фото уже не больше MAX_IMAGE_WIDTH×MAX_IMAGE_HEIGHT"""
+    return photo_size.width <= MAX_IMAGE_WIDTH and photo_size.height <= MAX_IMAGE_HEIGHT
+
+def pick_photo_size(photo_sizes):
+    """Самый маленький PhotoSize, после уменьшения которого фото будет таким же, как из оригинала"""
+    ordered = sorted(photo_sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if size.width >= MAX_IMAGE_WIDTH or size.height >= MAX_IMAGE_HEIGHT:
+            return size
+    return ordered[-1]
+
+def check_photo_size(photo_size):
+    """Размер фото по данным Telegram не больше MAX_PHOTO_BYTES"""
+    if photo_size.file_size and photo_size.file_size > MAX_PHOTO_BYTES:
+        raise PhotoTooLargeError(f"{photo_size.file_size} байт")
+
+async def download_photo(photo_size):
+    """Потоковое скачивание фото с ограничением размера"""
+    check_photo_size(photo_size)
+    return await download_file(photo_size.get_file)
+
+async def download_file(get_file):
+    """Потоковое скачивание файла Telegram (get_file — запрос getFile) с ограничением размера"""
+    async with download_limit:
+        photo_file = await get_file()
+        # file_path — полный URL с токеном бота: ошибки aiohttp его повторяют, а они
+        # попадают в лог и в last_error очереди, поэтому заменяются своими
+        try:
+            async with http_session().get(photo_file.file_path) as response:
+                if response.status >= 400:
+                    raise TelegramDownloadError(f"HTTP {response.status} при скачивании файла Telegram")
+                chunks = []
+                received = 0
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    received += len(chunk)
+                    if received > MAX_PHOTO_BYTES:
+                        raise PhotoTooLargeError(f"больше {MAX_PHOTO_BYTES} байт")
+                    chunks.append(chunk)
+        except aiohttp.ClientError as e:
+            raise TelegramDownloadError(f"{type(e).__name__} при скачивании файла Telegram") from None
+    return b''.join(chunks)
+
+def drive_url(file_id):
+    """Публичная ссылка на файл Drive"""
+    return f"https://drive.google.com/uc?id={file_id}"
+
+# ID файла в ссылке drive_url (в формуле =IMAGE(...) и в столбце ссылок)
+DRIVE_FILE_ID_PATTERN = re.compile(r'[?&]id=([\w-]+)')
+
+class BatchQueue:
+    """Очередь отложенной записи: элементы копятся и отправляются одним запросом
+
+    Пакет уходит, когда набралось max_items элементов или прошло max_delay
+    секунд с первого из них. Подклассы реализуют _write(batch), где batch —
+    список пар (элемент, future), и выставляют результат каждого future.
+    """
+
+    def __init__(self, max_items, max_delay):
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    async def put(self, item):
+        """Поставить элемент в очередь и дождаться результата его пакета"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_items:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+
+        return await future
+
+    def _start_flush(self):
+        """Забрать накопленные элементы и запустить их запись"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._write(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch):
+        raise NotImplementedError
+
+    async def close(self):
+        """Дописать все, что осталось в очереди"""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+PUBLIC_PERMISSION = {'type': 'anyone', 'role': 'reader'}
+
+# Фото публичны за счет доступа, унаследованного от папки (определяется при запуске)
+drive_inherits_public = DRIVE_PUBLIC_MODE == 'inherit'
+
+async def detect_drive_public_mode(drive_service):
+    """Проверка, открыта ли папка GOOGLE_DRIVE_FOLDER_ID для всех по ссылке"""
+    global drive_inherits_public
+    if DRIVE_PUBLIC_MODE != 'auto':
+        return drive_inherits_public
+
+    result = await google_execute('drive', 'permissions.list', lambda: drive_service.permissions().list(
+        fileId=GOOGLE_DRIVE_FOLDER_ID,
+        fields='permissions(type,role)'
+    ))
+    drive_inherits_public = any(
+        permission.get('type') == 'anyone'
+        for permission in result.get('permissions', [])
+    )
+    return drive_inherits_public
+
+class DrivePermissionQueue(BatchQueue):
+    """Пакетная выдача публичного доступа к файлам одним batch-запросом"""
+
+    async def grant(self, file_id):
+        """Открыть доступ к файлу; True при успехе"""
+        return await self.put(file_id)
+
+    async def _write(self, batch):
+        """Отправить permissions().create для всех файлов пакета"""
+        drive_service = google_services['drive']
+
+        # Одиночный файл — обычным запросом, без обертки batch
+        if len(batch) == 1:
+            file_id, future = batch[0]
+            try:
+                await drive_create_permission(drive_service, file_id, PUBLIC_PERMISSION)
+                granted = True
+            except Exception as e:
+                logger.error(f"❌ ОШИБКА Drive (доступ к {file_id}): {e}")
+                granted = False
+            # Загрузка, ждавшая доступ, могла быть отменена (например, при остановке)
+            if not future.done():
+                future.set_result(granted)
+            return
+
+        errors = {}
+
+        def collect(request_id, response, exception):
+            errors[request_id] = exception
+
+        def make_batch():
+            batch_request = drive_service.new_batch_http_request(callback=collect)
+            for index, (file_id, _) in enumerate(batch):
+                batch_request.add(
+                    drive_service.permissions().create(fileId=file_id, body=PUBLIC_PERMISSION, fields='id'),
+                    request_id=str(index)
+                )
+            return batch_request
+
+        try:
+            await google_execute('drive', 'batch', make_batch, cost=len(batch))
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА Drive (доступ, пакет из {len(batch)}): {e}")
+
+        for index, (file_id, future) in enumerate(batch):
+            error = errors.get(str(index), RuntimeError("нет ответа"))
+            if error is not None:
+                status = error.resp.status if isinstance(error, HttpError) else type(error).__name__
+                metrics.inc('journal_google_errors_total', api='drive', method='batch.permissions.create', status=status)
+                logger.error(f"❌ ОШИБКА Drive (доступ к {file_id}): {error}")
+            if not future.done():
+                future.set_result(error is None)
+
+drive_permission_queue = DrivePermissionQueue(DRIVE_PERMISSION_BATCH_SIZE, DRIVE_PERMISSION_BATCH_DELAY)
+
+async def upload_to_drive(photo_bytes, name, drive_service):
+    """Загрузка фото на Google Drive, возвращает ID файла
+
+    Доступ по ссылке открывает publish_drive_file: ID файла сохраняется до этого,
+    чтобы повтор после ошибки или остановки не потерял файл без доступа.
+    """
+    try:
+        started = time.perf_counter()
+        file_metadata = {
+            'name': name,
+            'parents': [GOOGLE_DRIVE_FOLDER_ID]
+        }
+        # Небольшие фото — одним multipart-запросом, большие — резюмируемой загрузкой
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(
+            BytesIO(photo_bytes),
+            mimetype=photo_mimetype(photo_bytes),
+            chunksize=DRIVE_RESUMABLE_THRESHOLD,
+            resumable=len(photo_bytes) > DRIVE_RESUMABLE_THRESHOLD
+        )
+        with metrics.timer('journal_stage_seconds', stage='drive_create'):
+            file = await drive_create_file(drive_service, file_metadata, media)
+
+        logger.info(
+            f"✅ Drive: {name} ({len(photo_bytes) // 1024} КБ) за "
+            f"{(time.perf_counter() - started) * 1000:.0f} мс"
+        )
+        return file['id']
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА Drive: {e}")
+        return None
+
+async def publish_drive_file(file_id):
+    """Открыть доступ к файлу по ссылке, если он не наследуется от папки; True при успехе
+
+    Повторная выдача того же доступа ничего не меняет, поэтому доступ выдается
+    и найденным, и сохраненным ранее файлам: прошлая попытка могла не успеть.
+    """
+    if drive_inherits_public:
+        return True
+    with metrics.timer('journal_stage_seconds', stage='drive_permission'):
+        return await drive_permission_queue.grant(file_id)
+
+class SheetLayoutError(Exception):
+    """Строка заголовков таблицы не подходит для записи журнала"""
+
+# Строка заголовков листа, проверенная при запуске
+sheet_layout = None
+
+def sheet_range(cells):
+    """Диапазон на целевом листе таблицы"""
+    if GOOGLE_SHEET_TAB:
+        return f"'{GOOGLE_SHEET_TAB}'!{cells}"
+    return cells
+
+def column_letter(index):
+    """Буква столбца по его номеру (с нуля)"""
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return letters
+
+async def ensure_sheet_layout(sheets_service):
+    """Проверка строки заголовков; создает недостающие столбцы и кэширует порядок"""
+    with metrics.timer('journal_stage_seconds', stage='sheets_header'):
+        return await _ensure_sheet_layout(sheets_service)
+
+async def _ensure_sheet_layout(sheets_service):
+    global sheet_layout
+
+    result = await sheets_get_values(sheets_service, sheet_range("1:1"))
+    header = [str(value).strip() for value in result.get('values', [[]])[0]]
+
+    if not any(header):
+        await sheets_update_values(sheets_service, sheet_range("A1"), [COLUMN_HEADERS])
+        header = list(COLUMN_HEADERS)
+        logger.info("✅ Sheets: создана строка заголовков")
+
+    missing = [name for name in COLUMN_HEADERS if name not in header]
+    if missing:
+        start = column_letter(len(header))
+        await sheets_update_values(sheets_service, sheet_range(f"{start}1"), [missing])
+        logger.warning(f"⚠️ Sheets: в строке заголовков не было столбцов {missing}, они добавлены в конец")
+        header += missing
+
+    if header[:len(COLUMN_HEADERS)] != COLUMN_HEADERS:
+        logger.warning(
+            f"⚠️ Sheets: порядок столбцов отличается от ожидаемого: {header}. "
+            "Данные записываются по названиям заголовков"
+        )
+
+    duplicates = {name for name in COLUMN_HEADERS if header.count(name) > 1}
+    if duplicates:
+        raise SheetLayoutError(f"повторяющиеся заголовки: {sorted(duplicates)}")
+
+    sheet_layout = header
+    return header
+
+def layout_row(record):
+    """Строка таблицы в порядке столбцов листа"""
+    return [record.get(name, '') for name in sheet_layout]
+
+def is_layout_error(error):
+    """Ошибка диапазона или структуры листа"""
+    return isinstance(error, HttpError) and error.resp.status == 400
+
+class SheetsAppendQueue(BatchQueue):
+    """Очередь отложенной записи: строки копятся и добавляются одним append"""
+
+    async def append(self, record, check_existing=False):
+        """Поставить запись {заголовок: значение} в очередь; True, когда строка записана
+
+        check_existing: перед записью проверить, нет ли уже строки с тем же
+        'ID записи' (повторная попытка после неизвестного исхода).
+        """
+        return await self.put((record, check_existing))
+
+    async def _existing_ids(self, sheets_service):
+        """Значения столбца 'ID записи' на листе"""
+        column = column_letter(sheet_layout.index('ID записи'))
+        result = await sheets_get_values(sheets_service, sheet_range(f"{column}:{column}"))
+        return {row[0] for row in result.get('values', []) if row}
+
+    async def _write(self, batch):
+        """Записать пакет строк одним запросом
+
+        Строки отмененных записей (остановка, потерянная аренда) не пишутся:
+        запись вернется в очередь и будет выгружена повторно.
+        """
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+        sheets_service = google_services['sheets']
+        try:
+            if sheet_layout is None:
+                await ensure_sheet_layout(sheets_service)
+
+            # Строки, уже попавшие в таблицу при прошлой попытке, не дублируются
+            if any(check for (_, check), _ in batch):
+                existing = await self._existing_ids(sheets_service)
+                for (record, _), future in batch:
+                    if record['ID записи'] in existing and not future.done():
+                        future.set_result(True)
+
+            # Пока шли запросы, часть записей могла быть отменена
+            batch = [item for item in batch if not item[1].done()]
+            rows = [record for (record, _), _ in batch]
+            if rows:
+                started = time.perf_counter()
+                try:
+                    await sheets_append_values(
+                        sheets_service,
+                        sheet_range("A1"),
+                        [layout_row(record) for record in rows]
+                    )
+                except HttpError as e:
+                    if not is_layout_error(e):
+                        raise
+                    # Лист изменился: перепроверяем заголовки и повторяем один раз
+                    logger.warning(f"⚠️ Sheets: ошибка диапазона, перепроверка заголовков: {e}")
+                    await ensure_sheet_layout(sheets_service)
+                    await sheets_append_values(
+                        sheets_service,
+                        sheet_range("A1"),
+                        [layout_row(record) for record in rows]
+                    )
+                metrics.observe('journal_stage_seconds', time.perf_counter() - started, stage='sheets_append')
+            ok = True
+            logger.info(f"✅ Sheets: записано строк: {len(rows)}")
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА Sheets (пакет из {len(batch)}): {e}")
+            ok = False
+
+        for _, future in batch:
+            if not future.done():
+                future.set_result(ok)
+
+sheets_queue = SheetsAppendQueue(SHEETS_BATCH_SIZE, SHEETS_BATCH_MAX_DELAY)
+
+async def save_to_sheets(data, image_urls, check_existing=False):
+    """Сохранение в Google Sheets: первое фото в ячейке, ссылки на все фото альбома"""
+    try:
+        record = dict(zip(COLUMN_HEADERS, [
+            data['Мастер'],
+            data['дата'],
+            data['смена'],
+            data['наименование'],
+            data.get('комментарий', ''),
+            f'=IMAGE("{image_urls[0]}")',
+            data['id'],
+            '\n'.join(image_urls)
+        ]))
+
+        # Добавление данных через очередь пакетной записи
+        return await sheets_queue.append(record, check_existing)
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА Sheets: {e}")
+        return False
+
+class EntryPhoto(NamedTuple):
+    """Фото записи: JPEG, ключи кэша и ID файла на Drive
+
+    JPEG пустой, если файл уже есть на Drive или фото скачает воркер
+    по telegram_file ({'file_id': ..., 'fits': без уменьшения}).
+    """
+    photo: bytes
+    keys: list
+    drive_file_id: Optional[str] = None
+    telegram_file: Optional[dict] = None
+
+class Outbox:
+    """Локальная очередь готовых записей (SQLite в режиме WAL)
+
+    Запись с фото сохраняется на диск до ответа пользователю, а фоновый
+    обработчик выгружает ее в Drive и Sheets с повторными попытками.
+    Первое фото хранится в самой записи, остальные фото альбома — в outbox_photo.
+    Записи пакетного ввода смены (batch_id) ждут release() и выгружаются вместе.
+
+    Очередь общая для процессов: запись берется в работу арендой (lease_owner,
+    leased_until), поэтому выгружать могут несколько воркеров, а запись
+    упавшего воркера после OUTBOX_LEASE секунд достается другому. Пока выгрузка
+    идет, аренда продлевается, а изменения записи пишутся только владельцем аренды.
+
+    claims считает, сколько раз запись брали в работу: взятая повторно (после
+    ошибки, сбоя процесса или истекшей аренды) могла уже попасть в Drive и Sheets,
+    поэтому выгружается с проверкой дублей.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.bot = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                chat_id INTEGER,
+                data TEXT NOT NULL,
+                photo BLOB NOT NULL,
+                photo_keys TEXT,
+                drive_file_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                batch_id TEXT,
+                telegram_file TEXT,
+                notify INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                leased_until REAL,
+                claims INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        for column, definition in (
+            ('photo_keys', 'TEXT'),
+            ('batch_id', 'TEXT'),
+            ('telegram_file', 'TEXT'),
+            ('notify', 'INTEGER NOT NULL DEFAULT 0'),
+            ('lease_owner', 'TEXT'),
+            ('leased_until', 'REAL'),
+            ('claims', 'INTEGER NOT NULL DEFAULT 0')
+        ):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE outbox ADD COLUMN {column} {definition}")
+        if 'claims' not in columns:
+            # Записи из старой базы, которые уже пробовали выгрузить, проверяются на дубли
+            self._db.execute("UPDATE outbox SET claims = 1 WHERE attempts > 0 OR lease_owner IS NOT NULL")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at)")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_photo (
+                entry_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                photo BLOB NOT NULL,
+                photo_keys TEXT,
+                drive_file_id TEXT,
+                telegram_file TEXT,
+                PRIMARY KEY (entry_id, position)
+            )
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox_photo)")}
+        if 'telegram_file' not in columns:
+            self._db.execute("ALTER TABLE outbox_photo ADD COLUMN telegram_file TEXT")
+        self._wakeup = None
+        # ID записи в работе → задача ее выгрузки
+        self._in_flight = {}
+        self._tasks = set()
+        self._heartbeat_task = None
+
+    async def _run(self, func, *args):
+        """Выполнение запроса к базе в отдельном потоке"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _telegram_file(photo):
+        return json.dumps(photo.telegram_file) if photo.telegram_file else None
+
+    def _put(self, entry_id, chat_id, data, photos, batch_id, notify):
+        now = time.time()
+        first, extra = photos[0], photos[1:]
+        # Запись и фото альбома сохраняются одной транзакцией
+        self._db.execute("BEGIN")
+        try:
+            self._db.execute(
+                "INSERT INTO outbox (id, created_at, chat_id, data, photo, photo_keys, drive_file_id, "
+                "next_attempt_at, batch_id, telegram_file, notify) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry_id, now, chat_id, json.dumps(data, ensure_ascii=False),
+                    first.photo, json.dumps(list(first.keys)), first.drive_file_id, now, batch_id,
+                    self._telegram_file(first), int(notify)
+                )
+            )
+            self._db.executemany(
+                "INSERT INTO outbox_photo (entry_id, position, photo, photo_keys, drive_file_id, telegram_file) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        entry_id, position, photo.photo, json.dumps(list(photo.keys)),
+                        photo.drive_file_id, self._telegram_file(photo)
+                    )
+                    for position, photo in enumerate(extra, start=1)
+                ]
+            )
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    async def put(self, chat_id, data, photos, entry_id=None, batch_id=None, notify=False):
+        """Надежно сохранить запись; возвращает ее ID (ключ идемпотентности)
+
+        photos: список EntryPhoto (несколько — у альбома); у фото с drive_file_id
+        файл уже есть на Drive, загружать его не нужно;
+        entry_id: заранее выбранный ID (по нему названы локальные копии фото);
+        batch_id: запись смены, выгружается после release(batch_id);
+        notify: сообщить мастеру в чат chat_id, когда запись окажется в таблице.
+        """
+        entry_id = entry_id or uuid.uuid4().hex
+        data = dict(data, id=entry_id)
+        await self._run(self._put, entry_id, chat_id, data, list(photos), batch_id, notify)
+        if batch_id is not None:
+            # В индекс запись попадет при выгрузке: до конца смены ее можно убрать
+            return entry_id
+        self.wake()
+        file_ids = [photo.drive_file_id for photo in photos]
+        try:
+            await journal_index.record(data, file_ids if all(file_ids) else None)
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА индекса журнала: {e}")
+        return entry_id
+
+    def _claim(self, limit):
+        # Незавершенная смена ждет release(), брошенная — не дольше BATCH_MAX_AGE;
+        # взятая запись больше не принадлежит смене, и discard() ее уже не уберет.
+        # Записи берутся в аренду одним UPDATE, поэтому два процесса не возьмут одну
+        now = time.time()
+        claimed = [row[0] for row in self._db.execute(
+            "UPDATE outbox SET lease_owner = ?, leased_until = ?, claims = claims + 1, batch_id = NULL "
+            "WHERE id IN ("
+            "SELECT id FROM outbox WHERE next_attempt_at <= ? AND (batch_id IS NULL OR created_at <= ?) "
+            "AND (leased_until IS NULL OR leased_until < ?) ORDER BY next_attempt_at LIMIT ?) "
+            "RETURNING id",
+            (self.owner, now + OUTBOX_LEASE, now, now - BATCH_MAX_AGE, now, limit)
+        ).fetchall()]
+        if not claimed:
+            return []
+
+        placeholders = ', '.join('?' * len(claimed))
+        entries = [
+            {
+                'id': row[0],
+                'chat_id': row[1],
+                'data': json.loads(row[2]),
+                'photos': [{
+                    'position': 0,
+                    'photo': row[3],
+                    'photo_keys': json.loads(row[4] or '[]'),
+                    'drive_file_id': row[5],
+                    'telegram_file': json.loads(row[6]) if row[6] else None
+                }],
+                'attempts': row[7],
+                'notify': bool(row[8]),
+                'claims': row[9]
+            }
+            for row in self._db.execute(
+                "SELECT id, chat_id, data, photo, photo_keys, drive_file_id, telegram_file, attempts, notify, claims "
+                f"FROM outbox WHERE id IN ({placeholders}) ORDER BY next_attempt_at",
+                claimed
+            )
+        ]
+        by_id = {entry['id']: entry for entry in entries}
+        for entry_id, position, photo, photo_keys, drive_file_id, telegram_file in self._db.execute(
+            "SELECT entry_id, position, photo, photo_keys, drive_file_id, telegram_file FROM outbox_photo "
+            f"WHERE entry_id IN ({placeholders}) ORDER BY entry_id, position",
+            claimed
+        ):
+            by_id[entry_id]['photos'].append({
+                'position': position,
+                'photo': photo,
+                'photo_keys': json.loads(photo_keys or '[]'),
+                'drive_file_id': drive_file_id,
+                'telegram_file': json.loads(telegram_file) if telegram_file else None
+            })
+        return entries
+
+    def _next_due_in(self):
+        # Уже готовые записи подхватываются по wake(), ждем только отложенные
+        # и арендованные другими процессами (на случай их сбоя)
+        now = time.time()
+        row = self._db.execute(
+            "SELECT MIN(MAX(next_attempt_at, COALESCE(leased_until, 0))) FROM outbox "
+            "WHERE batch_id IS NULL AND MAX(next_attempt_at, COALESCE(leased_until, 0)) > ?",
+            (now,)
+        ).fetchone()
+        return None if row[0] is None else row[0] - now
+
+    def _pending_ids(self):
+        return [row[0] for row in self._db.execute("SELECT id FROM outbox")]
+
+    async def pending_ids(self):
+        """ID записей, еще не выгруженных в Google"""
+        return await self._run(self._pending_ids)
+
+    def _release(self, batch_id):
+        return self._db.execute(
+            "UPDATE outbox SET batch_id = NULL, next_attempt_at = ? WHERE batch_id = ?",
+            (time.time(), batch_id)
+        ).rowcount
+
+    async def release(self, batch_id):
+        """Выгрузить все записи смены разом; возвращает их количество"""
+        count = await self._run(self._release, batch_id)
+        self.wake()
+        return count
+
+    def _discard(self, entry_id):
+        self._db.execute("BEGIN")
+        try:
+            deleted = self._db.execute(
+                "DELETE FROM outbox WHERE id = ? AND batch_id IS NOT NULL AND lease_owner IS NULL", (entry_id,)
+            ).rowcount
+            if deleted:
+                self._db.execute("DELETE FROM outbox_photo WHERE entry_id = ?", (entry_id,))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return deleted > 0
+
+    async def discard(self, entry_id):
+        """Убрать еще не выгруженную запись смены; False, если она уже выгружается"""
+        return await self._run(self._discard, entry_id)
+
+    # Изменения записи — только пока аренда у этого процесса: запись, аренда которой
+    # истекла, уже выгружает другой процесс
+    OWNED = "EXISTS (SELECT 1 FROM outbox WHERE id = ? AND lease_owner = ?)"
+
+    def _set_photo(self, entry_id, position, photo_bytes, photo_keys):
+        if position == 0:
+            self._db.execute(
+                "UPDATE outbox SET photo = ?, photo_keys = ? WHERE id = ? AND lease_owner = ?",
+                (photo_bytes, json.dumps(photo_keys), entry_id, self.owner)
+            )
+        else:
+            self._db.execute(
+                f"UPDATE outbox_photo SET photo = ?, photo_keys = ? WHERE entry_id = ? AND position = ? "
+                f"AND {self.OWNED}",
+                (photo_bytes, json.dumps(photo_keys), entry_id, position, entry_id, self.owner)
+            )
+
+    def _set_drive_file(self, entry_id, position, file_id):
+        if position == 0:
+            self._db.execute(
+                "UPDATE outbox SET drive_file_id = ? WHERE id = ? AND lease_owner = ?",
+                (file_id, entry_id, self.owner)
+            )
+        else:
+            self._db.execute(
+                f"UPDATE outbox_photo SET drive_file_id = ? WHERE entry_id = ? AND position = ? AND {self.OWNED}",
+                (file_id, entry_id, position, entry_id, self.owner)
+            )
+
+    def _done(self, entry_id):
+        self._db.execute("BEGIN")
+        try:
+            deleted = self._db.execute(
+                "DELETE FROM outbox WHERE id = ? AND lease_owner = ?", (entry_id, self.owner)
+            ).rowcount
+            if deleted:
+                self._db.execute("DELETE FROM outbox_photo WHERE entry_id = ?", (entry_id,))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return deleted > 0
+
+    def _retry(self, entry_id, attempts, error):
+        # Экспоненциальная задержка со случайным разбросом
+        delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** attempts)
+        delay *= random.uniform(0.5, 1.0)
+        self._db.execute(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, "
+            "lease_owner = NULL, leased_until = NULL WHERE id = ? AND lease_owner = ?",
+            (attempts + 1, time.time() + delay, error, entry_id, self.owner)
+        )
+        return delay
+
+    def _renew_leases(self, entry_ids):
+        self._db.execute(
+            "UPDATE outbox SET leased_until = ? WHERE lease_owner = ?",
+            (time.time() + OUTBOX_LEASE, self.owner)
+        )
+        placeholders = ', '.join('?' * len(entry_ids))
+        return [row[0] for row in self._db.execute(
+            f"SELECT id FROM outbox WHERE id IN ({placeholders}) "
+            "AND lease_owner IS NOT NULL AND lease_owner != ?",
+            (*entry_ids, self.owner)
+        )]
+
+    async def _heartbeat(self):
+        """Продление аренды записей в работе, пока выгрузка идет дольше OUTBOX_LEASE"""
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE / 3)
+            if not self._in_flight:
+                continue
+            try:
+                lost = await self._run(self._renew_leases, list(self._in_flight))
+            except Exception as e:
+                logger.error(f"❌ ОШИБКА продления аренды outbox: {e}")
+                continue
+            # Аренда истекла (например, процесс надолго останавливался) и запись взял
+            # другой процесс: он и выгрузит ее с проверкой дублей
+            for entry_id in lost:
+                task = self._in_flight.get(entry_id)
+                if task is not None:
+                    logger.warning(f"⚠️ Запись {entry_id} взял другой процесс, выгрузка здесь прервана")
+                    task.cancel()
+
+    def _release_leases(self):
+        return self._db.execute(
+            "UPDATE outbox SET lease_owner = NULL, leased_until = NULL WHERE lease_owner = ?",
+            (self.owner,)
+        ).rowcount
+
+    async def cancel(self):
+        """Прервать выгрузки, которые сейчас в работе"""
+        tasks = list(self._tasks)
+        if self._heartbeat_task is not None:
+            tasks.append(self._heartbeat_task)
+            self._heartbeat_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def finish(self, timeout):
+        """Остановка: выгрузки в работе завершаются не дольше timeout секунд,
+        оставшиеся прерываются и возвращаются в очередь; возвращает их число
+
+        Новые записи к этому моменту уже не должны браться (drain остановлен).
+        """
+        tasks = list(self._tasks)
+        if tasks and timeout > 0:
+            await asyncio.wait(tasks, timeout=timeout)
+        interrupted = sum(not task.done() for task in tasks)
+        await self.cancel()
+        await self.release_leases()
+        return interrupted
+
+    async def release_leases(self):
+        """Вернуть в очередь записи, взятые этим процессом (при остановке)"""
+        count = await self._run(self._release_leases)
+        if count:
+            logger.warning(f"⚠️ Возвращено в очередь записей: {count}")
+        return count
+
+    def wake(self):
+        """Разбудить фоновый обработчик"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _fetch_photo(self, entry, photo):
+        """Скачивание и обработка фото, которое бот передал ссылкой на файл Telegram"""
+        if self.bot is None:
+            raise RuntimeError("нет клиента Telegram для скачивания фото")
+        telegram_file = photo['telegram_file']
+        with metrics.timer('journal_stage_seconds', stage='download'):
+            raw_bytes = await download_file(functools.partial(self.bot.get_file, telegram_file['file_id']))
+        photo['photo_keys'] = photo['photo_keys'] + [content_photo_key(raw_bytes)]
+        photo['drive_file_id'] = await photo_cache.get(photo['photo_keys'][-1])
+        if photo['drive_file_id'] is not None:
+            return
+
+        photo['photo'] = await encode_photo(raw_bytes, telegram_file['fits'])
+        with metrics.timer('journal_stage_seconds', stage='local_save'):
+            await photo_store.save(entry['id'], photo['photo'], photo['position'])
+        # Повторная попытка не скачивает фото снова
+        await self._run(self._set_photo, entry['id'], photo['position'], photo['photo'], photo['photo_keys'])
+
+    async def _upload_photo(self, entry, photo, retry):
+        """Выгрузка одного фото записи в Drive; возвращает ID файла"""
+        if photo['drive_file_id'] is None and not photo['photo'] and photo['telegram_file']:
+            await self._fetch_photo(entry, photo)
+        file_id = photo['drive_file_id']
+        photo_name = photo_file_name(entry['id'], photo['position'])
+
+        # Повторная попытка: файл мог быть создан, но ID не успел сохраниться
+        if file_id is None and retry:
+            file_id = await drive_find_file(google_services['drive'], photo_name)
+        if file_id is None:
+            file_id = await upload_to_drive(photo['photo'], photo_name, google_services['drive'])
+            if file_id is None:
+                raise RuntimeError(f"не удалось загрузить фото {photo_name} в Drive")
+        # ID сохраняется до выдачи доступа: если она не удастся или выгрузку прервут,
+        # повтор не создаст второй файл и снова откроет доступ к этому
+        if file_id != photo['drive_file_id']:
+            await self._run(self._set_drive_file, entry['id'], photo['position'], file_id)
+        if not await publish_drive_file(file_id):
+            raise RuntimeError(f"не удалось открыть доступ к фото {photo_name} на Drive")
+        # В кеш попадают только файлы с открытым доступом
+        if photo['photo_keys']:
+            await photo_cache.put(photo['photo_keys'], file_id)
+        return file_id
+
+    async def _commit(self, entry):
+        """Выгрузка одной записи в Drive и Sheets"""
+        if not await google_ready():
+            raise RuntimeError("клиенты Google недоступны")
+
+        # Запись, взятая не впервые, могла быть выгружена до сбоя: файлы и строка ищутся
+        retry = entry['claims'] > 1
+        # Фото альбома загружаются параллельно; ID уже загруженных сохраняются,
+        # даже если другое фото не загрузилось, и повтор их не дублирует
+        results = await asyncio.gather(
+            *[self._upload_photo(entry, photo, retry) for photo in entry['photos']],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        file_ids = results
+
+        if not await save_to_sheets(entry['data'], [drive_url(file_id) for file_id in file_ids], check_existing=retry):
+            raise RuntimeError("не удалось записать строку в Sheets")
+        try:
+            await journal_index.record(entry['data'], file_ids)
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА индекса журнала: {e}")
+
+    async def _process(self, entry):
+        """Одна попытка выгрузки записи с учетом результата в базе"""
+        # Повторные попытки уступают квоту свежим записям
+        if entry['attempts'] > 0:
+            google_priority.set(PRIORITY_BACKGROUND)
+        try:
+            try:
+                with metrics.timer('journal_stage_seconds', stage='commit'):
+                    await self._commit(entry)
+            except Exception as e:
+                delay = await self._run(self._retry, entry['id'], entry['attempts'], str(e))
+                logger.error(
+                    f"❌ ОШИБКА выгрузки записи {entry['id']} "
+                    f"(попытка {entry['attempts'] + 1}, повтор через {delay:.0f} с): {e}"
+                )
+                if entry['notify'] and entry['attempts'] + 1 == OUTBOX_NOTIFY_ATTEMPTS:
+                    await self._notify(entry, "⚠️ Запись пока не выгружена в таблицу, повторяем попытки")
+                return
+            if not await self._run(self._done, entry['id']):
+                logger.warning(f"⚠️ Запись {entry['id']} выгружена, но ее уже взял другой процесс")
+                return
+            photo_store.confirm(entry['id'])
+            # Фото, найденные в кеше Drive, не выгружались и байтов не содержат
+            photo_bytes = sum(len(photo['photo'] or b'') for photo in entry['photos'])
+            metrics.observe('journal_entry_upload_bytes', photo_bytes)
+            logger.info(f"✅ Запись {entry['id']} выгружена в Google ({photo_bytes / 1024:.0f} КБ фото)")
+            if entry['notify']:
+                await self._notify(entry, "☁️ Запись выгружена в таблицу")
+        finally:
+            self._in_flight.pop(entry['id'], None)
+            self.wake()
+
+    async def _notify(self, entry, text):
+        """Сообщение мастеру о результате выгрузки записи"""
+        if self.bot is None or entry['chat_id'] is None:
+            return
+        data = entry['data']
+        try:
+            await self.bot.send_message(
+                chat_id=entry['chat_id'],
+                text=f"{text}: {data['наименование']}, {data['дата']}, {data['смена']}"
+            )
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА уведомления о записи {entry['id']}: {e}")
+
+    async def drain(self, bot=None, poll_interval=None):
+        """Фоновая выгрузка записей с повторными попытками
+
+        bot: скачивание фото по ссылке и уведомления мастерам;
+        poll_interval: записи ставит другой процесс, очередь проверяется по таймеру.
+        """
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        # Аренда продлевается и после остановки drain, пока выгрузки завершаются
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+        while True:
+            self._wakeup.clear()
+
+            # В работе не больше OUTBOX_CONCURRENCY записей: они держат фото в памяти,
+            # а параллелизм самих запросов ограничен GOOGLE_*_CONCURRENCY
+            free = OUTBOX_CONCURRENCY - len(self._in_flight)
+            entries = []
+            if free > 0:
+                # Своя аренда могла истечь у очень долгой выгрузки: такие записи уже в работе
+                entries = [
+                    entry for entry in await self._run(self._claim, free)
+                    if entry['id'] not in self._in_flight
+                ]
+            for entry in entries:
+                task = asyncio.create_task(self._process(entry))
+                self._in_flight[entry['id']] = task
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            timeout = min(await self._run(self._next_due_in) or 30.0, 30.0)
+            if poll_interval:
+                timeout = min(timeout, poll_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        """Закрыть базу"""
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+class PhotoCache:
+    """Кэш загруженных фото: file_unique_id и SHA-256 → ID файла на Drive
+
+    Хранится в той же базе SQLite, ограничен PHOTO_CACHE_SIZE ключами
+    и вытесняет давно не использованные (LRU).
+    """
+
+    def __init__(self, path, max_size):
+        self.max_size = max_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='photo-cache')
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS photo_cache (
+                key TEXT PRIMARY KEY,
+                drive_file_id TEXT NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS photo_cache_lru ON photo_cache (used_at)")
+
+    async def _run(self, func, *args):
+        """Выполнение запроса к базе в отдельном потоке"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _get(self, keys):
+        for key in keys:
+            row = self._db.execute(
+                "SELECT drive_file_id FROM photo_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                self._db.execute(
+                    "UPDATE photo_cache SET used_at = ? WHERE key = ?", (time.time(), key)
+                )
+                return row[0]
+        return None
+
+    def _put(self, keys, file_id):
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO photo_cache (key, drive_file_id, used_at) VALUES (?, ?, ?)",
+            [(key, file_id, now) for key in keys]
+        )
+        self._db.execute(
+            "DELETE FROM photo_cache WHERE key IN ("
+            "SELECT key FROM photo_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+
+    async def get(self, *keys):
+        """ID файла на Drive по первому найденному ключу"""
+        return await self._run(self._get, keys)
+
+    async def put(self, keys, file_id):
+        """Запомнить файл под всеми ключами"""
+        await self._run(self._put, keys, file_id)
+
+    def close(self):
+        """Закрыть базу"""
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+class SQLitePersistence(BasePersistence):
+    """Хранение user_data (этап и введенные данные) в SQLite
+
+    В отличие от PicklePersistence, при каждом обновлении перезаписывается
+    только запись изменившегося пользователя.
+    """
+
+    def __init__(self, path, update_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persistence')
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._written = {}
+
+    async def _run(self, func, *args):
+        """Выполнение запроса к базе в отдельном потоке"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _load_users(self):
+        users = {}
+        for user_id, data in self._db.execute("SELECT user_id, data FROM user_state"):
+            try:
+                users[user_id] = pickle.loads(data)
+            except Exception as e:
+                logger.error(f"❌ ОШИБКА чтения состояния пользователя {user_id}: {e}")
+            else:
+                self._written[user_id] = hash(data)
+        return users
+
+    def _save_user(self, user_id, data):
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        # Неизменившееся состояние повторно не записывается
+        if self._written.get(user_id) == hash(blob):
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)",
+            (user_id, blob, time.time())
+        )
+        self._written[user_id] = hash(blob)
+
+    def _drop_user(self, user_id):
+        self._db.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+        self._written.pop(user_id, None)
+
+    async def get_user_data(self):
+        users = await self._run(self._load_users)
+        logger.info(f"✅ Восстановлено состояние пользователей: {len(users)}")
+        return users
+
+    async def update_user_data(self, user_id, data):
+        await self._run(self._save_user, user_id, data)
+
+    async def drop_user_data(self, user_id):
+        await self._run(self._drop_user, user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Вызывается при остановке: все записи уже на диске, закрываем базу"""
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=True)
+
+class JournalIndex:
+    """Локальный индекс записей журнала для отчетов без чтения таблицы
+
+    Записи хранятся в той же базе SQLite с индексами по дате, смене,
+    наименованию и мастеру. Пополняется при сохранении каждой записи
+    и сверкой с таблицей (reconcile), которая добавляет недостающие строки.
+    Старые строки таблицы без 'ID записи' хранятся под ключом sheet-... по
+    содержимому и при каждой сверке заменяются целиком.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal-index')
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                id TEXT PRIMARY KEY,
+                date TEXT NOT NULL,
+                shift TEXT NOT NULL,
+                product TEXT NOT NULL,
+                master TEXT NOT NULL,
+                comment TEXT,
+                drive_file_id TEXT
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS journal_date ON journal (date, shift, product)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS journal_product ON journal (product, date)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS journal_master ON journal (master, date)")
+        self.reconciled_at = None
+
+    async def _run(self, func, *args):
+        """Выполнение запроса к базе в отдельном потоке"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _row(data, drive_file_ids):
+        date = datetime.datetime.strptime(data['дата'], "%d.%m.%Y").date().isoformat()
+        # ID файлов всех фото записи (альбома) через пробел
+        return (
+            data['id'], date, data['смена'], data['наименование'],
+            data['Мастер'], data.get('комментарий', ''),
+            ' '.join(drive_file_ids) if drive_file_ids else None
+        )
+
+    def _upsert(self, rows):
+        # ID файла дописывается, если его еще не было; остальные поля не меняются
+        self._db.executemany(
+            "INSERT INTO journal (id, date, shift, product, master, comment, drive_file_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+            "drive_file_id = COALESCE(journal.drive_file_id, excluded.drive_file_id)",
+            rows
+        )
+
+    def _reconcile(self, rows, legacy_rows):
+        # Старые строки могли отсортировать или удалить в таблице: заменяются все сразу
+        self._db.execute("BEGIN")
+        try:
+            self._db.execute("DELETE FROM journal WHERE id LIKE 'sheet-%'")
+            self._upsert(rows + legacy_rows)
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def legacy_id(values, seen):
+        """Ключ строки без 'ID записи': по содержимому (мастер, дата, смена,
+        наименование, комментарий, фото), а не по номеру строки, который меняется
+        при сортировке; одинаковые строки различаются порядковым номером"""
+        digest = hashlib.sha1('\x1f'.join(values).encode()).hexdigest()[:16]
+        seen[digest] = seen.get(digest, 0) + 1
+        return f"sheet-{digest}-{seen[digest]}"
+
+    async def record(self, data, drive_file_ids=None):
+        """Добавить запись (данные в формате outbox) или дописать ID ее фото"""
+        await self._run(self._upsert, [self._row(data, drive_file_ids)])
+
+    def _report(self, start, end):
+        where = "WHERE date BETWEEN ? AND ?"
+        params = (start.isoformat(), end.isoformat())
+        return {
+            'total': self._db.execute(f"SELECT COUNT(*) FROM journal {where}", params).fetchone()[0],
+            'by_shift': self._db.execute(
+                f"SELECT shift, product, COUNT(*) FROM journal {where} "
+                "GROUP BY shift, product ORDER BY shift, COUNT(*) DESC, product",
+                params
+            ).fetchall(),
+            'by_master': self._db.execute(
+                f"SELECT master, COUNT(*) FROM journal {where} "
+                "GROUP BY master ORDER BY COUNT(*) DESC, master",
+                params
+            ).fetchall()
+        }
+
+    async def report(self, start, end):
+        """Количество записей за период по сменам, наименованиям и мастерам"""
+        return await self._run(self._report, start, end)
+
+    def _stats(self, since):
+        return {
+            'total': self._db.execute("SELECT COUNT(*) FROM journal").fetchone()[0],
+            'by_day': self._db.execute(
+                "SELECT date, shift, COUNT(*) FROM journal WHERE date >= ? "
+                "GROUP BY date, shift ORDER BY date DESC, shift",
+                (since.isoformat(),)
+            ).fetchall(),
+            'top_products': self._db.execute(
+                "SELECT product, COUNT(*) FROM journal WHERE date >= ? "
+                "GROUP BY product ORDER BY COUNT(*) DESC, product LIMIT 5",
+                (since.isoformat(),)
+            ).fetchall()
+        }
+
+    async def stats(self, days=7):
+        """Сводка за последние days дней"""
+        since = datetime.date.today() - datetime.timedelta(days=days - 1)
+        return await self._run(self._stats, since)
+
+    def _export(self, start, end, path):
+        # Отдельное соединение: долгая выгрузка не задерживает /report и запись
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            # Write-only: строки сразу пишутся во временный XML, память не растет
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet("Журнал")
+            sheet.append(COLUMN_HEADERS)
+            count = 0
+            rows = db.execute(
+                "SELECT master, date, shift, product, comment, drive_file_id, id FROM journal "
+                "WHERE date BETWEEN ? AND ? ORDER BY date, shift, product",
+                (start.isoformat(), end.isoformat())
+            )
+            for master, date, shift, product, comment, drive_file_ids, entry_id in rows:
+                date_cell = WriteOnlyCell(sheet, value=datetime.date.fromisoformat(date))
+                date_cell.number_format = 'DD.MM.YYYY'
+                photo_cell = ''
+                urls = [drive_url(file_id) for file_id in (drive_file_ids or '').split()]
+                if urls:
+                    # Формула, а не cell.hyperlink: объекты ссылок копятся в памяти до сохранения
+                    photo_cell = WriteOnlyCell(sheet, value=f'=HYPERLINK("{urls[0]}","Фото")')
+                    photo_cell.style = 'Hyperlink'
+                sheet.append([master, date_cell, shift, product, comment, photo_cell, entry_id, '\n'.join(urls)])
+                count += 1
+            workbook.save(path)
+            return count
+        finally:
+            db.close()
+
+    async def export_xlsx(self, start, end, path):
+        """Записать записи за период в файл .xlsx; возвращает число строк"""
+        return await asyncio.to_thread(self._export, start, end, path)
+
+    async def reconcile(self, sheets_service):
+        """Сверка с таблицей: добавить в индекс строки, которых в нем нет"""
+        started = time.perf_counter()
+        if sheet_layout is None:
+            await ensure_sheet_layout(sheets_service)
+        result = await sheets_get_values(
+            sheets_service,
+            sheet_range(f"A2:{column_letter(len(sheet_layout) - 1)}"),
+            value_render_option='FORMULA'
+        )
+
+        rows, legacy_rows, skipped = [], [], 0
+        seen = {}
+        for values in result.get('values', []):
+            cells = dict(zip(sheet_layout, (str(value).strip() for value in values)))
+            # Все фото альбома — в столбце ссылок, в старых строках только =IMAGE(...)
+            file_ids = (
+                DRIVE_FILE_ID_PATTERN.findall(cells.get('Ссылки на фото', ''))
+                or DRIVE_FILE_ID_PATTERN.findall(cells.get('Фото', ''))
+            )
+            data = {
+                'дата': cells.get('Дата', ''),
+                'смена': cells.get('Смена', ''),
+                'наименование': cells.get('Наименование', ''),
+                'Мастер': cells.get('Мастер', ''),
+                'комментарий': cells.get('Комментарий', '')
+            }
+            entry_id = cells.get('ID записи')
+            try:
+                if entry_id:
+                    rows.append(self._row(dict(data, id=entry_id), file_ids))
+                else:
+                    # Строки до появления столбца 'ID записи'
+                    key = [data['Мастер'], data['дата'], data['смена'], data['наименование'],
+                           data['комментарий'], *file_ids]
+                    legacy_rows.append(self._row(dict(data, id=self.legacy_id(key, seen)), file_ids))
+            except ValueError:
+                skipped += 1
+
+        await self._run(self._reconcile, rows, legacy_rows)
+        self.reconciled_at = datetime.datetime.now()
+        logger.info(
+            f"✅ Индекс журнала сверен с таблицей: строк {len(rows) + len(legacy_rows)}, "
+            f"пропущено {skipped}, за {(time.perf_counter() - started) * 1000:.0f} мс"
+        )
+
+    async def reconciler(self, interval):
+        """Периодическая сверка с таблицей"""
+        google_priority.set(PRIORITY_BACKGROUND)
+        while True:
+            try:
+                if await google_ready():
+                    await self.reconcile(google_services['sheets'])
+            except Exception as e:
+                logger.error(f"❌ ОШИБКА сверки индекса журнала: {e}")
+            await asyncio.sleep(interval)
+
+    def close(self):
+        """Закрыть базу"""
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+def telegram_photo_key(photo_size):
+    """Ключ кэша по file_unique_id из Telegram"""
+    return f"tg:{photo_size.file_unique_id}"
+
+def content_photo_key(raw_bytes):
+    """Ключ кэша по содержимому файла"""
+    return f"sha256:{hashlib.sha256(raw_bytes).hexdigest()}"
+
+# Очередь, кеш фото и индекс журнала открываются при запуске (open_storage):
+# импорт модуля не создает и не мигрирует базу
+outbox = None
+photo_cache = None
+journal_index = None
+
+def open_storage():
+    """Открыть базу OUTBOX_DB (очередь, кеш фото, индекс журнала) и каталог PHOTOS_DIR"""
+    global outbox, photo_cache, journal_index
+    os.makedirs(PHOTOS_DIR, exist_ok=True)
+    outbox = Outbox(OUTBOX_DB)
+    photo_cache = PhotoCache(OUTBOX_DB, PHOTO_CACHE_SIZE)
+    journal_index = JournalIndex(OUTBOX_DB)
+
+def close_storage():
+    """Закрыть базы, открытые open_storage()"""
+    for store in (outbox, photo_cache, journal_index):
+        if store is not None:
+            store.close()
+
+# Кнопки создаются один раз: InlineKeyboardMarkup неизменяемы и общие для всех чатов
+BACK_TO_MASTER_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад", callback_data='back_to_master')]
+])
+BACK_TO_PRODUCT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад", callback_data='back_to_product')]
+])
+BACK_TO_COMMENT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад", callback_data='back_to_comment')]
+])
+DATE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Сегодня", callback_data='date_today')],
+    [InlineKeyboardButton("Другая дата", callback_data='date_custom')],
+    [InlineKeyboardButton("◀️ Назад", callback_data='back_to_master')]
+])
+SHIFT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("День", callback_data='день'),
+     InlineKeyboardButton("Ночь", callback_data='ночь')],
+    [InlineKeyboardButton("◀️ Назад", callback_data='back_to_date')]
+])
+PRODUCT_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(name, callback_data=f"name_{idx}")] for idx, name in enumerate(PRODUCT_NAMES)]
+    + [[InlineKeyboardButton("✏️ Ввести свое наименование", callback_data="custom_name")],
+       [InlineKeyboardButton("◀️ Назад", callback_data='back_to_shift')]]
+)
+# Выбор продукта при вводе смены: еще и завершение смены
+BATCH_PRODUCT_MARKUP = InlineKeyboardMarkup(
+    list(PRODUCT_MARKUP.inline_keyboard)
+    + [[InlineKeyboardButton("↩️ Убрать последнюю запись", callback_data='пакет_убрать')],
+       [InlineKeyboardButton("✅ Завершить смену", callback_data='пакет_завершить')]]
+)
+NEW_ENTRY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Новая запись", callback_data='новая')]
+])
+
+# Флаги ожидания ввода своего значения текстом
+TEXT_FLAGS = ('custom_date', 'custom_name')
+
+def parse_date(text):
+    """Дата в формате ДД.ММ.ГГГГ"""
+    return {
+        'дата': text,
+        'date_obj': datetime.datetime.strptime(text, "%d.%m.%Y")
+    }
+
+def today_fields():
+    """Сегодняшняя дата"""
+    today = datetime.datetime.now()
+    return {
+        'дата': today.strftime("%d.%m.%Y"),
+        'date_obj': today
+    }
+
+class TextInput(NamedTuple):
+    """Текстовый ввод на этапе: разбор, условие и переход"""
+    parse: Callable[[str], dict]
+    next: int
+    requires: Optional[str] = None
+    error: Optional[str] = None
+
+class Stage(NamedTuple):
+    """Этап записи: вопрос, кнопки (отдельные для ввода смены) и обработка текста"""
+    prompt: str
+    markup: Optional[InlineKeyboardMarkup]
+    text: Optional[TextInput] = None
+    batch_markup: Optional[InlineKeyboardMarkup] = None
+
+# Этапы записи журнала
+STAGES = {
+    1: Stage(
+        "👨‍🍳 Введите ФИО Мастера:",
+        None,
+        TextInput(lambda text: {'Мастер': text}, next=2)
+    ),
+    2: Stage(
+        "📅 Выберите дату:",
+        DATE_MARKUP,
+        TextInput(
+            parse_date,
+            next=3,
+            requires='custom_date',
+            error="❌ Неверный формат. Используйте ДД.ММ.ГГГГ"
+        )
+    ),
+    3: Stage("🌞🌜 Выберите смену:", SHIFT_MARKUP),
+    4: Stage(
+        "🏷 Выберите наименование продукта:",
+        PRODUCT_MARKUP,
+        TextInput(lambda text: {'наименование': text}, next=5, requires='custom_name'),
+        BATCH_PRODUCT_MARKUP
+    ),
+    5: Stage(
+        "💬 Введите комментарий:",
+        BACK_TO_PRODUCT_MARKUP,
+        TextInput(lambda text: {'комментарий': text}, next=6)
+    ),
+    6: Stage("📸 Отправьте фото готовой продукции:", BACK_TO_COMMENT_MARKUP)
+}
+
+def enter_stage(user_data, stage):
+    """Переход на этап со сбросом флагов ввода"""
+    for flag in TEXT_FLAGS:
+        user_data.pop(flag, None)
+    user_data['этап'] = stage
+    stage = STAGES[stage]
+    if user_data.get('пакет') and stage.batch_markup is not None:
+        return stage._replace(markup=stage.batch_markup)
+    return stage
+
+class Choice(NamedTuple):
+    """Выбор кнопкой: сохраняет значение и переходит на следующий этап"""
+    fields: Callable[[], dict]
+    label: str
+    key: str
+    next: int
+
+    async def apply(self, query, context):
+        user_data = context.user_data
+        user_data.update(self.fields())
+        stage = enter_stage(user_data, self.next)
+        await query.edit_message_text(text=f"{self.label}: {user_data[self.key]}")
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=stage.prompt,
+            reply_markup=stage.markup
+        )
+
+class AskText(NamedTuple):
+    """Кнопка ввода своего значения текстом"""
+    flag: str
+    prompt: str
+    markup: InlineKeyboardMarkup
+
+    async def apply(self, query, context):
+        context.user_data[self.flag] = True
+        await query.edit_message_text(text=self.prompt, reply_markup=self.markup)
+
+class Back(NamedTuple):
+    """Кнопка «Назад»: возврат на этап"""
+    stage: int
+
+    async def apply(self, query, context):
+        stage = enter_stage(context.user_data, self.stage)
+        await query.edit_message_text(text=stage.prompt, reply_markup=stage.markup)
+
+class NewEntry(NamedTuple):
+    """Кнопка «Новая запись»"""
+
+    async def apply(self, query, context):
+        closed = await reset_conversation(context.user_data)
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=f"{closed}\n\n{STAGES[1].prompt}" if closed else STAGES[1].prompt,
+            reply_markup=ReplyKeyboardRemove()
+        )
+
+class FinishBatch(NamedTuple):
+    """Кнопка «Завершить смену»: записи смены выгружаются вместе"""
+
+    async def apply(self, query, context):
+        # Кнопка со старого сообщения после конца смены: начатая запись не сбрасывается
+        if not context.user_data.get('пакет'):
+            await query.edit_message_text(text="❌ Ввод смены уже завершен. Новая смена — /shift")
+            return
+        closed = await reset_conversation(context.user_data)
+        await query.edit_message_text(
+            text=closed or "❌ В смене нет записей",
+            reply_markup=NEW_ENTRY_MARKUP
+        )
+
+class UndoBatchEntry(NamedTuple):
+    """Кнопка «Убрать последнюю запись» смены"""
+
+    async def apply(self, query, context):
+        user_data = context.user_data
+        entries = user_data.get('записи')
+        if not entries:
+            return
+        entry = entries[-1]
+        if await outbox.discard(entry['id']):
+            entries.pop()
+            photo_store.confirm(entry['id'])
+            note = f"↩️ Убрана запись: {entry['наименование']}"
+        else:
+            note = "❌ Запись уже выгружена в таблицу"
+        stage = enter_stage(user_data, 4)
+        await query.edit_message_text(
+            text=f"{note}\n\n{batch_summary(user_data)}\n\n{stage.prompt}",
+            reply_markup=stage.markup
+        )
+
+# Действия по callback_data: поиск за O(1) вместо цепочек if/elif
+CALLBACKS = {
+    'date_today': Choice(today_fields, "Дата", 'дата', 3),
+    'date_custom': AskText('custom_date', "✏️ Введите дату в формате ДД.ММ.ГГГГ:", BACK_TO_MASTER_MARKUP),
+    'день': Choice(lambda: {'смена': 'День'}, "Смена", 'смена', 4),
+    'ночь': Choice(lambda: {'смена': 'Ночь'}, "Смена", 'смена', 4),
+    'custom_name': AskText('custom_name', "✏️ Введите свое наименование:", BACK_TO_PRODUCT_MARKUP),
+    'back_to_master': Back(1),
+    'back_to_date': Back(2),
+    'back_to_shift': Back(3),
+    'back_to_product': Back(4),
+    'back_to_comment': Back(5),
+    'новая': NewEntry(),
+    'пакет_завершить': FinishBatch(),
+    'пакет_убрать': UndoBatchEntry()
+}
+CALLBACKS.update({
+    f"name_{idx}": Choice(lambda name=name: {'наименование': name}, "Наименование", 'наименование', 5)
+    for idx, name in enumerate(PRODUCT_NAMES)
+})
+
+# Сколько последних записей смены показывать в сводке
+BATCH_SUMMARY_ENTRIES = 15
+
+def batch_summary(user_data):
+    """Сводка записей смены при пакетном вводе"""
+    entries = user_data.get('записи', [])
+    lines = [
+        f"📋 Смена {user_data.get('дата', '')} {SHIFT_ICONS.get(user_data.get('смена'), '')} "
+        f"{user_data.get('смена', '')}, мастер {user_data.get('Мастер', '')}"
+    ]
+    hidden = len(entries) - BATCH_SUMMARY_ENTRIES
+    if hidden > 0:
+        lines.append(f"… и еще {hidden}")
+    for number, entry in enumerate(entries[-BATCH_SUMMARY_ENTRIES:], start=max(hidden, 0) + 1):
+        line = f"{number}. {entry['наименование']} — 📷 {entry['фото']}"
+        if entry['комментарий']:
+            line += f", {entry['комментарий']}"
+        lines.append(line)
+    lines.append(f"Записей: {len(entries)}, фото: {sum(entry['фото'] for entry in entries)}")
+    return "\n".join(lines)
+
+async def reset_conversation(user_data):
+    """Начать запись заново; открытая смена при этом выгружается
+
+    Возвращает итог выгруженной смены или None.
+    """
+    closed = None
+    if user_data.get('пакет') and user_data.get('записи'):
+        await outbox.release(user_data['пакет'])
+        closed = f"✅ Смена сохранена\n\n{batch_summary(user_data)}"
+    user_data.clear()
+    user_data['этап'] = 1
+    return closed
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка команд /start и /new"""
+    closed = await reset_conversation(context.user_data)
+    if closed:
+        await update.message.reply_text(closed)
+    await update.message.reply_text(
+        STAGES[1].prompt,
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+async def start_shift(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /shift: ввод всей смены — мастер, дата и смена один раз, затем продукты"""
+    closed = await reset_conversation(context.user_data)
+    if closed:
+        await update.message.reply_text(closed)
+    context.user_data['пакет'] = uuid.uuid4().hex
+    context.user_data['записи'] = []
+    await update.message.reply_text(
+        "📋 Ввод смены: мастер, дата и смена указываются один раз, затем для каждого "
+        "продукта — наименование, комментарий и фото. Записи выгружаются в таблицу "
+        "вместе после «✅ Завершить смену»\n\n"
+        f"{STAGES[1].prompt}",
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+SHIFT_ICONS = {'День': '🌞', 'Ночь': '🌙'}
+
+def managers_only(handler):
+    """Команда только для пользователей и чатов из MANAGER_IDS"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user, chat = update.effective_user, update.effective_chat
+        if (user is not None and user.id in MANAGER_IDS) or (chat is not None and chat.id in MANAGER_IDS):
+            return await handler(update, context)
+        logger.warning(
+            f"⚠️ Отказано в доступе к {handler.__name__}: "
+            f"пользователь {user.id if user else '-'}, чат {chat.id if chat else '-'}"
+        )
+        await update.effective_message.reply_text("⛔ Команда доступна только менеджерам")
+    return wrapper
+
+def report_period(args):
+    """Период отчета из аргументов команды: нет — сегодня, одна дата или две"""
+    dates = [datetime.datetime.strptime(arg, "%d.%m.%Y").date() for arg in args[:2]]
+    if not dates:
+        dates = [datetime.date.today()]
+    return min(dates), max(dates)
+
+def format_period(start_date, end_date):
+    """Период для сообщений: одна дата или диапазон"""
+    period = start_date.strftime("%d.%m.%Y")
+    if end_date != start_date:
+        period += f" – {end_date.strftime('%d.%m.%Y')}"
+    return period
+
+def format_date(value):
+    """ДД.ММ.ГГГГ из даты ISO"""
+    return datetime.date.fromisoformat(value).strftime("%d.%m.%Y")
+
+@managers_only
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /report [ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]]: записи за период из локального индекса"""
+    try:
+        start_date, end_date = report_period(context.args or [])
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Формат: /report [ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]]\n"
+            "Без даты — отчет за сегодня"
+        )
+        return
+
+    data = await journal_index.report(start_date, end_date)
+    period = format_period(start_date, end_date)
+    if not data['total']:
+        await update.message.reply_text(f"📊 {period}: записей нет")
+        return
+
+    lines = [f"📊 Отчет за {period}", f"Всего записей: {data['total']}"]
+    shift = None
+    for row_shift, product, count in data['by_shift']:
+        if row_shift != shift:
+            shift = row_shift
+            shift_total = sum(c for s, _, c in data['by_shift'] if s == shift)
+            lines.append(f"\n{SHIFT_ICONS.get(shift, '🕒')} {shift}: {shift_total}")
+        lines.append(f"  • {product} — {count}")
+    lines.append("\n👨‍🍳 По мастерам:")
+    lines.extend(f"  • {master} — {count}" for master, count in data['by_master'])
+    await update.message.reply_text("\n".join(lines))
+
+export_limit = asyncio.Semaphore(EXPORT_CONCURRENCY)
+
+@managers_only
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export [ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]]: журнал за период файлом Excel"""
+    try:
+        start_date, end_date = report_period(context.args or [])
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Формат: /export [ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]]\n"
+            "Без даты — записи за сегодня"
+        )
+        return
+
+    period = format_period(start_date, end_date)
+    await update.message.reply_text(f"⏳ Готовлю файл за {period}...")
+
+    stem = os.path.splitext(EXCEL_FILE)[0]
+    filename = f"{stem}_{start_date:%d.%m.%Y}"
+    if end_date != start_date:
+        filename += f"-{end_date:%d.%m.%Y}"
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        async with export_limit:
+            count = await journal_index.export_xlsx(start_date, end_date, path)
+        logger.info(
+            f"✅ Выгрузка Excel за {period}: строк {count}, "
+            f"{os.path.getsize(path) // 1024} КБ, за {(time.perf_counter() - started) * 1000:.0f} мс"
+        )
+        if not count:
+            await update.message.reply_text(f"📄 {period}: записей нет")
+            return
+        with open(path, 'rb') as document:
+            await update.message.reply_document(
+                document=document,
+                filename=f"{filename}.xlsx",
+                caption=f"📄 Журнал за {period}: записей {count}",
+                write_timeout=120
+            )
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА выгрузки Excel: {e}")
+        await update.message.reply_text("❌ Не удалось подготовить файл. Попробуйте позже")
+    finally:
+        os.unlink(path)
+
+@managers_only
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats: сводка за последние 7 дней из локального индекса"""
+    data = await journal_index.stats()
+    lines = [f"📈 Всего записей в журнале: {data['total']}", "\nЗа 7 дней:"]
+    by_day = {}
+    for date, shift, count in data['by_day']:
+        by_day.setdefault(date, []).append(f"{SHIFT_ICONS.get(shift, '🕒')} {count}")
+    if by_day:
+        lines.extend(f"  {format_date(date)}: {' '.join(counts)}" for date, counts in by_day.items())
+    else:
+        lines.append("  записей нет")
+    if data['top_products']:
+        lines.append("\n🏷 Чаще всего:")
+        lines.extend(f"  • {product} — {count}" for product, count in data['top_products'])
+    if journal_index.reconciled_at is not None:
+        lines.append(f"\nСверка с таблицей: {journal_index.reconciled_at.strftime('%d.%m.%Y %H:%M')}")
+    await update.message.reply_text("\n".join(lines))
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка текстовых сообщений по таблице этапов"""
+    user_data = context.user_data
+    stage = STAGES.get(user_data.get('этап'))
+    if stage is None:
+        await update.message.reply_text("❌ Начните с команды /start")
+        return
+
+    text_input = stage.text
+    if text_input is None or (text_input.requires and not user_data.get(text_input.requires)):
+        return
+
+    try:
+        fields = text_input.parse(update.message.text.strip())
+    except ValueError:
+        await update.message.reply_text(text_input.error)
+        return
+
+    user_data.update(fields)
+    next_stage = enter_stage(user_data, text_input.next)
+    await update.message.reply_text(
+        next_stage.prompt,
+        reply_markup=next_stage.markup
+    )
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка нажатий кнопок по таблице CALLBACKS"""
+    query = update.callback_query
+    await query.answer()
+
+    action = CALLBACKS.get(query.data)
+    if action is not None:
+        await action.apply(query, context)
+
+async def prepare_entry_photo(photo_sizes, entry_id, position=0):
+    """Скачивание и подготовка одного фото записи; возвращает EntryPhoto"""
+    # Скачивание фото: самый маленький подходящий размер
+    photo_size = pick_photo_size(photo_sizes)
+    photo_keys = [telegram_photo_key(photo_size)]
+
+    # Повторно отправленное фото уже есть на Drive
+    drive_file_id = await photo_cache.get(*photo_keys)
+    if UPLOAD_IN_WORKERS:
+        # Фото скачивает и обрабатывает воркер, в очередь идет только ссылка на файл
+        check_photo_size(photo_size)
+        return EntryPhoto(b'', photo_keys, drive_file_id, {
+            'file_id': photo_size.file_id,
+            'fits': photo_fits(photo_size)
+        })
+    if drive_file_id is None:
+        with metrics.timer('journal_stage_seconds', stage='download'):
+            raw_bytes = await download_photo(photo_size)
+        photo_keys.append(content_photo_key(raw_bytes))
+        drive_file_id = await photo_cache.get(photo_keys[-1])
+
+    if drive_file_id is not None:
+        logger.info(f"✅ Фото уже загружено на Drive: {drive_file_id}")
+        return EntryPhoto(b'', photo_keys, drive_file_id)
+
+    # Обработка изображения в пуле процессов, без промежуточных файлов
+    photo_bytes = await encode_photo(raw_bytes, photo_fits(photo_size))
+    with metrics.timer('journal_stage_seconds', stage='local_save'):
+        await photo_store.save(entry_id, photo_bytes, position)
+    return EntryPhoto(photo_bytes, photo_keys)
+
+async def save_entry(message, user_data, photos, entry_id, note=''):
+    """Сохранение записи с фото в outbox и ответ пользователю"""
+    entry = {
+        'Мастер': user_data['Мастер'],
+        'дата': user_data['date_obj'].strftime("%d.%m.%Y"),
+        'смена': user_data['смена'],
+        'наименование': user_data['наименование'],
+        'комментарий': user_data.get('комментарий', '')
+    }
+
+    # Запись сохраняется локально и выгружается в Google в фоне
+    batch_id = user_data.get('пакет')
+    try:
+        with metrics.timer('journal_stage_seconds', stage='outbox_put'):
+            await outbox.put(message.chat_id, entry, photos, entry_id, batch_id, notify=UPLOAD_IN_WORKERS)
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА outbox: {e}")
+        await message.reply_text("❌ Ошибка сохранения\nОтправьте фото еще раз")
+        return
+
+    if batch_id:
+        # Ввод смены: мастер, дата и смена остаются, следующий продукт
+        user_data['записи'].append({
+            'id': entry_id,
+            'наименование': entry['наименование'],
+            'комментарий': entry['комментарий'],
+            'фото': len(photos)
+        })
+        user_data.pop('наименование', None)
+        user_data.pop('комментарий', None)
+        stage = enter_stage(user_data, 4)
+        await message.reply_text(
+            f"✅ Добавлено в смену\n{note}\n{batch_summary(user_data)}\n\n{stage.prompt}",
+            reply_markup=stage.markup
+        )
+        return
+
+    msg = (
+        "✅ Данные сохранены!\n"
+        f"📅 Дата: {user_data['дата']}\n"
+        f"👨‍🍳 Мастер: {user_data['Мастер']}\n"
+        f"🌃 Смена: {user_data['смена']}\n"
+        f"🏷 Наименование: {user_data['наименование']}\n"
+        f"💬 Комментарий: {user_data.get('комментарий', 'нет')}\n"
+    )
+    if len(photos) > 1:
+        msg += f"📷 Фото: {len(photos)}\n"
+    if UPLOAD_IN_WORKERS:
+        msg += "☁️ О выгрузке в таблицу придет отдельное сообщение\n"
+    msg += f"{note}\nДобавить новую запись?"
+
+    # Réinitialisation de l'état de l'utilisateur
+    user_data.clear()
+    user_data['этап'] = 1
+
+    await message.reply_text(
+        msg,
+        reply_markup=NEW_ENTRY_MARKUP
+    )
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка фото"""
+    # Фото альбома приходят отдельными обновлениями и собираются в одну запись
+    if update.message.media_group_id:
+        album_buffer.add(update.message, context)
+        return
+
+    user_data = context.user_data
+    if user_data.get('этап') != 6:
+        await update.message.reply_text("❌ Начните с команды /start")
+        return
+
+    try:
+        entry_id = uuid.uuid4().hex
+        try:
+            photo = await prepare_entry_photo(update.message.photo, entry_id)
+        except PhotoTooLargeError as e:
+            logger.warning(f"⚠️ Фото слишком большое: {e}")
+            await update.message.reply_text("❌ Фото слишком большое. Отправьте другое фото")
+            return
+
+        await save_entry(update.message, user_data, [photo], entry_id)
+
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА фото: {e}")
+        await update.message.reply_text(
+            "❌ Ошибка. Попробуйте снова.\n"
+            "Начните с /start"
+        )
+
+async def handle_album(messages, context):
+    """Обработка альбома: фото готовятся параллельно и сохраняются одной записью"""
+    messages.sort(key=lambda message: message.message_id)
+    # Следующие сообщения чата обрабатываются после сохранения альбома
+    async with context.application.update_processor.chat_turn(messages[0].chat_id):
+        await _handle_album(messages, context)
+
+async def _handle_album(messages, context):
+    message = messages[0]
+    user_data = context.user_data
+    if user_data.get('этап') != 6:
+        await message.reply_text("❌ Начните с команды /start")
+        return
+
+    try:
+        entry_id = uuid.uuid4().hex
+        results = await asyncio.gather(
+            *[
+                prepare_entry_photo(album_message.photo, entry_id, position)
+                for position, album_message in enumerate(messages)
+            ],
+            return_exceptions=True
+        )
+        photos, too_large = [], 0
+        for result in results:
+            if isinstance(result, PhotoTooLargeError):
+                logger.warning(f"⚠️ Фото альбома слишком большое: {result}")
+                too_large += 1
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                photos.append(result)
+
+        if not photos:
+            await message.reply_text("❌ Фото слишком большие. Отправьте другие фото")
+            return
+        note = f"⚠️ Пропущено больших фото: {too_large}\n" if too_large else ''
+        await save_entry(message, user_data, photos, entry_id, note)
+
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА альбома: {e}")
+        await message.reply_text(
+            "❌ Ошибка. Попробуйте снова.\n"
+            "Начните с /start"
+        )
+    finally:
+        # Обработка идет вне обработчика обновления: user_data сохраняется явно
+        if message.from_user is not None:
+            context.application.mark_data_for_update_persistence(user_ids=message.from_user.id)
+
+class AlbumBuffer:
+    """Сбор фото одного альбома (media_group_id)
+
+    Telegram присылает каждое фото альбома отдельным обновлением. Фото
+    копятся, пока новые приходят чаще, чем раз в window секунд (или пока
+    их не станет ALBUM_MAX_PHOTOS), затем альбом обрабатывается отдельной
+    задачей, чтобы не задерживать очередь обновлений чата.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._albums = {}
+        self._tasks = set()
+
+    def add(self, message, context):
+        key = (message.chat_id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = {'messages': [], 'context': context, 'timer': None}
+        else:
+            album['timer'].cancel()
+        album['messages'].append(message)
+        if len(album['messages']) >= ALBUM_MAX_PHOTOS:
+            self._flush(key)
+        else:
+            album['timer'] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        album = self._albums.pop(key)
+        task = asyncio.create_task(handle_album(album['messages'], album['context']))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Остановка: собранные альбомы обрабатываются сразу, не дожидаясь окна"""
+        for key, album in list(self._albums.items()):
+            album['timer'].cancel()
+            self._flush(key)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+album_buffer = AlbumBuffer(ALBUM_WINDOW)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений: разные чаты — одновременно,
+    обновления одного чата — строго по очереди (этапы не перемешиваются)
+    """
+
+    def __init__(self, max_running, queue_limit, stats_interval):
+        super().__init__(max_concurrent_updates=queue_limit)
+        self.max_running = max_running
+        self.stats_interval = stats_interval
+        self._running = asyncio.Semaphore(max_running)
+        self._chats = {}
+        self._stats_task = None
+        self.waiting = 0
+        self._reset_stats()
+
+    def _reset_stats(self):
+        """Сброс накопленной статистики (текущая очередь не сбрасывается)"""
+        self.peak_waiting = self.waiting
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @staticmethod
+    def _chat_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    @contextlib.asynccontextmanager
+    async def chat_turn(self, key):
+        """Очередь чата: обработка, начатая вне обновления (альбом), тоже ждет ее"""
+        chat = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            async with chat[0]:
+                yield
+        finally:
+            chat[1] -= 1
+            if chat[1] == 0:
+                del self._chats[key]
+
+    async def do_process_update(self, update, coroutine):
+        """Ожидание своей очереди в чате и свободного слота обработки"""
+        queued_at = time.monotonic()
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+
+        async with self.chat_turn(self._chat_key(update)), self._running:
+            waited = time.monotonic() - queued_at
+            self.waiting -= 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.processed += 1
+            await coroutine
+        record_startup('first_update', "Первое обновление обработано")
+
+    def stats(self):
+        """Глубина очереди и время ожидания с последнего сброса"""
+        return {
+            'waiting': self.waiting,
+            'peak_waiting': self.peak_waiting,
+            'active_chats': len(self._chats),
+            'processed': self.processed,
+            'wait_avg': self.wait_total / self.processed if self.processed else 0.0,
+            'wait_max': self.wait_max
+        }
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            stats = self.stats()
+            if stats['processed']:
+                logger.info(
+                    f"📊 Обновления: {stats['processed']}, в очереди: {stats['waiting']} "
+                    f"(пик {stats['peak_waiting']}), ожидание: среднее {stats['wait_avg'] * 1000:.0f} мс, "
+                    f"макс. {stats['wait_max'] * 1000:.0f} мс"
+                )
+                self._reset_stats()
+
+    async def initialize(self):
+        if self.stats_interval > 0:
+            self._stats_task = asyncio.create_task(self._log_stats())
+
+    async def shutdown(self):
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            self._stats_task = None
+
+# Получен SIGTERM/SIGINT: процесс завершает начатую работу и новую не принимает
+shutdown_requested = asyncio.Event()
+
+async def health_check(request):
+    """Endpoint de vérification de santé pour Railway"""
+    if shutdown_requested.is_set():
+        return web.Response(status=503, text="stopping")
+    return web.Response(text="OK")
+
+# Unix-сокеты метрик воркеров выгрузки, запущенных этим процессом
+worker_metrics_sockets = []
+
+async def fetch_worker_metrics(index, path):
+    """snapshot() воркера выгрузки index или None, если воркер не отвечает"""
+    try:
+        async with aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=path),
+            timeout=aiohttp.ClientTimeout(total=2)
+        ) as session:
+            async with session.get('http://worker/metrics/snapshot') as response:
+                return ((('worker', index),), await response.json())
+    except Exception as e:
+        logger.warning(f"⚠️ Метрики воркера выгрузки {index} недоступны: {e}")
+        return None
+
+async def collect_worker_metrics():
+    """Метрики воркеров выгрузки с меткой worker; недоступный воркер пропускается"""
+    remote = await asyncio.gather(*(
+        fetch_worker_metrics(index, path) for index, path in enumerate(worker_metrics_sockets)
+    ))
+    return [snapshot for snapshot in remote if snapshot is not None]
+
+async def metrics_snapshot_endpoint(request):
+    """Метрики процесса в JSON для сбора ботом"""
+    return web.json_response(metrics.snapshot())
+
+async def metrics_endpoint(request):
+    """Метрики в текстовом формате Prometheus, вместе с метриками воркеров выгрузки"""
+    return web.Response(
+        text=metrics.render(await collect_worker_metrics()),
+        content_type='text/plain',
+        headers={'X-Content-Type-Options': 'nosniff'}
+    )
+
+def register_application_metrics(application):
+    """Показатели, которые читаются из состояния приложения при запросе /metrics"""
+
+    def conversations():
+        counts = {}
+        for user_data in application.user_data.values():
+            stage = user_data.get('этап')
+            if stage is not None:
+                counts[stage] = counts.get(stage, 0) + 1
+        return {(('stage', stage),): count for stage, count in counts.items()}
+
+    metrics.gauge('journal_conversations', conversations)
+    if isinstance(application.update_processor, ChatOrderedUpdateProcessor):
+        metrics.gauge(
+            'journal_updates_waiting',
+            lambda: {(): application.update_processor.waiting}
+        )
+
+async def telegram_webhook(request):
+    """Прием обновлений Telegram в режиме webhook"""
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secrets.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+
+    # Во время остановки Telegram доставит обновление повторно, уже новому процессу
+    if shutdown_requested.is_set():
+        return web.Response(status=503)
+
+    application = request.app['application']
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА webhook: {e}")
+        return web.Response(status=400)
+
+    await application.update_queue.put(update)
+    return web.Response(text="OK")
+
+def create_web_app(application, webhook=False):
+    """Веб-сервер: /health, /metrics и, в режиме webhook, прием обновлений Telegram"""
+    app = web.Application()
+    app['application'] = application
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_get('/metrics/snapshot', metrics_snapshot_endpoint)
+    if webhook:
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return app
+
+async def start_web_server(app, path=None):
+    """Запуск веб-сервера на PORT или на unix-сокете path"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    if path is not None:
+        await web.UnixSite(runner, path).start()
+        logger.info(f"✅ Serveur web démarré sur {path}")
+    else:
+        await web.TCPSite(runner, '0.0.0.0', PORT).start()
+        logger.info(f"✅ Serveur web démarré sur le port {PORT}")
+    return runner
+
+async def start_webhook(application):
+    """Регистрация webhook в Telegram; False, если нужно перейти на polling"""
+    if not WEBHOOK_URL:
+        logger.warning("⚠️ WEBHOOK_URL не задан, используется polling")
+        return False
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+            secret_token=WEBHOOK_SECRET
+        )
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА установки webhook, используется polling: {e}")
+        return False
+    logger.info(f"✅ Webhook установлен: {WEBHOOK_URL + WEBHOOK_PATH}")
+    return True
+
+def build_application():
+    """Создание приложения Telegram со всеми обработчиками"""
+    # Обновления разных чатов обрабатываются параллельно, одного чата — по порядку
+    update_processor = ChatOrderedUpdateProcessor(
+        UPDATE_CONCURRENCY,
+        UPDATE_QUEUE_LIMIT,
+        UPDATE_STATS_INTERVAL
+    )
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(update_processor)
+        .persistence(SQLitePersistence(OUTBOX_DB, PERSISTENCE_INTERVAL))
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if TELEGRAM_FILE_URL:
+        builder = builder.base_file_url(TELEGRAM_FILE_URL)
+    application = builder.build()
+
+    # Ajout des gestionnaires
+    logger.info("Configuration des gestionnaires...")
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("new", start))
+    application.add_handler(CommandHandler("shift", start_shift))
+    application.add_handler(CommandHandler("report", report))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("export", export))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    register_application_metrics(application)
+    return application
+
+def validate_config():
+    """Проверка обязательных настроек при запуске; False, если бот не может работать"""
+    global MANAGER_IDS
+    logger.info("Vérification des variables d'environnement...")
+    ok = True
+    for name, value in (
+        ("TELEGRAM_TOKEN", TOKEN),
+        ("GOOGLE_SHEET_ID", SPREADSHEET_ID),
+        ("GOOGLE_DRIVE_FOLDER_ID", GOOGLE_DRIVE_FOLDER_ID),
+        ("GOOGLE_CREDS_JSON", GOOGLE_CREDS_JSON)
+    ):
+        logger.info(f"{name}: {'présent' if value else 'absent'}")
+        if not value:
+            logger.error(f"❌ {name} manquant")
+            ok = False
+
+    # Формат учетных данных проверяется сразу, сами клиенты Google создаются в фоне
+    if GOOGLE_CREDS_JSON:
+        try:
+            info = json.loads(GOOGLE_CREDS_JSON)
+            missing = [key for key in ('client_email', 'private_key', 'token_uri') if not info.get(key)]
+            if missing:
+                raise ValueError(f"нет полей {missing}")
+        except (ValueError, AttributeError) as e:
+            logger.error(f"❌ ОШИБКА при загрузке учетных данных Google: {e}")
+            ok = False
+
+    try:
+        MANAGER_IDS = frozenset(
+            int(value) for value in re.split(r'[\s,]+', os.getenv('MANAGER_IDS', '')) if value
+        )
+    except ValueError:
+        logger.error("❌ MANAGER_IDS: нужны числовые ID пользователей или чатов через запятую")
+        ok = False
+    else:
+        if not MANAGER_IDS:
+            logger.warning("⚠️ MANAGER_IDS не задан: /report, /stats и /export недоступны")
+
+    # Файловая система контейнера Railway сбрасывается при каждом деплое:
+    # очередь и фото, не выгруженные до остановки, сохраняются только на томе
+    if os.getenv('RAILWAY_ENVIRONMENT'):
+        volume = os.path.abspath(os.getenv('RAILWAY_VOLUME_MOUNT_PATH') or '/nonexistent')
+        for name, path in (("OUTBOX_DB", OUTBOX_DB), ("PHOTOS_DIR", PHOTOS_DIR)):
+            if os.path.commonpath([os.path.abspath(path), volume]) != volume:
+                logger.warning(
+                    f"⚠️ {name}={path} не на томе Railway: записи, не выгруженные до перезапуска, "
+                    f"будут потеряны. Подключите том и укажите путь на нем"
+                )
+
+    if not ok:
+        logger.error("Проверьте переменные окружения в Railway")
+    return ok
+
+# Этапы запуска: секунды от BOOT_STARTED
+startup_times = {}
+metrics.describe('journal_startup_seconds', 'gauge', 'Время от запуска процесса до этапа готовности')
+metrics.gauge(
+    'journal_startup_seconds',
+    lambda: {(('phase', phase),): seconds for phase, seconds in startup_times.items()}
+)
+
+def record_startup(phase, description):
+    """Запомнить время этапа запуска (только первый раз)"""
+    if phase not in startup_times:
+        startup_times[phase] = time.monotonic() - BOOT_STARTED
+        logger.info(f"⏱ {description} через {startup_times[phase] * 1000:.0f} мс после запуска")
+
+async def warm_up(images=True):
+    """Фоновая подготовка: пул обработки фото, клиенты Google, проверки таблицы и папки"""
+    if images:
+        await asyncio.to_thread(warm_image_pool)
+
+    # Клиенты Google создаются один раз и используются всеми записями
+    if await google_ready():
+        logger.info("✅ Clients Google initialisés")
+        try:
+            await ensure_sheet_layout(google_services['sheets'])
+            logger.info("✅ Structure de la feuille vérifiée")
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА проверки заголовков Sheets: {e}")
+        try:
+            if await detect_drive_public_mode(google_services['drive']):
+                logger.info("✅ Dossier Drive public: les photos héritent de l'accès")
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА проверки доступа к папке Drive: {e}")
+    record_startup('warm', "Прогрев завершен")
+
+async def start_background_work(tasks, application):
+    """Запуск фоновой работы после того, как бот начал принимать обновления"""
+    if UPLOAD_IN_WORKERS:
+        # Фото сохраняют и выгружают воркеры: индекс фото строится заново перед каждой очисткой
+        tasks.append(asyncio.create_task(
+            photo_store.sweeper(LOCAL_PHOTOS_SWEEP_INTERVAL, outbox.pending_ids)
+        ))
+        worker_metrics_sockets[:] = [worker_metrics_socket(index) for index in range(UPLOAD_WORKERS)]
+        tasks.extend(
+            asyncio.create_task(run_upload_worker(index), name=f'upload-worker-{index}')
+            for index in range(UPLOAD_WORKERS)
+        )
+        await warm_up(images=False)
+    else:
+        # Индекс локальных фото строится до выгрузки, чтобы не пропустить подтверждения
+        try:
+            await photo_store.load(await outbox.pending_ids())
+        except Exception as e:
+            logger.error(f"❌ ОШИБКА индекса локальных фото: {e}")
+        tasks.append(asyncio.create_task(photo_store.sweeper(LOCAL_PHOTOS_SWEEP_INTERVAL)))
+
+        await warm_up()
+
+        # Выгрузка локальной очереди записей в Google
+        tasks.append(asyncio.create_task(outbox.drain(application.bot)))
+
+    # Сверка локального индекса журнала с таблицей
+    if JOURNAL_RECONCILE_INTERVAL > 0:
+        tasks.append(asyncio.create_task(journal_index.reconciler(JOURNAL_RECONCILE_INTERVAL)))
+
+def worker_metrics_socket(index):
+    """Путь unix-сокета метрик воркера index"""
+    return os.path.join(tempfile.gettempdir(), f"journal-worker-{os.getpid()}-{index}.sock")
+
+def upload_worker_env(index):
+    """Окружение воркера, запущенного ботом: квоты Google и ядра делятся между воркерами.
+    TCP-порта у воркера нет, метрики бот забирает через unix-сокет"""
+    env = dict(
+        os.environ, BOT_ROLE='worker', UPLOAD_WORKERS='0', PORT='0',
+        WORKER_METRICS_SOCKET=worker_metrics_socket(index)
+    )
+    env.setdefault('IMAGE_WORKERS', str(max(1, IMAGE_WORKERS // UPLOAD_WORKERS)))
+    for name, value in (
+        ('GOOGLE_DRIVE_RATE', GOOGLE_DRIVE_RATE),
+        ('GOOGLE_DRIVE_BURST', GOOGLE_DRIVE_BURST),
+        ('GOOGLE_SHEETS_RATE', GOOGLE_SHEETS_RATE),
+        ('GOOGLE_SHEETS_BURST', GOOGLE_SHEETS_BURST)
+    ):
+        env[name] = str(value / UPLOAD_WORKERS)
+    return env
+
+async def run_upload_worker(index):
+    """Процесс-воркер, запущенный ботом; перезапускается, если завершился"""
+    while True:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), 'worker', env=upload_worker_env(index)
+        )
+        logger.info(f"✅ Воркер выгрузки {index} запущен (pid {process.pid})")
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                # Воркер сам дожидается начатых выгрузок не дольше SHUTDOWN_TIMEOUT
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), SHUTDOWN_TIMEOUT + 5)
+                except asyncio.TimeoutError:
+                    logger.error(f"❌ Воркер выгрузки {index} не остановился, завершаем принудительно")
+                    process.kill()
+                    await process.wait()
+            raise
+        logger.error(f"❌ Воркер выгрузки {index} завершился с кодом {code}, перезапуск через 5 с")
+        await asyncio.sleep(5)
+
+def install_shutdown_handlers():
+    """SIGTERM (перезапуск на Railway) и SIGINT запускают плавную остановку"""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, shutdown_requested.set)
+
+async def report_shutdown(started, interrupted):
+    """Итог остановки в лог: время, прерванные выгрузки и записи, оставшиеся в outbox"""
+    try:
+        left = len(await outbox.pending_ids())
+    except Exception as e:
+        logger.error(f"❌ ОШИБКА чтения outbox при остановке: {e}")
+        left = '?'
+    logger.info(
+        f"⏱ Остановка за {time.perf_counter() - started:.1f} с: "
+        f"прервано выгрузок {interrupted}, записей в outbox до следующего запуска {left}"
+    )
+
+async def finish_updates(application):
+    """Обработка уже полученных обновлений и собранных альбомов"""
+    await application.stop()
+    await album_buffer.close()
+
+async def stop_gracefully(application, background_tasks):
+    """Остановка по сигналу: новые обновления не принимаются, начатые обработка
+    фото и записи в Google завершаются не дольше SHUTDOWN_TIMEOUT, остальное
+    остается в outbox и выгрузится после следующего запуска
+    """
+    started = time.perf_counter()
+    deadline = started + SHUTDOWN_TIMEOUT
+    logger.info(f"Arrêt demandé: fin des traitements en cours (au plus {SHUTDOWN_TIMEOUT:.0f} s)")
+    if application.updater.running:
+        await application.updater.stop()
+
+    # Фоновые задачи останавливаются сразу: выгрузка перестает брать новые записи
+    # (прогрев, не успевший ее запустить, тоже прерывается), а воркеры выгрузки
+    # получают SIGTERM и завершаются параллельно с ботом
+    workers = [task for task in background_tasks if task.get_name().startswith('upload-worker')]
+    for task in background_tasks:
+        task.cancel()
+
+    updates = asyncio.create_task(finish_updates(application))
+    await asyncio.wait([updates], timeout=max(0.0, deadline - time.perf_counter()))
+    if not updates.done():
+        updates.cancel()
+        await asyncio.gather(updates, return_exceptions=True)
+        logger.warning(f"⚠️ Обработка обновлений не завершилась за {SHUTDOWN_TIMEOUT:.0f} с")
+        # application.stop() прерван до сохранения диалогов
+        await application.update_persistence()
+    elif updates.exception() is not None:
+        logger.error(f"❌ ОШИБКА остановки обработки обновлений: {updates.exception()}")
+
+    interrupted = await outbox.finish(deadline - time.perf_counter())
+    await asyncio.gather(*workers, return_exceptions=True)
+    await report_shutdown(started, interrupted)
+
+async def run_worker():
+    """Процесс-воркер: скачивание и обработка фото, выгрузка записей из общей очереди"""
+    logger.info(f"Démarrage du worker de téléversement (pid {os.getpid()})...")
+    telegram_urls = {}
+    if TELEGRAM_API_URL:
+        telegram_urls['base_url'] = TELEGRAM_API_URL
+    if TELEGRAM_FILE_URL:
+        telegram_urls['base_file_url'] = TELEGRAM_FILE_URL
+    bot = Bot(TOKEN, **telegram_urls)
+
+    background_tasks = []
+    web_runner = None
+    metrics_runner = None
+    install_shutdown_handlers()
+    try:
+        await bot.initialize()
+        background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+        # Отдельный сервис: /health и /metrics на своем PORT; воркер бота — метрики
+        # для бота на unix-сокете
+        if PORT:
+            web_runner = await start_web_server(create_web_app(None))
+        if WORKER_METRICS_SOCKET:
+            metrics_runner = await start_web_server(create_web_app(None), WORKER_METRICS_SOCKET)
+        record_startup('ready', "Воркер запущен")
+
+        async def work():
+            await warm_up()
+            await outbox.drain(bot, OUTBOX_POLL_INTERVAL)
+
+        # SIGTERM от бота или платформы (в том числе во время прогрева): начатые
+        # выгрузки завершаются, затем выход через finally, чтобы остановить пул
+        # обработки фото (иначе его процессы остаются после воркера)
+        drain_task = asyncio.create_task(work())
+        background_tasks.append(drain_task)
+        await asyncio.wait(
+            [drain_task, asyncio.create_task(shutdown_requested.wait())],
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        if drain_task.done():
+            drain_task.result()
+        logger.info("Arrêt du worker de téléversement")
+        started = time.perf_counter()
+        drain_task.cancel()
+        interrupted = await outbox.finish(SHUTDOWN_TIMEOUT)
+        await report_shutdown(started, interrupted)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await outbox.cancel()
+        await outbox.release_leases()
+        await sheets_queue.close()
+        await drive_permission_queue.close()
+        if _http_session is not None:
+            await _http_session.close()
+        if web_runner is not None:
+            await web_runner.cleanup()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+            with contextlib.suppress(OSError):
+                os.unlink(WORKER_METRICS_SOCKET)
+        await bot.shutdown()
+
+async def main(role=BOT_ROLE):
+    """Fonction principale de démarrage du bot"""
+    # Vérification des variables d'environnement
+    if not validate_config():
+        sys.exit(1)
+    logger.info("✅ Variables d'environnement OK")
+    open_storage()
+
+    if role == 'worker':
+        await run_worker()
+        return
+    logger.info("Initialisation de l'application...")
+
+    # Initialisation de l'application
+    application = build_application()
+    logger.info("✅ Configuration terminée")
+    logger.info("Démarrage du bot...")
+
+    background_tasks = []
+    web_runner = None
+    # Un signal reçu pendant le démarrage est traité une fois le bot lancé
+    install_shutdown_handlers()
+
+    try:
+        # Démarrage du bot avec gestion des erreurs
+        await application.initialize()
+        await application.start()
+        background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+
+        # Webhook и /health обслуживаются одним веб-сервером на PORT
+        use_webhook = BOT_MODE == 'webhook' and await start_webhook(application)
+        web_runner = await start_web_server(create_web_app(application, webhook=use_webhook))
+
+        if not use_webhook:
+            # Configuration du polling
+            await application.updater.start_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False
+            )
+        record_startup('ready', "Бот принимает обновления")
+
+        # Пул фото, клиенты Google и выгрузка записей готовятся в фоне
+        background_tasks.append(asyncio.create_task(start_background_work(background_tasks, application)))
+
+        # Attente du signal d'arrêt (SIGTERM lors d'un redéploiement, Ctrl+C)
+        await shutdown_requested.wait()
+        await stop_gracefully(application, background_tasks)
+
     except Exception as e:
         logger.error(f"❌ Erreur lors de l'exécution du bot: {str(e)}")
     finally:
         # Arrêt propre de l'application
         try:
-            await application.updater.stop()
-            await application.stop()
+            for task in background_tasks:
+                task.cancel()
+            await sheets_queue.close()
+            await drive_permission_queue.close()
+            if _http_session is not None:
+                await _http_session.close()
+            if web_runner is not None:
+                await web_runner.cleanup()
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
             await application.shutdown()
         except Exception as e:
             logger.error(f"❌ Erreur lors de l'arrêt du bot: {str(e)}")
 
-def run_bot():
-    """Fonction pour exécuter le bot"""
+def run_bot(role=BOT_ROLE):
+    """Fonction pour exécuter le bot (ou un worker de téléversement)"""
     try:
         # Création d'une nouvelle boucle d'événements
         loop = asyncio.get_event_loop()
         
         try:
             # Exécution de la fonction principale
-            loop.run_until_complete(main())
+            loop.run_until_complete(main(role))
         except KeyboardInterrupt:
             logger.info("Arrêt manuel du bot")
         except asyncio.CancelledError:
@@ -590,10 +3597,16 @@ def run_bot():
         finally:
             # Nettoyage de la boucle d'événements
             try:
+                # Tâches restantes après SHUTDOWN_TIMEOUT: annulées, pas attendues
                 pending = asyncio.all_tasks(loop)
+                for task in pending:
+                    task.cancel()
                 loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
                 loop.run_until_complete(loop.shutdown_asyncgens())
             finally:
+                google_executor.shutdown(wait=True)
+                image_executor.shutdown(wait=True)
+                close_storage()
                 loop.close()
     except Exception as e:
         logger.error(f"❌ Erreur lors de l'exécution du bot: {str(e)}")
@@ -601,4 +3614,5 @@ def run_bot():
 
 if __name__ == '__main__':
     logger.info("🚀 Démarrage du programme...")
-    run_bot()
+    # python journal_bot.py worker — процесс-воркер выгрузки
+    run_bot(sys.argv[1].lower() if len(sys.argv) > 1 else BOT_ROLE)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Тесты альбомов: сбор фото одного media_group_id и сохранение одной записью"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import journal_bot as jb
+
+
+class FakeMessage:
+    def __init__(self, message_id, media_group_id="g", chat_id=1):
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+        self.chat_id = chat_id
+        self.photo = [f"photo-{message_id}"]
+        self.from_user = None
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+@pytest.fixture
+def albums(monkeypatch):
+    handled = []
+
+    async def handle_album(messages, context):
+        handled.append(sorted(message.message_id for message in messages))
+
+    monkeypatch.setattr(jb, "handle_album", handle_album)
+    return handled
+
+
+def test_album_is_flushed_after_window(albums):
+    buffer = jb.AlbumBuffer(0.05)
+
+    async def run():
+        for message_id in (1, 2, 3):
+            buffer.add(FakeMessage(message_id), None)
+            await asyncio.sleep(0.02)
+        buffer.add(FakeMessage(10, media_group_id="other"), None)
+        assert albums == []
+        await asyncio.sleep(0.1)
+        await buffer.close()
+
+    asyncio.run(run())
+    assert sorted(albums) == [[1, 2, 3], [10]]
+
+
+def test_full_album_is_flushed_at_once(albums):
+    buffer = jb.AlbumBuffer(60)
+
+    async def run():
+        for message_id in range(jb.ALBUM_MAX_PHOTOS):
+            buffer.add(FakeMessage(message_id), None)
+        await asyncio.sleep(0)
+        assert len(albums) == 1
+        await buffer.close()
+
+    asyncio.run(run())
+    assert albums == [list(range(jb.ALBUM_MAX_PHOTOS))]
+
+
+def test_close_flushes_collected_albums(albums):
+    buffer = jb.AlbumBuffer(60)
+
+    async def run():
+        buffer.add(FakeMessage(1), None)
+        buffer.add(FakeMessage(2), None)
+        await buffer.close()
+
+    asyncio.run(run())
+    assert albums == [[1, 2]]
+
+
+# Сохранение альбома одной записью
+
+@pytest.fixture
+def saved(monkeypatch):
+    entries = []
+
+    async def prepare_entry_photo(photo_sizes, entry_id, position=0):
+        if photo_sizes[0] == "photo-3":
+            raise jb.PhotoTooLargeError("большое")
+        return jb.EntryPhoto(f"{photo_sizes[0]}@{position}".encode(), [])
+
+    async def save_entry(message, user_data, photos, entry_id, note=""):
+        entries.append((message.message_id, [photo.photo for photo in photos], note))
+
+    monkeypatch.setattr(jb, "prepare_entry_photo", prepare_entry_photo)
+    monkeypatch.setattr(jb, "save_entry", save_entry)
+    return entries
+
+
+class FakeApplication:
+    def __init__(self):
+        self.persisted = []
+
+    def mark_data_for_update_persistence(self, user_ids):
+        self.persisted.append(user_ids)
+
+
+def handle(messages, stage=6):
+    application = FakeApplication()
+    context = SimpleNamespace(user_data={"этап": stage}, application=application)
+
+    async def run():
+        application.update_processor = jb.ChatOrderedUpdateProcessor(4, 100, 60)
+        await jb.handle_album(list(messages), context)
+
+    asyncio.run(run())
+    return application
+
+
+def test_album_photos_are_saved_in_order(saved):
+    first, second = FakeMessage(1), FakeMessage(2)
+    first.from_user = SimpleNamespace(id=7)
+    application = handle([second, first])
+    assert saved == [(1, [b"photo-1@0", b"photo-2@1"], "")]
+    # Альбом обрабатывается вне обработчика обновления: состояние сохраняется явно
+    assert application.persisted == [7]
+
+
+def test_too_large_album_photos_are_skipped(saved):
+    handle([FakeMessage(1), FakeMessage(3)])
+    assert saved == [(1, [b"photo-1@0"], "⚠️ Пропущено больших фото: 1\n")]
+
+
+def test_album_of_only_large_photos_is_not_saved(saved):
+    message = FakeMessage(3)
+    handle([message])
+    assert saved == []
+    assert message.replies == ["❌ Фото слишком большие. Отправьте другие фото"]
+
+
+def test_album_outside_photo_stage_is_refused(saved):
+    message = FakeMessage(1)
+    handle([message], stage=4)
+    assert saved == []
+    assert message.replies == ["❌ Начните с команды /start"]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""Тесты вспомогательных функций нагрузочного теста"""
+
+import math
+
+from bench_bot import percentile
+from bench_images import make_photo
+
+
+def test_percentile_without_interpolation():
+    values = [5, 1, 4, 2, 3]
+    assert percentile(values, 0) == 1
+    assert percentile(values, 50) == 3
+    assert percentile(values, 99) == 5
+    assert math.isnan(percentile([], 50))
+
+
+def test_make_photo_is_jpeg_of_requested_size():
+    from io import BytesIO
+    from PIL import Image as PILImage
+
+    with PILImage.open(BytesIO(make_photo(320, 240))) as img:
+        assert img.format == "JPEG"
+        assert img.size == (320, 240)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Тесты диалога записи: таблица этапов STAGES и кнопки CALLBACKS"""
+
+import asyncio
+from types import SimpleNamespace
+
+import journal_bot as jb
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append(text)
+
+
+class FakeMessage:
+    def __init__(self, text=""):
+        self.text = text
+        self.chat_id = 1
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append(text)
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.message = FakeMessage()
+        self.edits = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append(text)
+
+
+def make_context(**user_data):
+    return SimpleNamespace(user_data=dict(user_data), bot=FakeBot())
+
+
+def press(context, data):
+    query = FakeQuery(data)
+    asyncio.run(jb.handle_callback(SimpleNamespace(callback_query=query), context))
+    return query
+
+
+def send(context, text):
+    message = FakeMessage(text)
+    asyncio.run(jb.handle_message(SimpleNamespace(message=message), context))
+    return message
+
+
+def test_callbacks_lead_to_known_stages():
+    for data, action in jb.CALLBACKS.items():
+        for stage in (getattr(action, "next", None), getattr(action, "stage", None)):
+            assert stage is None or stage in jb.STAGES, data
+    for idx, _ in enumerate(jb.PRODUCT_NAMES):
+        assert f"name_{idx}" in jb.CALLBACKS
+
+
+def test_markups_are_shared():
+    assert jb.enter_stage({}, 4).markup is jb.enter_stage({}, 4).markup is jb.PRODUCT_MARKUP
+
+
+def test_choice_callback_saves_value_and_moves_on():
+    context = make_context(этап=4)
+    query = press(context, "name_0")
+    assert context.user_data["наименование"] == jb.PRODUCT_NAMES[0]
+    assert context.user_data["этап"] == 5
+    assert query.edits == [f"Наименование: {jb.PRODUCT_NAMES[0]}"]
+    assert context.bot.sent == [jb.STAGES[5].prompt]
+
+
+def test_back_callback_returns_to_stage():
+    context = make_context(этап=5, custom_name=True)
+    query = press(context, "back_to_product")
+    assert context.user_data == {"этап": 4}
+    assert query.edits == [jb.STAGES[4].prompt]
+
+
+def test_unknown_callback_is_ignored():
+    context = make_context(этап=3)
+    query = press(context, "нет_такой_кнопки")
+    assert context.user_data == {"этап": 3}
+    assert query.edits == [] and context.bot.sent == []
+
+
+def test_text_input_follows_stage_table():
+    context = make_context(этап=1)
+    assert send(context, " Иванов ").replies == [jb.STAGES[2].prompt]
+    assert context.user_data["Мастер"] == "Иванов"
+    assert context.user_data["этап"] == 2
+
+    # Дата текстом — только после кнопки «ввести дату»
+    assert send(context, "01.10.2026").replies == []
+    press(context, "date_custom")
+    assert send(context, "32.10.2026").replies == [jb.STAGES[2].text.error]
+    assert send(context, "01.10.2026").replies == [jb.STAGES[3].prompt]
+    assert context.user_data["дата"] == "01.10.2026"
+    assert "custom_date" not in context.user_data
+
+
+def test_stage_without_text_input_ignores_text():
+    context = make_context(этап=3)
+    assert send(context, "День").replies == []
+    assert context.user_data == {"этап": 3}
+
+
+def test_text_without_conversation_asks_for_start():
+    assert send(make_context(), "текст").replies == ["❌ Начните с команды /start"]
+
+
+# Ввод смены (/shift): записи копятся в outbox и выгружаются вместе
+
+def shift_command(context):
+    message = FakeMessage()
+    asyncio.run(jb.start_shift(SimpleNamespace(message=message), context))
+    return message
+
+
+def add_product(context, product_index, comment):
+    press(context, f"name_{product_index}")
+    send(context, comment)
+    assert context.user_data["этап"] == 6
+    message = FakeMessage()
+    photo = jb.EntryPhoto(b"jpeg", [])
+    entry_id = f"entry-{len(context.user_data['записи'])}"
+    asyncio.run(jb.save_entry(message, context.user_data, [photo], entry_id))
+    return message
+
+
+def start_batch(storage):
+    context = make_context()
+    shift_command(context)
+    send(context, "Иванов")
+    press(context, "date_today")
+    press(context, "день")
+    return context
+
+
+def test_shift_entries_wait_for_finish(storage):
+    context = start_batch(storage)
+    add_product(context, 0, "первый")
+    reply = add_product(context, 1, "второй").replies[0]
+    assert reply.startswith("✅ Добавлено в смену")
+    # Мастер, дата и смена остаются для следующего продукта
+    assert context.user_data["этап"] == 4
+    assert context.user_data["Мастер"] == "Иванов"
+    assert [entry["id"] for entry in context.user_data["записи"]] == ["entry-0", "entry-1"]
+    assert storage.outbox._claim(10) == []
+
+    query = press(context, "пакет_завершить")
+    assert query.edits[0].startswith("✅ Смена сохранена")
+    assert context.user_data == {"этап": 1}
+    assert sorted(entry["id"] for entry in storage.outbox._claim(10)) == ["entry-0", "entry-1"]
+
+
+def test_undo_removes_last_shift_entry(storage):
+    context = start_batch(storage)
+    add_product(context, 0, "первый")
+    add_product(context, 1, "второй")
+
+    query = press(context, "пакет_убрать")
+    assert query.edits[0].startswith(f"↩️ Убрана запись: {jb.PRODUCT_NAMES[1]}")
+    assert [entry["id"] for entry in context.user_data["записи"]] == ["entry-0"]
+    assert storage.outbox._pending_ids() == ["entry-0"]
+
+
+def test_undo_after_upload_started_keeps_entry(storage, monkeypatch):
+    context = start_batch(storage)
+    add_product(context, 0, "первый")
+    # Брошенная смена: запись уже взята в выгрузку
+    monkeypatch.setattr(jb, "BATCH_MAX_AGE", -60)
+    assert len(storage.outbox._claim(10)) == 1
+
+    query = press(context, "пакет_убрать")
+    assert query.edits[0].startswith("❌ Запись уже выгружена в таблицу")
+    assert len(context.user_data["записи"]) == 1
+    assert storage.outbox._pending_ids() == ["entry-0"]
+
+
+def test_new_shift_releases_previous_one(storage):
+    context = start_batch(storage)
+    add_product(context, 0, "первый")
+    reply = shift_command(context).replies
+    assert reply[0].startswith("✅ Смена сохранена")
+    assert [entry["id"] for entry in storage.outbox._claim(10)] == ["entry-0"]
+
+
+def test_finish_button_outside_shift_keeps_entry(storage):
+    context = make_context(этап=5, Мастер="Иванов", наименование=jb.PRODUCT_NAMES[0])
+    query = press(context, "пакет_завершить")
+    assert query.edits == ["❌ Ввод смены уже завершен. Новая смена — /shift"]
+    assert context.user_data == {"этап": 5, "Мастер": "Иванов", "наименование": jb.PRODUCT_NAMES[0]}
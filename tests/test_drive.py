@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Тесты публикации фото на Drive: пакетная выдача доступа и повтор после ошибки"""
+
+import asyncio
+
+import pytest
+
+import journal_bot as jb
+
+
+class FakeRequest:
+    def __init__(self, drive, file_id):
+        self.drive = drive
+        self.file_id = file_id
+
+    def execute(self, http=None):
+        self.drive.granted.append(self.file_id)
+        if self.file_id in self.drive.failing:
+            raise RuntimeError("отказ Drive")
+        return {"id": "permission"}
+
+
+class FakeBatch:
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.drive.batches.append([request.file_id for _, request in self.requests])
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except RuntimeError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeDrive:
+    """permissions().create и new_batch_http_request, как у клиента Drive"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.granted = []
+        self.batches = []
+
+    def permissions(self):
+        return self
+
+    def create(self, fileId, body, fields=None):
+        assert body == jb.PUBLIC_PERMISSION
+        return FakeRequest(self, fileId)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+@pytest.fixture
+def drive(monkeypatch):
+    fake = FakeDrive()
+    monkeypatch.setitem(jb.google_services, "drive", fake)
+    monkeypatch.setattr(jb, "_execute_google_request", lambda make_request: make_request().execute())
+    return fake
+
+
+def grant_all(queue, file_ids):
+    async def run():
+        return await asyncio.gather(*(queue.grant(file_id) for file_id in file_ids))
+
+    return asyncio.run(run())
+
+
+def test_permissions_are_granted_in_one_batch(drive):
+    drive.failing = {"b"}
+    results = grant_all(jb.DrivePermissionQueue(10, 0.01), ["a", "b", "c"])
+    assert results == [True, False, True]
+    assert drive.batches == [["a", "b", "c"]]
+
+
+def test_full_batch_is_sent_without_waiting(drive):
+    grant_all(jb.DrivePermissionQueue(2, 60), ["a", "b", "c", "d"])
+    assert drive.batches == [["a", "b"], ["c", "d"]]
+
+
+def test_single_permission_skips_batch_wrapper(drive):
+    assert grant_all(jb.DrivePermissionQueue(10, 0.01), ["a"]) == [True]
+    assert drive.granted == ["a"] and drive.batches == []
+
+
+# Повтор выгрузки записи, когда доступ к созданному файлу выдать не удалось
+
+@pytest.fixture
+def google(storage, monkeypatch):
+    """Drive и Sheets для Outbox._commit: создание файлов, выдача доступа и строки"""
+    state = {"created": [], "grants": [], "grant_results": [], "rows": [], "found": None}
+
+    async def drive_create_file(drive_service, body, media_body, fields="id"):
+        state["created"].append(body["name"])
+        return {"id": f"file-{len(state['created'])}"}
+
+    async def drive_find_file(drive_service, name):
+        return state["found"]
+
+    async def grant(file_id):
+        state["grants"].append(file_id)
+        result = state["grant_results"].pop(0) if state["grant_results"] else True
+        if isinstance(result, asyncio.Event):
+            await result.wait()
+            return True
+        return result
+
+    async def save_to_sheets(data, image_urls, check_existing=False):
+        state["rows"].append((image_urls, check_existing))
+        return True
+
+    async def google_ready():
+        return True
+
+    monkeypatch.setitem(jb.google_services, "drive", object())
+    monkeypatch.setattr(jb, "drive_inherits_public", False)
+    monkeypatch.setattr(jb, "drive_create_file", drive_create_file)
+    monkeypatch.setattr(jb, "drive_find_file", drive_find_file)
+    monkeypatch.setattr(jb.drive_permission_queue, "grant", grant)
+    monkeypatch.setattr(jb, "save_to_sheets", save_to_sheets)
+    monkeypatch.setattr(jb, "google_ready", google_ready)
+    return state
+
+
+def process_next(outbox):
+    """Взять запись из очереди и выполнить одну попытку выгрузки"""
+    outbox._db.execute("UPDATE outbox SET next_attempt_at = 0")
+    [entry] = outbox._claim(1)
+    asyncio.run(outbox._process(entry))
+
+
+def stored_file_id(outbox, entry_id):
+    return outbox._db.execute("SELECT drive_file_id FROM outbox WHERE id = ?", (entry_id,)).fetchone()[0]
+
+
+def put_entry(outbox):
+    outbox._put("a", 1, {"id": "a"}, [jb.EntryPhoto(b"jpeg", ["tg:a"])], None, False)
+
+
+def test_failed_grant_is_retried_for_the_same_file(storage, google):
+    outbox = storage.outbox
+    put_entry(outbox)
+    google["grant_results"] = [False]
+
+    process_next(outbox)
+    assert stored_file_id(outbox, "a") == "file-1"
+    assert google["rows"] == []
+    # Файл без доступа не попадает в кеш повторно отправленных фото
+    assert asyncio.run(storage.photo_cache.get("tg:a")) is None
+
+    process_next(outbox)
+    assert google["created"] == ["a.jpg"]
+    assert google["grants"] == ["file-1", "file-1"]
+    assert google["rows"] == [([jb.drive_url("file-1")], True)]
+    assert outbox._pending_ids() == []
+    assert asyncio.run(storage.photo_cache.get("tg:a")) == "file-1"
+
+
+def test_grant_interrupted_by_shutdown_is_retried(storage, google):
+    outbox = storage.outbox
+    put_entry(outbox)
+    google["grant_results"] = [asyncio.Event()]
+
+    async def interrupted():
+        [entry] = outbox._claim(1)
+        task = asyncio.create_task(outbox._process(entry))
+        for _ in range(500):
+            if google["grants"] or task.done():
+                break
+            await asyncio.sleep(0.01)
+        assert google["grants"] and not task.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(interrupted())
+    outbox._release_leases()
+    assert stored_file_id(outbox, "a") == "file-1"
+
+    process_next(outbox)
+    assert google["created"] == ["a.jpg"]
+    assert google["grants"] == ["file-1", "file-1"]
+    assert outbox._pending_ids() == []
+
+
+def test_file_found_on_retry_gets_access(storage, google):
+    outbox = storage.outbox
+    put_entry(outbox)
+    # Файл создан, но ID не успел сохраниться (сбой процесса)
+    outbox._claim(1)
+    outbox._release_leases()
+    google["found"] = "file-found"
+
+    process_next(outbox)
+    assert google["created"] == []
+    assert google["grants"] == ["file-found"]
+    assert outbox._pending_ids() == []
+
+
+def test_inherited_access_needs_no_grant(storage, google, monkeypatch):
+    monkeypatch.setattr(jb, "drive_inherits_public", True)
+    put_entry(storage.outbox)
+    process_next(storage.outbox)
+    assert google["grants"] == []
+    assert storage.outbox._pending_ids() == []
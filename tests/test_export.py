@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Тесты выгрузки журнала в Excel (/export) и доступа к командам менеджеров"""
+
+import asyncio
+import datetime
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from openpyxl import load_workbook
+
+import journal_bot as jb
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+        self.documents = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_document(self, document, filename, caption, **kwargs):
+        self.documents.append((filename, caption, document.read()))
+
+
+def command(handler, args=(), user_id=1, chat_id=None):
+    message = FakeMessage()
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=chat_id or user_id),
+        message=message,
+        effective_message=message
+    )
+    asyncio.run(handler(update, SimpleNamespace(args=list(args))))
+    return message
+
+
+@pytest.fixture
+def index(storage, monkeypatch):
+    monkeypatch.setattr(jb, "MANAGER_IDS", {1, -100})
+    index = storage.journal_index
+
+    async def fill():
+        await index.record({"id": "b", "дата": "02.10.2026", "смена": "Ночь", "наименование": "Миникруассан",
+                            "Мастер": "Петров", "комментарий": "тест"}, ["f2", "f3"])
+        await index.record({"id": "a", "дата": "01.10.2026", "смена": "День", "наименование": "Круассан",
+                            "Мастер": "Иванов"})
+        await index.record({"id": "c", "дата": "05.10.2026", "смена": "День", "наименование": "Круассан",
+                            "Мастер": "Иванов"})
+
+    asyncio.run(fill())
+    return index
+
+
+def test_export_writes_period_in_order(index, tmp_path):
+    path = str(tmp_path / "journal.xlsx")
+    count = asyncio.run(index.export_xlsx(datetime.date(2026, 10, 1), datetime.date(2026, 10, 2), path))
+    assert count == 2
+
+    rows = list(load_workbook(path).active.values)
+    assert list(rows[0]) == jb.COLUMN_HEADERS
+    assert [row[6] for row in rows[1:]] == ["a", "b"]
+    assert rows[1][1] == datetime.datetime(2026, 10, 1)
+    assert rows[1][5] is None
+    assert rows[2][5] == f'=HYPERLINK("{jb.drive_url("f2")}","Фото")'
+    assert rows[2][7] == f"{jb.drive_url('f2')}\n{jb.drive_url('f3')}"
+
+
+def test_export_command_sends_file(index):
+    message = command(jb.export, ["01.10.2026", "05.10.2026"])
+    [(filename, caption, data)] = message.documents
+    assert filename == f"{jb.EXCEL_FILE.rsplit('.', 1)[0]}_01.10.2026-05.10.2026.xlsx"
+    assert caption == "📄 Журнал за 01.10.2026 – 05.10.2026: записей 3"
+    assert load_workbook(BytesIO(data)).active.max_row == 4
+
+
+def test_export_of_empty_period_sends_no_file(index):
+    message = command(jb.export, ["01.01.2026"])
+    assert message.documents == []
+    assert message.replies[-1] == "📄 01.01.2026: записей нет"
+
+
+@pytest.mark.parametrize("handler", [jb.report, jb.stats, jb.export])
+def test_manager_commands_refuse_others(index, handler):
+    message = command(handler, user_id=2)
+    assert message.replies == ["⛔ Команда доступна только менеджерам"]
+    assert message.documents == []
+
+
+def test_manager_chat_is_allowed(index):
+    message = command(jb.stats, user_id=2, chat_id=-100)
+    assert message.replies[0].startswith("📈 Всего записей в журнале: 3")
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Тесты планировщика запросов к Google: ведро токенов, приоритеты, пауза после 429"""
+
+import asyncio
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import journal_bot as jb
+
+
+def run_acquires(scheduler, requests, hold=0.0):
+    """Запросы (метка, приоритет) одновременно; метки в порядке запуска и время запуска"""
+    started = []
+
+    async def request(label, priority):
+        await scheduler.acquire(priority)
+        started.append((label, time.monotonic()))
+        await asyncio.sleep(hold)
+        scheduler.release()
+
+    async def run():
+        begin = time.monotonic()
+        await asyncio.gather(*(request(label, priority) for label, priority in requests))
+        return [(label, moment - begin) for label, moment in started]
+
+    return asyncio.run(run())
+
+
+def test_burst_then_rate():
+    scheduler = jb.GoogleApiScheduler("test", rate=20, burst=2, concurrency=10)
+    started = run_acquires(scheduler, [(index, jb.PRIORITY_INTERACTIVE) for index in range(4)])
+    delays = [delay for _, delay in started]
+    assert delays[1] < 0.03
+    # Дальше — один запрос в 1/rate секунды
+    assert delays[2] >= 0.04 and delays[3] >= 0.09
+
+
+def test_interactive_requests_go_first():
+    scheduler = jb.GoogleApiScheduler("test", rate=1000, burst=1000, concurrency=1)
+    started = run_acquires(scheduler, [
+        ("first", jb.PRIORITY_BACKGROUND),
+        ("background-1", jb.PRIORITY_BACKGROUND),
+        ("interactive", jb.PRIORITY_INTERACTIVE),
+        ("background-2", jb.PRIORITY_BACKGROUND)
+    ], hold=0.01)
+    assert [label for label, _ in started] == ["first", "interactive", "background-1", "background-2"]
+
+
+def test_throttled_pauses_and_halves_rate():
+    scheduler = jb.GoogleApiScheduler("test", rate=10, burst=10, concurrency=10)
+
+    async def run():
+        scheduler.throttled(0.1)
+        begin = time.monotonic()
+        await scheduler.acquire(jb.PRIORITY_INTERACTIVE)
+        scheduler.release()
+        return time.monotonic() - begin
+
+    assert asyncio.run(run()) >= 0.09
+    assert scheduler.rate == 5
+    scheduler.succeeded()
+    assert scheduler.rate == 5.5
+    for _ in range(20):
+        scheduler.succeeded()
+    assert scheduler.rate == 10
+
+
+def http_error(status, retry_after=None):
+    headers = {"status": status}
+    if retry_after is not None:
+        headers["retry-after"] = retry_after
+    return HttpError(httplib2.Response(headers), b"{}")
+
+
+@pytest.fixture
+def sheets_scheduler(monkeypatch):
+    scheduler = jb.GoogleApiScheduler("sheets", rate=100, burst=100, concurrency=4)
+    monkeypatch.setitem(jb.google_schedulers, "sheets", scheduler)
+    return scheduler
+
+
+def execute(monkeypatch, method, responses):
+    calls = []
+
+    def execute_request(make_request):
+        calls.append(method)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(jb, "_execute_google_request", execute_request)
+    return asyncio.run(jb.google_execute("sheets", method, lambda: None)), calls
+
+
+def test_429_is_retried_after_pause(monkeypatch, sheets_scheduler):
+    result, calls = execute(monkeypatch, "values.append", [http_error(429, "0"), {"ok": True}])
+    assert result == {"ok": True}
+    assert len(calls) == 2
+    assert sheets_scheduler.rate < 100
+    assert sheets_scheduler.running == 0
+
+
+def test_5xx_is_not_retried_for_append(monkeypatch, sheets_scheduler):
+    with pytest.raises(HttpError):
+        execute(monkeypatch, "values.append", [http_error(503), {"ok": True}])
+    assert sheets_scheduler.running == 0
+
+
+def test_5xx_is_retried_for_idempotent_methods(monkeypatch, sheets_scheduler):
+    monkeypatch.setattr(jb, "GOOGLE_RETRY_BASE_DELAY", 0.001)
+    result, calls = execute(monkeypatch, "values.get", [http_error(503), {"values": []}])
+    assert result == {"values": []}
+    assert len(calls) == 2
+    # 5xx не снижает скорость: это не превышение квоты
+    assert sheets_scheduler.rate == 100
+
+
+def test_retry_after_header_is_respected():
+    assert jb.google_retry_delay(http_error(429, "7"), 0) == 7
+    assert 0 <= jb.google_retry_delay(http_error(503), 0) <= jb.GOOGLE_RETRY_BASE_DELAY
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Тесты локального индекса журнала: отчеты и сверка с таблицей"""
+
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import journal_bot as jb
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def entry(entry_id, date, shift="День", product="Круассан классический", master="Иванов"):
+    return {"id": entry_id, "дата": date, "смена": shift, "наименование": product, "Мастер": master}
+
+
+def record_all(index, entries):
+    async def run():
+        for data in entries:
+            await index.record(data, [f"file-{data['id']}"])
+
+    asyncio.run(run())
+
+
+def command(handler, args=(), user_id=1):
+    message = FakeMessage()
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id),
+        message=message,
+        effective_message=message
+    )
+    asyncio.run(handler(update, SimpleNamespace(args=list(args))))
+    return message.replies
+
+
+@pytest.fixture
+def index(storage, monkeypatch):
+    monkeypatch.setattr(jb, "MANAGER_IDS", {1})
+    return storage.journal_index
+
+
+def test_report_counts_by_shift_product_and_master(index):
+    record_all(index, [
+        entry("a", "01.10.2026"),
+        entry("b", "01.10.2026", master="Петров"),
+        entry("c", "01.10.2026", shift="Ночь", product="Миникруассан"),
+        entry("d", "02.10.2026")
+    ])
+    data = asyncio.run(index.report(datetime.date(2026, 10, 1), datetime.date(2026, 10, 1)))
+    assert data["total"] == 3
+    assert data["by_shift"] == [("День", "Круассан классический", 2), ("Ночь", "Миникруассан", 1)]
+    assert data["by_master"] == [("Иванов", 2), ("Петров", 1)]
+
+    [reply] = command(jb.report, ["02.10.2026", "01.10.2026"])
+    assert reply.startswith("📊 Отчет за 01.10.2026 – 02.10.2026\nВсего записей: 4")
+
+
+def test_report_rejects_bad_date(index):
+    [reply] = command(jb.report, ["1 октября"])
+    assert reply.startswith("❌ Формат: /report")
+
+
+def test_record_keeps_first_photo_ids(index):
+    async def run():
+        await index.record(entry("a", "01.10.2026"))
+        await index.record(entry("a", "01.10.2026"), ["file-1", "file-2"])
+        await index.record(entry("a", "01.10.2026"), ["file-3"])
+
+    asyncio.run(run())
+    assert index._db.execute("SELECT drive_file_id FROM journal").fetchall() == [("file-1 file-2",)]
+
+
+def test_stats_covers_last_days(index):
+    today = datetime.date.today()
+    record_all(index, [
+        entry("a", today.strftime("%d.%m.%Y")),
+        entry("b", (today - datetime.timedelta(days=30)).strftime("%d.%m.%Y"))
+    ])
+    data = asyncio.run(index.stats())
+    assert data["total"] == 2
+    assert data["by_day"] == [(today.isoformat(), "День", 1)]
+
+
+# Сверка с таблицей
+
+def reconcile(index, monkeypatch, rows):
+    layout = ["Мастер", "Дата", "Смена", "Наименование", "Комментарий", "Фото", "ID записи", "Ссылки на фото"]
+
+    async def sheets_get_values(service, range_name, value_render_option="FORMATTED_VALUE"):
+        return {"values": rows}
+
+    monkeypatch.setattr(jb, "sheet_layout", layout)
+    monkeypatch.setattr(jb, "sheets_get_values", sheets_get_values)
+    asyncio.run(index.reconcile(object()))
+    return index._db.execute("SELECT id, date, master, drive_file_id FROM journal ORDER BY date, master, id").fetchall()
+
+
+def legacy(master, date, file_id):
+    return [master, date, "День", "Круассан классический", "", f'=IMAGE("{jb.drive_url(file_id)}")']
+
+
+def test_reconcile_adds_missing_rows(index, monkeypatch):
+    record_all(index, [entry("a", "01.10.2026")])
+    rows = reconcile(index, monkeypatch, [
+        ["Иванов", "01.10.2026", "День", "Круассан классический", "", "", "a", ""],
+        ["Петров", "02.10.2026", "Ночь", "Миникруассан", "", "", "b",
+         f"{jb.drive_url('file-1')}\n{jb.drive_url('file-2')}"],
+        ["Сидоров", "не дата", "День", "Миникруассан", "", "", "c", ""]
+    ])
+    assert rows == [
+        ("a", "2026-10-01", "Иванов", "file-a"),
+        ("b", "2026-10-02", "Петров", "file-1 file-2")
+    ]
+
+
+def test_reconcile_legacy_rows_follow_sheet_content(index, monkeypatch):
+    sheet = [legacy("Иванов", "01.10.2026", "f1"), legacy("Петров", "02.10.2026", "f2"),
+             legacy("Петров", "02.10.2026", "f2")]
+    first = reconcile(index, monkeypatch, sheet)
+    assert len(first) == 3
+
+    # Сортировка листа не плодит дубли и не меняет ключи
+    assert reconcile(index, monkeypatch, sheet[::-1]) == first
+    # Удаленная из таблицы строка исчезает и из индекса
+    assert reconcile(index, monkeypatch, sheet[1:]) == first[1:]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Тесты метрик в текстовом формате Prometheus"""
+
+import journal_bot as jb
+
+
+def test_render_prometheus_text():
+    metrics = jb.Metrics()
+    metrics.describe("test_total", "counter", "Счетчик")
+    metrics.describe("test_seconds", "histogram", "Гистограмма", [0.1, 1])
+    metrics.inc("test_total", stage="a")
+    metrics.inc("test_total", 2, stage="a")
+    metrics.observe("test_seconds", 0.05)
+    metrics.observe("test_seconds", 5)
+    metrics.gauge("test_depth", lambda: {(("queue", "q"),): 7})
+
+    lines = metrics.render().splitlines()
+    assert lines[:3] == ["# HELP test_total Счетчик", "# TYPE test_total counter", 'test_total{stage="a"} 3']
+    for line in (
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 1',
+        'test_seconds_bucket{le="+Inf"} 2',
+        "test_seconds_sum 5.05",
+        "test_seconds_count 2",
+        "# TYPE test_depth untyped",
+        'test_depth{queue="q"} 7'
+    ):
+        assert line in lines
+
+
+def test_timer_observes_block_duration():
+    metrics = jb.Metrics()
+    metrics.describe("test_seconds", "histogram", "Гистограмма", [0.5])
+    with metrics.timer("test_seconds", stage="a"):
+        pass
+    assert 'test_seconds_bucket{stage="a",le="0.5"} 1' in metrics.render().splitlines()
+
+
+def test_failing_gauge_is_skipped():
+    metrics = jb.Metrics()
+    metrics.inc("test_total")
+
+    def broken():
+        raise RuntimeError("нет данных")
+
+    metrics.gauge("test_broken", broken)
+    text = metrics.render()
+    assert "test_total 1" in text
+    assert "test_broken" not in text
+
+
+# Метрики воркеров выгрузки
+
+def test_render_merges_worker_snapshots():
+    worker = jb.Metrics()
+    worker.inc("test_total", stage="a")
+    worker.observe("test_seconds", 0.3)
+    metrics = jb.Metrics()
+    metrics.describe("test_total", "counter", "Счетчик")
+    metrics.inc("test_total", stage="a")
+
+    lines = metrics.render([((("worker", 0),), worker.snapshot())]).splitlines()
+    assert lines.count("# TYPE test_total counter") == 1
+    assert 'test_total{stage="a"} 1' in lines
+    assert 'test_total{stage="a",worker="0"} 1' in lines
+    assert 'test_seconds_count{worker="0"} 1' in lines
+    assert 'test_seconds_bucket{worker="0",le="+Inf"} 1' in lines
+
+
+def test_worker_metrics_are_collected_over_unix_socket(tmp_path, monkeypatch):
+    import asyncio
+
+    path = str(tmp_path / "worker.sock")
+    monkeypatch.setattr(jb, "worker_metrics_sockets", [path, str(tmp_path / "missing.sock")])
+
+    async def run():
+        runner = await jb.start_web_server(jb.create_web_app(None), path)
+        try:
+            return await jb.collect_worker_metrics()
+        finally:
+            await runner.cleanup()
+
+    [(labels, snapshot)] = asyncio.run(run())
+    assert labels == (("worker", 0),)
+    assert set(snapshot) == {"counters", "histograms", "gauges"}
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Тесты локальной очереди записей outbox"""
+
+import sqlite3
+
+import pytest
+
+
+def put(outbox, entry_id, batch_id=None, photos=1):
+    import journal_bot as jb
+
+    outbox._put(entry_id, 1, {"id": entry_id}, [jb.EntryPhoto(b"jpeg", ["key"])] * photos, batch_id, False)
+
+
+def make_due(outbox, entry_id):
+    outbox._db.execute("UPDATE outbox SET next_attempt_at = 0 WHERE id = ?", (entry_id,))
+
+
+def test_claim_leases_entry_once(storage):
+    outbox = storage.outbox
+    put(outbox, "a", photos=2)
+    [entry] = outbox._claim(10)
+    assert entry["id"] == "a"
+    assert entry["claims"] == 1
+    assert [photo["position"] for photo in entry["photos"]] == [0, 1]
+    assert outbox._claim(10) == []
+    assert storage.Outbox(outbox.path)._claim(10) == []
+
+
+def test_retry_claims_again_with_dedupe(storage):
+    outbox = storage.outbox
+    put(outbox, "a")
+    [entry] = outbox._claim(10)
+    outbox._retry("a", entry["attempts"], "ошибка")
+    assert outbox._claim(10) == []
+
+    make_due(outbox, "a")
+    [entry] = outbox._claim(10)
+    assert entry["attempts"] == 1
+    # Взятая повторно запись выгружается с проверкой дублей
+    assert entry["claims"] > 1
+
+
+def test_interrupted_entry_claims_again_with_dedupe(storage):
+    outbox = storage.outbox
+    put(outbox, "a")
+    outbox._claim(10)
+    # Остановка: аренда возвращается, попытка не засчитывается
+    outbox._release_leases()
+
+    [entry] = outbox._claim(10)
+    assert entry["attempts"] == 0
+    assert entry["claims"] == 2
+
+def test_done_removes_entry_and_album_photos(storage):
+    outbox = storage.outbox
+    put(outbox, "a", photos=3)
+    outbox._claim(10)
+    assert outbox._done("a")
+    assert outbox._pending_ids() == []
+    assert outbox._db.execute("SELECT COUNT(*) FROM outbox_photo").fetchone()[0] == 0
+
+
+def test_discard_failure_rolls_back(storage):
+    outbox = storage.outbox
+    put(outbox, "a", batch_id="shift", photos=2)
+    outbox._db.execute(
+        "CREATE TRIGGER locked BEFORE DELETE ON outbox_photo BEGIN SELECT RAISE(ABORT, 'database is locked'); END"
+    )
+    with pytest.raises(sqlite3.DatabaseError):
+        outbox._discard("a")
+    # Соединение не осталось внутри транзакции, запись на месте
+    assert not outbox._db.in_transaction
+    assert outbox._pending_ids() == ["a"]
+
+    outbox._db.execute("DROP TRIGGER locked")
+    assert outbox._discard("a")
+
+
+# Аренда записей несколькими процессами
+
+def expire_lease(outbox, entry_id):
+    outbox._db.execute("UPDATE outbox SET leased_until = 0 WHERE id = ?", (entry_id,))
+
+
+def test_expired_lease_moves_to_other_process(storage):
+    first, second = storage.outbox, storage.Outbox(storage.outbox.path)
+    put(first, "a")
+    first._claim(10)
+    expire_lease(first, "a")
+
+    [entry] = second._claim(10)
+    assert entry["claims"] == 2
+    assert first._renew_leases(["a"]) == ["a"]
+    # Прежний владелец аренды больше не меняет и не удаляет запись
+    first._set_drive_file("a", 0, "stale")
+    first._retry("a", 0, "ошибка")
+    assert not first._done("a")
+    row = first._db.execute("SELECT drive_file_id, attempts, lease_owner FROM outbox").fetchone()
+    assert row == (None, 0, second.owner)
+    assert second._done("a")
+    assert second._pending_ids() == []
+
+
+def test_renew_extends_own_leases(storage):
+    outbox = storage.outbox
+    put(outbox, "a")
+    outbox._claim(10)
+    outbox._db.execute("UPDATE outbox SET leased_until = 1")
+    assert outbox._renew_leases(["a"]) == []
+    assert outbox._db.execute("SELECT leased_until FROM outbox").fetchone()[0] > 1
+
+
+def test_heartbeat_cancels_upload_taken_by_other_process(storage, monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(storage, "OUTBOX_LEASE", 0.03)
+    first, second = storage.outbox, storage.Outbox(storage.outbox.path)
+    put(first, "a")
+    put(first, "b")
+    first._claim(10)
+    expire_lease(first, "a")
+    second._claim(10)
+
+    async def run():
+        uploads = {entry_id: asyncio.create_task(asyncio.sleep(10)) for entry_id in ("a", "b")}
+        first._in_flight.update(uploads)
+        heartbeat = asyncio.create_task(first._heartbeat())
+        await asyncio.sleep(0.05)
+        heartbeat.cancel()
+        uploads["b"].cancel()
+        await asyncio.gather(heartbeat, *uploads.values(), return_exceptions=True)
+        return uploads
+
+    uploads = asyncio.run(run())
+    assert uploads["a"].cancelled()
+    owners = dict(first._db.execute("SELECT id, lease_owner FROM outbox"))
+    assert owners == {"a": second.owner, "b": first.owner}
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Тесты хранения состояния диалогов в SQLite"""
+
+import asyncio
+import datetime
+
+import journal_bot as jb
+
+
+def test_user_data_survives_restart(tmp_path):
+    path = str(tmp_path / "state.db")
+    state = {"этап": 5, "Мастер": "Иванов", "date_obj": datetime.datetime(2026, 10, 1), "записи": [{"id": "a"}]}
+
+    async def run():
+        persistence = jb.SQLitePersistence(path, 60)
+        await persistence.update_user_data(1, state)
+        await persistence.update_user_data(2, {"этап": 1})
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+
+        restarted = jb.SQLitePersistence(path, 60)
+        try:
+            return await restarted.get_user_data()
+        finally:
+            await restarted.flush()
+
+    assert asyncio.run(run()) == {1: state}
+
+
+def test_unchanged_user_data_is_not_rewritten(tmp_path):
+    persistence = jb.SQLitePersistence(str(tmp_path / "state.db"), 60)
+    persistence._save_user(1, {"этап": 2})
+    persistence._db.execute("UPDATE user_state SET updated_at = 0")
+
+    persistence._save_user(1, {"этап": 2})
+    assert persistence._db.execute("SELECT updated_at FROM user_state").fetchone()[0] == 0
+    persistence._save_user(1, {"этап": 3})
+    assert persistence._db.execute("SELECT updated_at FROM user_state").fetchone()[0] > 0
+    persistence._db.close()
+
+
+def test_unreadable_user_data_is_skipped(tmp_path):
+    path = str(tmp_path / "state.db")
+    persistence = jb.SQLitePersistence(path, 60)
+    persistence._save_user(1, {"этап": 4})
+    persistence._db.execute("INSERT INTO user_state VALUES (2, x'00', 0)")
+    assert persistence._load_users() == {1: {"этап": 4}}
+    persistence._db.close()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Тесты локальных копий фото: имена, лимит объема и возраста, невыгруженные фото"""
+
+import asyncio
+import os
+import time
+
+import journal_bot as jb
+
+
+def make_store(tmp_path, max_bytes=1000, max_age=0):
+    return jb.PhotoStore(str(tmp_path), max_bytes, max_age)
+
+
+def files(tmp_path):
+    return sorted(os.listdir(tmp_path))
+
+
+def test_album_photos_do_not_overwrite_each_other(tmp_path):
+    store = make_store(tmp_path)
+
+    async def run():
+        await asyncio.gather(store.save("a", b"1" * 10), store.save("a", b"2" * 20, 1), store.save("b", b"3" * 30))
+
+    asyncio.run(run())
+    ext = jb.PHOTO_EXTENSION
+    assert files(tmp_path) == [f"a.{ext}", f"a_1.{ext}", f"b.{ext}"]
+    assert store.total_bytes == 60
+    assert jb.photo_entry_id(f"a_1.{ext}") == "a"
+
+
+def test_eviction_keeps_pending_photos(tmp_path):
+    store = make_store(tmp_path, max_bytes=250)
+
+    async def run():
+        for entry_id in "abcd":
+            await store.save(entry_id, b"x" * 100)
+        # Выгружены в Drive только b и c; a — самая давняя, но еще не выгружена
+        store.confirm("b")
+        store.confirm("c")
+        return await store.sweep()
+
+    assert asyncio.run(run()) == 2
+    ext = jb.PHOTO_EXTENSION
+    assert files(tmp_path) == [f"a.{ext}", f"d.{ext}"]
+    assert store.total_bytes == 200
+
+
+def test_over_limit_without_confirmed_photos_deletes_nothing(tmp_path):
+    store = make_store(tmp_path, max_bytes=50)
+
+    async def run():
+        await store.save("a", b"x" * 100)
+        return await store.sweep()
+
+    assert asyncio.run(run()) == 0
+    assert files(tmp_path) == [f"a.{jb.PHOTO_EXTENSION}"]
+
+
+def test_old_confirmed_photos_expire(tmp_path):
+    store = make_store(tmp_path, max_bytes=10 ** 6, max_age=3600)
+
+    async def run():
+        await store.save("old", b"x")
+        await store.save("new", b"x")
+        store.confirm("old")
+        store.confirm("new")
+        size, _ = store._files[f"old.{jb.PHOTO_EXTENSION}"]
+        store._files[f"old.{jb.PHOTO_EXTENSION}"] = (size, time.time() - 7200)
+        return await store.sweep()
+
+    assert asyncio.run(run()) == 1
+    assert files(tmp_path) == [f"new.{jb.PHOTO_EXTENSION}"]
+
+
+def test_load_marks_pending_and_removes_stale_tmp(tmp_path):
+    ext = jb.PHOTO_EXTENSION
+    for name in (f"a.{ext}", f"b.{ext}", f"b_1.{ext}"):
+        (tmp_path / name).write_bytes(b"x" * 100)
+    stale = tmp_path / f"c.{ext}.1234.tmp"
+    stale.write_bytes(b"x")
+    os.utime(stale, (time.time() - 3600, time.time() - 3600))
+
+    store = make_store(tmp_path, max_bytes=0)
+
+    async def run():
+        await store.load(["b"])
+        return await store.sweep()
+
+    assert asyncio.run(run()) == 1
+    assert files(tmp_path) == [f"b.{ext}", f"b_1.{ext}"]
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Тесты выбора, скачивания и обработки фото"""
+
+import asyncio
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from PIL import Image as PILImage
+
+import journal_bot as jb
+from bench_images import make_photo
+
+
+def photo_size(width, height):
+    return SimpleNamespace(width=width, height=height)
+
+
+# pick_photo_size
+
+def test_pick_photo_size_smallest_covering_box():
+    sizes = [photo_size(1280, 960), photo_size(90, 67), photo_size(800, 600), photo_size(320, 240)]
+    assert jb.pick_photo_size(sizes) is sizes[2]
+
+
+def test_pick_photo_size_one_side_is_enough():
+    sizes = [photo_size(600, 900), photo_size(300, 450)]
+    assert jb.pick_photo_size(sizes) is sizes[0]
+
+
+def test_pick_photo_size_all_small_takes_largest():
+    sizes = [photo_size(320, 240), photo_size(640, 480), photo_size(90, 67)]
+    assert jb.pick_photo_size(sizes) is sizes[1]
+
+
+# download_file
+
+def download(status, body=b""):
+    """Скачать файл с локального сервера, у которого в пути файла токен бота"""
+
+    async def handler(request):
+        return web.Response(status=status, body=body)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/file/bot0:secret-token/photos/file_1.jpg", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        url = f"http://127.0.0.1:{port}/file/bot0:secret-token/photos/file_1.jpg"
+
+        async def get_file():
+            return SimpleNamespace(file_path=url)
+
+        try:
+            return await jb.download_file(get_file)
+        finally:
+            await jb.http_session().close()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_download_file_returns_body():
+    assert download(200, b"jpeg") == b"jpeg"
+
+
+@pytest.mark.parametrize("status", [404, 502])
+def test_download_error_does_not_leak_token(status):
+    with pytest.raises(jb.TelegramDownloadError) as error:
+        download(status)
+    assert str(status) in str(error.value)
+    assert "secret-token" not in str(error.value)
+
+
+def test_download_connection_error_does_not_leak_token():
+    async def get_file():
+        return SimpleNamespace(file_path="http://127.0.0.1:9/file/bot0:secret-token/photos/file_1.jpg")
+
+    async def run():
+        try:
+            await jb.download_file(get_file)
+        finally:
+            await jb.http_session().close()
+
+    with pytest.raises(jb.TelegramDownloadError) as error:
+        asyncio.run(run())
+    assert "secret-token" not in str(error.value)
+
+
+# process_image
+
+@pytest.fixture(scope="module")
+def raw_photo():
+    return make_photo(1600, 1200)
+
+
+def encode(raw, **kwargs):
+    kwargs.setdefault("image_format", "jpeg")
+    kwargs.setdefault("min_quality", 60)
+    kwargs.setdefault("max_quality", 85)
+    kwargs.setdefault("progressive", False)
+    return jb.process_image(raw, (800, 600), **kwargs)
+
+
+def image_size(photo_bytes):
+    with PILImage.open(BytesIO(photo_bytes)) as img:
+        return img.size
+
+
+def test_process_image_fits_budget_uses_full_color(raw_photo):
+    photo_bytes, info = encode(raw_photo, target_bytes=10 ** 7)
+    assert image_size(photo_bytes) == (800, 600)
+    assert info["quality"] == 85
+    assert info["subsampling"] == "4:4:4"
+    assert info["encodes"] == 2
+    assert info["bytes"] == len(photo_bytes)
+    assert not info["over_budget"]
+
+
+def test_process_image_searches_quality_under_budget(raw_photo):
+    largest = encode(raw_photo, target_bytes=0)[1]["bytes"]
+    smallest = encode(raw_photo, target_bytes=0, max_quality=60)[1]["bytes"]
+    target = (largest + smallest) // 2
+
+    photo_bytes, info = encode(raw_photo, target_bytes=target)
+    assert len(photo_bytes) <= target
+    assert 60 <= info["quality"] < 85
+    assert info["subsampling"] == "4:2:0"
+    assert not info["over_budget"]
+    # Следующее качество после найденного уже не помещается (точность поиска — 2)
+    above = encode(raw_photo, target_bytes=0, max_quality=min(info["quality"] + 3, 85))[1]
+    assert above["bytes"] > target
+
+
+def test_process_image_stops_at_min_quality(raw_photo):
+    photo_bytes, info = encode(raw_photo, target_bytes=1000)
+    assert info["quality"] == 60
+    assert info["over_budget"]
+    assert info["encodes"] == 2
+    assert len(photo_bytes) > 1000
+
+
+def test_process_image_applies_exif_orientation():
+    img = PILImage.new("RGB", (400, 200), "white")
+    exif = img.getexif()
+    exif[0x0112] = 6  # Orientation: повернуть на 90°
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", exif=exif)
+
+    photo_bytes, _ = encode(buffer.getvalue(), target_bytes=0)
+    assert image_size(photo_bytes) == (200, 400)
+    with PILImage.open(BytesIO(photo_bytes)) as result:
+        assert 0x0112 not in result.getexif()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""Тесты пакетной записи строк в Google Sheets"""
+
+import asyncio
+
+import journal_bot as jb
+
+
+def test_sheets_queue_skips_cancelled_rows(monkeypatch):
+    appended = []
+
+    async def sheets_append_values(service, range_name, values):
+        appended.extend(values)
+
+    monkeypatch.setattr(jb, "sheet_layout", ["ID записи"])
+    monkeypatch.setattr(jb, "sheets_append_values", sheets_append_values)
+    monkeypatch.setitem(jb.google_services, "sheets", object())
+
+    async def write():
+        loop = asyncio.get_running_loop()
+        cancelled, kept = loop.create_future(), loop.create_future()
+        cancelled.cancel()
+        await jb.SheetsAppendQueue(10, 1)._write([
+            (({"ID записи": "a"}, False), cancelled),
+            (({"ID записи": "b"}, False), kept)
+        ])
+        return kept.result()
+
+    assert asyncio.run(write())
+    assert appended == [["b"]]
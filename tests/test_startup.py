@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Тесты быстрого запуска: импорт без побочных эффектов и проверка настроек"""
+
+import os
+import subprocess
+import sys
+
+import journal_bot as jb
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_opens_no_storage(tmp_path):
+    env = dict(
+        os.environ,
+        OUTBOX_DB=str(tmp_path / "journal.db"),
+        PHOTOS_DIR=str(tmp_path / "photos"),
+        MANAGER_IDS="не число"
+    )
+    subprocess.run(
+        [sys.executable, "-c", "import journal_bot"],
+        cwd=ROOT, env=env, check=True, capture_output=True, timeout=60
+    )
+    assert os.listdir(tmp_path) == []
+
+
+def test_open_storage_creates_database_and_photos_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(jb, "OUTBOX_DB", str(tmp_path / "journal.db"))
+    monkeypatch.setattr(jb, "PHOTOS_DIR", str(tmp_path / "photos"))
+    for name in ("outbox", "photo_cache", "journal_index"):
+        monkeypatch.setattr(jb, name, None)
+    jb.open_storage()
+    try:
+        assert jb.outbox._pending_ids() == []
+        assert {"journal.db", "photos"} <= set(os.listdir(tmp_path))
+    finally:
+        jb.close_storage()
+
+
+def test_manager_ids_are_parsed_at_validation(monkeypatch):
+    monkeypatch.setattr(jb, "MANAGER_IDS", frozenset())
+    monkeypatch.setenv("MANAGER_IDS", "1, 2 -100")
+    assert jb.validate_config()
+    assert jb.MANAGER_IDS == {1, 2, -100}
+
+
+def test_bad_manager_ids_fail_validation(monkeypatch):
+    monkeypatch.setattr(jb, "MANAGER_IDS", frozenset())
+    monkeypatch.setenv("MANAGER_IDS", "1,ivanov")
+    assert not jb.validate_config()
+
+
+def test_bad_config_exits_with_code_1(tmp_path):
+    env = dict(os.environ, OUTBOX_DB=str(tmp_path / "journal.db"), MANAGER_IDS="ivanov")
+    result = subprocess.run(
+        [sys.executable, "journal_bot.py"], cwd=ROOT, env=env, capture_output=True, timeout=60
+    )
+    assert result.returncode == 1
+    assert not os.path.exists(tmp_path / "journal.db")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Тесты параллельной обработки обновлений с порядком внутри чата"""
+
+import asyncio
+import datetime
+
+from telegram import Chat, Message, Update
+
+import journal_bot as jb
+
+
+def chat_update(update_id, chat_id):
+    message = Message(update_id, datetime.datetime.now(), Chat(chat_id, Chat.PRIVATE), text="текст")
+    return Update(update_id, message=message)
+
+
+def run_updates(updates, max_running=4):
+    """Обработать (обновление, задержка) одновременно; порядок начала и конца обработки"""
+    events = []
+
+    async def handle(update, delay):
+        events.append(("start", update.update_id))
+        await asyncio.sleep(delay)
+        events.append(("end", update.update_id))
+
+    async def run():
+        processor = jb.ChatOrderedUpdateProcessor(max_running, 100, 60)
+        await asyncio.gather(*(
+            processor.process_update(update, handle(update, delay)) for update, delay in updates
+        ))
+        return processor
+
+    return events, asyncio.run(run())
+
+
+def test_same_chat_updates_run_in_order():
+    events, processor = run_updates([
+        (chat_update(1, 10), 0.05),
+        (chat_update(2, 10), 0),
+        (chat_update(3, 10), 0)
+    ])
+    assert events == [("start", 1), ("end", 1), ("start", 2), ("end", 2), ("start", 3), ("end", 3)]
+    assert processor.stats()["processed"] == 3
+    assert processor.stats()["active_chats"] == 0
+
+
+def test_other_chats_do_not_wait():
+    events, _ = run_updates([
+        (chat_update(1, 10), 0.05),
+        (chat_update(2, 20), 0)
+    ])
+    assert events.index(("end", 2)) < events.index(("end", 1))
+
+
+def test_running_updates_are_limited():
+    running = peak = 0
+
+    async def handle():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        processor = jb.ChatOrderedUpdateProcessor(2, 100, 60)
+        await asyncio.gather(*(
+            processor.process_update(chat_update(index, index), handle()) for index in range(6)
+        ))
+
+    asyncio.run(run())
+    assert peak == 2
+
+
+def test_chat_turn_orders_work_outside_updates():
+    events = []
+
+    async def album(processor):
+        async with processor.chat_turn(10):
+            events.append("album")
+
+    async def run():
+        processor = jb.ChatOrderedUpdateProcessor(4, 100, 60)
+
+        async def slow():
+            events.append("update")
+            await asyncio.sleep(0.02)
+            events.append("update done")
+
+        first = asyncio.create_task(processor.process_update(chat_update(1, 10), slow()))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, album(processor))
+
+    asyncio.run(run())
+    assert events == ["update", "update done", "album"]